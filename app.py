@@ -1,6 +1,26 @@
-import os, qrFileServerConfig, tempfile, atexit, shutil, io, zipfly, base64, math
+import os, qrFileServerConfig, tempfile, atexit, shutil, io, base64, math, secrets, time, tarfile, filecmp, stat, asyncio, threading, struct
 from modules.generateQrcode import generate_unicode_qr
-from flask import Flask, request, send_from_directory, abort, render_template, jsonify, Response
+from modules.listDirectory import list_directory, walk_directory
+from modules.metadataCache import MetadataCache
+from modules.serveFile import serve_file, serve_content
+from modules.uploadSession import UploadSession, part_paths, remove_stale_uploads
+from modules.uploadBatch import UploadBatch
+from modules.deltaSync import SignatureCache, block_size, delta_part_path, write_delta, file_checksums
+from modules.fairShare import FairShare, TooManyTransfers, DOWNLOAD, UPLOAD
+from modules.fileDigest import DigestIndex, new_hasher, parse_checksum, combine_chunk_crcs, format_digest
+from modules.zipStream import ZipStream, ZipLayout
+from modules.tarStream import TarStream, COMPRESSIONS, available_compressions
+from modules.asgiBridge import AsgiBridge, ASYNC_BODY
+from modules.sessionStore import SessionStore
+from modules.metrics import Registry
+from modules.sessionCookie import SessionSigner, equal
+from modules.searchIndex import SearchIndex
+from modules.changeFeed import ChangeFeed
+from modules.fileJobs import FileJobs
+from modules.contentIndex import ContentIndex, METHODS as CLONE_METHODS
+from modules.thumbnails import Thumbnailer, Busy, Pending, Image, can_thumbnail, thumbnail_size
+from modules.compression import LEVELS, CompressedCache, available_encodings, is_compressible, compress, compress_stream
+from flask import Flask, request, send_from_directory, abort, render_template, jsonify, Response, g, has_request_context
 from werkzeug.utils import secure_filename, safe_join
 
 app = Flask(__name__)
@@ -11,16 +31,25 @@ app = Flask(__name__)
 
 def authenticate():
     """
-    Handle authentication by checking url args, cookies, or http auth.
+    Handle authentication by checking the session cookie, url args, cookies, or
+    http auth. The signed session cookie is checked first since it needs no lookup,
+    the other methods issue a new one.
 
     :return: Sends a 401 response if not authenticated and return none if authenticated
     """
-    auth = request.authorization
-    if request.args.get('token') == TOKEN:
+    remaining = SESSIONS.verify(request.cookies.get(SESSION_COOKIE))
+    if remaining is not None:
+        # renew sessions in use once half of their time is left
+        g.issue_session = remaining < SESSIONS.max_age/2
+        return
+    g.issue_session = True
+    if equal(request.args.get('token'), TOKEN):
         return
-    if request.cookies.get('token') == TOKEN:
+    if equal(request.cookies.get('token'), TOKEN):
         return
-    elif not auth or not (auth.username in USERS and USERS[auth.username] == auth.password):
+    auth = request.authorization
+    if not auth or not equal(USERS.get(auth.username), auth.password):
+        g.issue_session = False
         return Response(
             'Please provide valid credentials.', 401,
             {'WWW-Authenticate': 'Basic realm="Login Required"'})
@@ -89,15 +118,350 @@ def secure_folderpath(root, user_input_folder):
         return secure_filename(user_input_folder)
 
 
+def path_metadata(path):
+    """
+    Get the metadata of a path from the metadata cache.
+
+    :param path: An absolute path inside the upload folder.
+    :return: A (name, is_dir, size, mtime) tuple or None if it doesn't exist.
+    """
+    if os.path.normpath(path) == UPLOAD_FOLDER:
+        return ('', True, 0, 0)
+    return METADATA_CACHE.lookup(path)
+
+
+def path_updated(path):
+    """
+    Record a path created or modified by an endpoint in the metadata cache and the
+    search index, and send it to the clients listening to /events.
+
+    :param path: An absolute path inside the upload folder.
+    """
+    METADATA_CACHE.update_path(path)
+    SEARCH_INDEX.update_path(path)
+    CHANGE_FEED.publish(path)
+
+
+def path_removed(path):
+    """Record a path deleted by an endpoint, see path_updated()."""
+    METADATA_CACHE.remove_path(path)
+    SEARCH_INDEX.remove_path(path)
+    CHANGE_FEED.publish(path)
+
+
+def path_moved(source, destination):
+    """Record a path moved by an endpoint, see path_updated()."""
+    METADATA_CACHE.remove_path(source)
+    SEARCH_INDEX.remove_path(source)
+    METADATA_CACHE.update_path(destination)
+    SEARCH_INDEX.update_path(destination)
+    CHANGE_FEED.publish(destination, source)
+
+
+def path_changed(path):
+    """
+    Record a change made outside of the server, seen by the watches of the
+    metadata cache which already updated itself.
+
+    :param path: An absolute path inside the upload folder or None if changes were lost.
+    """
+    if path is None:
+        CHANGE_FEED.reset()
+        return
+    SEARCH_INDEX.update_path(path)
+    CHANGE_FEED.publish(path)
+
+
+def makedirs(path):
+    """os.makedirs() that records the created directories, see path_updated()."""
+    METADATA_CACHE.makedirs(path)
+    SEARCH_INDEX.update_path(path)
+    CHANGE_FEED.publish(path)
+
+
+def annotate_file(path, entry):
+    """
+    Add what the server knows about a file to its listing entry: its 'digest' when
+    it was already computed and 'thumbnail' when /thumb can make a preview of it.
+
+    :param path: The absolute path of the file.
+    :param entry: The listing entry of the file, modified in place.
+    """
+    digest = DIGEST_INDEX.peek(path, entry['size'], entry['mtime'])
+    if digest is not None:
+        entry['digest'] = digest
+    if THUMBNAILER is not None and can_thumbnail(entry['name']):
+        entry['thumbnail'] = True
+
+
+def describe_path(path):
+    """
+    :param path: An absolute path inside the upload folder.
+    :return: Its entry like in /files?lazy=true without the 'path', or None if it
+    doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    name = os.path.basename(path)
+    if stat.S_ISDIR(st.st_mode):
+        return {'name': name, 'type': 'folder', 'size': 0, 'mtime': int(st.st_mtime)}
+    entry = {'name': name, 'type': 'file', 'size': st.st_size, 'mtime': int(st.st_mtime)}
+    annotate_file(path, entry)
+    return entry
+
+
+def compress_response(response):
+    """
+    Compress text and json responses with the best content encoding accepted by the
+    client. Range responses, small ones and types that are already compressed are
+    sent as they are. Files are compressed once and kept in a cache keyed by their
+    etag, bigger ones are compressed as they are sent. A compressed response has the
+    etag of the uncompressed one followed by the encoding, like "<etag>-gzip".
+
+    :param response: A flask response.
+    :return: The response.
+    """
+    if (not RESPONSE_ENCODINGS or request.method == 'HEAD' or response.status_code != 200
+            or 'Range' in request.headers or 'Content-Encoding' in response.headers
+            or not is_compressible(response.mimetype)):
+        return response
+    response.vary.add('Accept-Encoding')
+    length = response.content_length
+    if length is not None and length < COMPRESS_MIN_SIZE:
+        return response
+    encoding = request.accept_encodings.best_match(RESPONSE_ENCODINGS)
+    if encoding is None:
+        return response
+
+    level, cached_level = LEVELS[encoding]
+    etag, weak = response.get_etag()
+    body = response.response
+    if etag is not None and not weak and request.if_none_match.contains_weak(f'{etag}-{encoding}'):
+        # the view compared the etag of the file, not the one of its compressed version
+        if hasattr(body, 'close'):
+            body.close()
+        response.direct_passthrough = False
+        response.response = []
+        response.status_code = 304
+        for header in ('Content-Length', 'Content-Type', 'Content-Disposition', 'Accept-Ranges'):
+            response.headers.pop(header, None)
+        response.set_etag(f'{etag}-{encoding}')
+        return response
+    if etag is not None and not weak and length is not None and length <= COMPRESS_CACHE_ENTRY_SIZE:
+        data = COMPRESSED_CACHE.get(etag, encoding)
+        if data is None:
+            data = compress(b''.join(body), encoding, cached_level)
+            COMPRESSED_CACHE.put(etag, encoding, data)
+        if hasattr(body, 'close'):
+            body.close()
+        response.direct_passthrough = False
+        response.set_data(data)
+    elif response.is_streamed or response.direct_passthrough:
+        response.direct_passthrough = False
+        response.response = compress_stream(body, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress(response.get_data(), encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    if etag is not None:
+        # the compressed bytes differ, a strong etag of their own keeps If-Range from
+        # mixing the two versions and lets If-None-Match match them
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+
+def record_scan(seconds):
+    """Record the time spent reading a directory from the filesystem."""
+    DIRECTORY_SCAN_SECONDS.observe(seconds)
+    if has_request_context():
+        g.fs_time = g.get('fs_time', 0) + seconds
+
+
+def track_archive(chunks, archive_format):
+    """
+    Count an archive as in progress while its chunks are sent.
+
+    :param chunks: A generator of the archive.
+    :param archive_format: 'zip' or 'tar'.
+    """
+    ARCHIVE_STREAMS.inc(1, archive_format)
+    try:
+        yield from chunks
+    finally:
+        ARCHIVE_STREAMS.dec(1, archive_format)
+
+
+class ClosingBody:
+    """
+    A response body that counts the bytes sent and calls a function with their
+    number once the server closes it. Werkzeug skips the close callbacks of
+    direct_passthrough responses such as files and ranges, but a wsgi server always
+    closes the body it was given.
+    """
+
+    def __init__(self, body, closed):
+        self.body = body
+        self.iterator = iter(body)
+        self.closed = closed
+        self.sent = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = next(self.iterator)
+        self.sent += len(data)
+        return data
+
+    def close(self):
+        closed, self.closed = self.closed, None
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            if closed is not None:
+                closed(self.sent)
+
+
+def on_body_closed(response, closed):
+    """
+    Call closed(sent) once the server closes the response body, sent being the
+    number of bytes of the body. A file wrapper is kept so gunicorn still sends the
+    file with sendfile, it counts as sent whole.
+
+    :param response: A flask response.
+    :param closed: A function of the bytes sent.
+    """
+    body = response.response
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if not (file_wrapper is not None and isinstance(body, file_wrapper)):
+        response.response = ClosingBody(body, closed)
+        return
+    close = getattr(body, 'close', None)
+    length = 0 if request.method == 'HEAD' else response.content_length or 0
+    pending = [closed]
+
+    def close_file():
+        try:
+            if close is not None:
+                close()
+        finally:
+            if pending:
+                pending.pop()(length)
+    body.close = close_file
+
+
+def start_transfer():
+    """
+    Take a transfer slot of the scheduler for downloads, archives and uploads, and
+    throttle the request body of uploads. Other requests never wait here, so
+    listings stay fast while large transfers run.
+
+    :return: A json error with the code 'BUSY' and a Retry-After header if there are
+    too many transfers, otherwise None.
+    """
+    direction = TRANSFER_ENDPOINTS.get(request.endpoint)
+    if direction is None or request.method == 'HEAD':
+        return None
+    try:
+        g.transfer = FAIR_SHARE.acquire(request.remote_addr, direction)
+    except TooManyTransfers as e:
+        TRANSFER_REJECTIONS.inc(1, e.reason)
+        return {'message': 'Too many transfers, try again later', 'code': 'BUSY'}, 503, {'Retry-After': '1'}
+    TRANSFERS.inc(1, direction)
+    if direction == UPLOAD and FAIR_SHARE.limited():
+        request.environ['wsgi.input'] = g.transfer.input(request.environ['wsgi.input'])
+    return None
+
+
+def end_transfer(transfer):
+    if not transfer.released:
+        transfer.release()
+        TRANSFERS.dec(1, transfer.direction)
+
+
+def transfer_waited(direction, seconds):
+    TRANSFER_THROTTLED_SECONDS.inc(seconds, direction)
+
+
+def upload_sessions_metric():
+    # the sessions are in the database shared by the workers, so don't add them up
+    return ('# HELP qrfileserver_upload_sessions Upload sessions in progress.\n'
+            '# TYPE qrfileserver_upload_sessions gauge\n'
+            f'qrfileserver_upload_sessions {UPLOAD_SESSIONS.count()}')
+
 
 @app.before_request
 def before_every_request():
     """Authentication and logging before each request"""
-    readonlyAPI = {'/upload', '/delete', '/move', '/newfile', '/newfolder'}
+    g.request_start = time.perf_counter()
+    METRICS.start()
+    readonlyAPI = {'/upload', '/upload/session', '/upload/chunk', '/upload/batch', '/upload/delta', '/upload/delta/commit', '/delete', '/move', '/copy', '/newfile', '/newfolder'}
     if READONLY and request.path in readonlyAPI:
         return {'message': 'This site is in read only mode'}, 405
 
-    if authenticate(): return authenticate()
+    if request.endpoint == 'static':
+        return # the scripts and styles are not secret
+    error = authenticate()
+    if error is not None:
+        return error
+    return start_transfer()
+
+
+@app.after_request
+def after_every_request(response):
+    """
+    Compress the response, record the metrics of each request and add a
+    Server-Timing header with the time spent handling it and reading directories,
+    to debug slow requests from the developer tools of a browser.
+    """
+    response = compress_response(response)
+    now = time.perf_counter()
+    start = g.get('request_start', now)
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method = request.method
+    REQUESTS.inc(1, route, method, str(response.status_code))
+    if request.content_length:
+        RECEIVED_BYTES.inc(request.content_length, route)
+    if request.path.startswith('/upload') and response.is_json:
+        code = (response.get_json(silent=True) or {}).get('code')
+        if code in UPLOAD_REJECTION_CODES:
+            UPLOAD_REJECTIONS.inc(1, code)
+
+    # the transfer slot is held until the whole body is sent, then released when
+    # the body is closed instead of by teardown_transfer()
+    transfer = g.pop('transfer', None)
+    if transfer is not None and transfer.direction == DOWNLOAD and FAIR_SHARE.limited() and method != 'HEAD':
+        # a file is then read through python instead of with sendfile
+        response.direct_passthrough = False
+        response.response = transfer.chunks(response.response)
+
+    def closed(sent):
+        if transfer is not None:
+            end_transfer(transfer)
+        if sent:
+            SENT_BYTES.inc(sent, route)
+        # measured until the body is sent, so downloads include the transfer
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route, method)
+    on_body_closed(response, closed)
+
+    timing = f'app;dur={(now - start)*1000:.1f}'
+    if 'fs_time' in g:
+        timing += f', fs;desc="directory scans";dur={g.fs_time*1000:.1f}'
+    response.headers['Server-Timing'] = timing
+    if g.get('issue_session'):
+        response.set_cookie(SESSION_COOKIE, SESSIONS.sign(), max_age=SESSIONS.max_age, httponly=True,
+                            samesite='Lax', secure=request.is_secure)
+    return response
+
+@app.teardown_request
+def teardown_transfer(error):
+    """Release the transfer slot of a request that failed before it had a response."""
+    transfer = g.pop('transfer', None)
+    if transfer is not None:
+        end_transfer(transfer)
 
 @app.route('/')
 def index():
@@ -106,7 +470,14 @@ def index():
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    """Handle file upload by writing each chunk of data on each request."""
+    """
+    Handle file upload by writing each chunk of data on each request.
+
+    Deprecated: only kept for clients of older versions, use /upload/session and
+    /upload/chunk instead. Chunks must be EXPECTED_CHUNK_SIZE bytes, which doesn't
+    follow the negotiated chunk sizes, and are refused with a 413 status when
+    upload_max_chunk_size is smaller.
+    """
 
     #here is some heavy input validation
     folder = os.path.normpath(request.form.get('folder',''))
@@ -159,7 +530,7 @@ def upload_file():
 
     # Ensure the folder exists
     folder_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER,folder))
-    os.makedirs(folder_path, exist_ok=True)
+    makedirs(folder_path)
     file_path = os.path.join(folder_path, secure_filename(filename))
 
     if os.path.exists(file_path):
@@ -175,6 +546,7 @@ def upload_file():
                 # Rewrite the file
                 resumeTo = 0
                 os.remove(file_path)
+                path_removed(file_path)
                 return {'message': f'Skipping this chunk. Resume to chunk {resumeTo}', 'code': 'RESUME_UPLOAD', 'resumeChunk': resumeTo}, 200
 
 
@@ -184,60 +556,753 @@ def upload_file():
     # Append the chunk to the file
     with open(file_path, 'ab') as f:
         f.write(file_content)
+    path_updated(file_path)
 
     if chunk_index + 1 == total_chunks:
+        record_content(file_path, file_size)
         return {'message': 'File uploaded successfully', 'code': 'SUCCESS'}, 200
 
     return {'message': 'Chunk recieved', 'code': 'CONTINUE'}, 200
 
 
+@app.route('/upload/config', methods=['GET'])
+def upload_config():
+    """
+    Advertise the chunk sizes accepted by /upload/chunk.
+
+    Files are tracked in chunks of 'minChunkSize'. A single request may send up to
+    'maxChunkSize' bytes of consecutive chunks. Clients should start with
+    'defaultChunkSize' and adjust it to their throughput.
+
+    Files of at least 'dedupMinSize' bytes should be created with a 'contentHash'
+    (see /upload/session), it is null when deduplication is disabled.
+
+    Files smaller than 'batchMaxFileSize' should be sent together to /upload/batch
+    in batches of up to 'maxChunkSize' bytes.
+
+    Files of at least 'deltaMinSize' bytes that may already be on the server should
+    be sent with /upload/delta, it is null when delta uploads are disabled.
+
+    :return: A json with 'minChunkSize', 'maxChunkSize', 'defaultChunkSize',
+    'dedupMinSize', 'batchMaxFileSize' and 'deltaMinSize'.
+    """
+    return {'minChunkSize': UPLOAD_MIN_CHUNK_SIZE, 'maxChunkSize': UPLOAD_MAX_CHUNK_SIZE,
+            'defaultChunkSize': UPLOAD_DEFAULT_CHUNK_SIZE,
+            'dedupMinSize': DEDUP_MIN_SIZE if DEDUP_METHODS else None,
+            'batchMaxFileSize': UPLOAD_BATCH_MAX_FILE_SIZE,
+            'deltaMinSize': DELTA_MIN_SIZE or None}
+
+
+@app.route('/upload/session', methods=['POST'])
+def create_upload_session():
+    """
+    Start or resume an upload where chunks can be sent in parallel and in any order.
+
+    The form fields are 'folder', 'filename', 'fileSize', 'resume' and optionally
+    'contentHash', the sha256 of the whole file like 'sha256:<hex>'. When resuming,
+    the chunks received by an earlier unfinished upload to the same file are kept.
+    When resuming and a file of the same size already exists, its content is compared
+    with 'contentHash' and the code 'FILE_ALREADY_UPLOADED' is returned when they
+    match. Without a 'contentHash', the code 'DIGEST_REQUIRED' is returned with the
+    'contentHash' of the existing file.
+
+    With a 'contentHash', a file already on the server with the same content is
+    cloned into place instead of uploaded when dedup is enabled and the code
+    'DEDUPLICATED' is returned with the 'method' used. A 'copy' is only done when the
+    file doesn't exist yet and runs in the background, the response then has its
+    'job' from /jobs/<job_id>.
+
+    :return: A json with the 'session' id, the 'chunkSize' to split the file with,
+    the indexes of the 'missing' chunks to send to /upload/chunk and the chunk sizes
+    from /upload/config.
+    """
+    folder = os.path.normpath(request.form.get('folder',''))
+    filename = request.form.get('filename')
+    if not isinstance(filename, str) or not secure_filename(filename):
+        return {'message': 'Invalid file name'}, 400
+
+    try:
+        file_size = int(request.form.get('fileSize'))
+        if file_size < 0:
+            return {'message': 'Invalid file size'}, 400
+    except (ValueError, TypeError):
+        return {'message': 'Invalid file size'}, 400
+
+    resume = request.form.get('resume','false') == 'true'
+
+    folder_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER,folder))
+    makedirs(folder_path)
+    file_path = os.path.join(folder_path, secure_filename(filename))
+
+    content_hash = request.form.get('contentHash')
+    if content_hash is not None:
+        algorithm, _, sha256 = content_hash.lower().partition(':')
+        if algorithm != 'sha256' or len(sha256) != 64 or not all(c in '0123456789abcdef' for c in sha256):
+            return {'message': 'Invalid content hash'}, 400
+
+    part_path, state_path = part_paths(file_path)
+    if resume and os.path.isfile(file_path) and not os.path.exists(state_path):
+        if os.path.getsize(file_path) == file_size:
+            # the crc32 digests can't tell files apart reliably, their sha256 is compared
+            existing_hash = CONTENT_INDEX.hash(file_path)
+            if existing_hash is not None and content_hash is None:
+                return {'message': 'A file of the same size exists, compare its content hash',
+                        'code': 'DIGEST_REQUIRED', 'contentHash': f'sha256:{existing_hash}'}, 200
+            if existing_hash is not None and sha256 == existing_hash:
+                return {'message':'File already uploaded', 'code': 'FILE_ALREADY_UPLOADED'}, 200
+
+    if content_hash is not None and DEDUP_METHODS and file_size >= DEDUP_MIN_SIZE:
+        materialized = CONTENT_INDEX.materialize(sha256, file_size, file_path, DEDUP_METHODS)
+        if materialized is not None:
+            # an unfinished upload of the same file isn't needed anymore
+            UploadSession(file_path, file_size, UPLOAD_MIN_CHUNK_SIZE).discard()
+            path_updated(file_path)
+            return {'message': 'The same content is already on the server', 'code': 'DEDUPLICATED',
+                    'method': materialized[0]}, 200
+        found = None
+        if 'copy' in DEDUP_METHODS and not os.path.lexists(file_path):
+            found = CONTENT_INDEX.find(sha256, file_size)
+        if found is not None:
+            # copying takes as long as reading the file, it runs as a job followed with /jobs
+            UploadSession(file_path, file_size, UPLOAD_MIN_CHUNK_SIZE).discard()
+            job_id = FILE_JOBS.start('copy', [(found[0], file_path)])
+            return {'message': 'The same content is being copied on the server', 'code': 'DEDUPLICATED',
+                    'method': 'copy', 'job': FILE_JOBS.get(job_id)}, 200
+        hash_same_size(file_size)
+
+    session = UploadSession.open(file_path, file_size, UPLOAD_MIN_CHUNK_SIZE, resume)
+    missing = session.missing_chunks()
+    if not missing and session.finalize():
+        # empty files or uploads that were complete but not moved into place yet
+        finish_upload(None, session)
+        return {'message': 'File uploaded successfully', 'code': 'SUCCESS', 'digest': session.digest}, 200
+
+    session_id = secrets.token_urlsafe(16)
+    UPLOAD_SESSIONS.put(session_id, os.path.relpath(file_path, UPLOAD_FOLDER), file_size, session.chunk_size)
+    return {'message': 'Upload session created', 'code': 'SESSION_CREATED', 'session': session_id,
+            'chunkSize': session.chunk_size, 'missing': missing, **upload_config()}, 200
+
+
+def chunk_checksum(value):
+    """
+    Parse the checksum sent with a chunk.
+
+    :param value: A checksum like 'crc32=1a2b3c4d' or None.
+    :return: A tuple of (hasher, expected hex digest), (None, None) without a
+    checksum or None if the algorithm is not supported.
+    """
+    if value is None:
+        return None, None
+    parsed = parse_checksum(value)
+    if parsed is None:
+        return None
+    hasher = new_hasher(parsed[0])
+    if hasher is None:
+        return None
+    return hasher, parsed[1]
+
+
+def finish_chunk(session_id, session, chunk_index, crcs, hasher, expected):
+    """
+    Verify the checksum of written chunks before marking them as received and
+    finish the upload when it is complete.
+
+    :return: A json response.
+    """
+    if hasher is not None and hasher.hexdigest() != expected:
+        # the chunk stays missing so its data will be written again
+        return {'message': 'Chunk checksum mismatch', 'code': 'CORRUPTED'}, 400
+    try:
+        session.mark_received(chunk_index, crcs)
+    except FileNotFoundError:
+        return {'message': 'Upload session not found', 'code': 'SESSION_NOT_FOUND'}, 404
+
+    if session.finalize():
+        finish_upload(session_id, session)
+        return {'message': 'File uploaded successfully', 'code': 'SUCCESS', 'digest': session.digest}, 200
+    return {'message': 'Chunk recieved', 'code': 'CONTINUE'}, 200
+
+
+def get_upload_session(session_id):
+    """
+    :param session_id: The id of a session created by /upload/session, possibly by
+    another worker.
+    :return: The UploadSession or None if it doesn't exist.
+    """
+    if not isinstance(session_id, str):
+        return None
+    stored = UPLOAD_SESSIONS.get(session_id)
+    if stored is None:
+        return None
+    path, file_size, chunk_size = stored
+    return UploadSession(os.path.join(UPLOAD_FOLDER, path), file_size, chunk_size)
+
+
+def finish_upload(session_id, session):
+    """Forget a completed upload session and record the new file."""
+    if session_id is not None:
+        UPLOAD_SESSIONS.remove(session_id)
+    path_updated(session.file_path)
+    if session.digest is not None:
+        DIGEST_INDEX.set(session.file_path, session.digest)
+    record_content(session.file_path, session.file_size)
+
+
+def expire_uploads():
+    """Forget the expired upload sessions and remove the files they left."""
+    for path in UPLOAD_SESSIONS.expire():
+        remove_stale_uploads(os.path.dirname(os.path.join(UPLOAD_FOLDER, path)), UPLOAD_SESSIONS.max_age)
+
+
+def clean_uploads():
+    """
+    Remove the files of abandoned uploads in the background: at startup those left
+    anywhere in the upload folder, like after a crash, then those of the sessions
+    expiring while the server runs.
+    """
+    try:
+        remove_stale_uploads(UPLOAD_FOLDER, UPLOAD_SESSIONS.max_age)
+        for relative_path, is_dir, size, mtime in walk_directory(UPLOAD_FOLDER):
+            if is_dir:
+                remove_stale_uploads(os.path.join(UPLOAD_FOLDER, relative_path), UPLOAD_SESSIONS.max_age)
+    except Exception as e:
+        print(f'Upload cleanup error: {e}')
+    while True:
+        try:
+            expire_uploads()
+        except Exception as e:
+            print(f'Upload cleanup error: {e}')
+        time.sleep(UPLOAD_EXPIRE_INTERVAL)
+
+
+def record_content(file_path, file_size):
+    """Hash an uploaded file in the background so later uploads of it are deduplicated."""
+    if DEDUP_METHODS and file_size >= DEDUP_MIN_SIZE:
+        CONTENT_INDEX.queue(file_path)
+
+
+def hash_same_size(file_size):
+    """
+    Hash a few files with the size of an upload whose content wasn't found, to
+    deduplicate the next upload of files that weren't uploaded through the server.
+    They are looked up and hashed in the background.
+    """
+    def candidates():
+        entries, _ = SEARCH_INDEX.search(kind='file', min_size=file_size, max_size=file_size, limit=DEDUP_CANDIDATES)
+        return [os.path.join(UPLOAD_FOLDER, entry['path']) for entry in entries]
+    CONTENT_INDEX.queue(candidates)
+
+
+@app.route('/upload/chunk', methods=['POST'])
+def upload_chunk():
+    """
+    Write one or more consecutive chunks of an upload session at their offset.
+
+    The form fields are 'session', 'chunk' (the chunk index), 'count' (the number of
+    consecutive chunks sent, 1 by default), 'file' and optionally 'checksum' of the
+    sent data in the format 'algorithm=hex' where the algorithm is crc32, sha256 or
+    when installed on the server crc32c or xxh64.
+
+    :return: A json with the code 'SUCCESS' once every chunk is received or 'CONTINUE'.
+    """
+    session_id = request.form.get('session')
+    session = get_upload_session(session_id)
+    if session is None:
+        return {'message': 'Upload session not found', 'code': 'SESSION_NOT_FOUND'}, 404
+
+    try:
+        chunk_index = int(request.form.get('chunk'))
+    except (ValueError, TypeError):
+        return {'message': 'Invalid chunk index'}, 400
+    try:
+        count = int(request.form.get('count', 1))
+    except (ValueError, TypeError):
+        return {'message': 'Invalid chunk count'}, 400
+    if not 0 <= chunk_index < chunk_index + count <= session.total_chunks:
+        return {'message': 'Invalid chunk index'}, 400
+    if session.chunk_length(chunk_index, count) > UPLOAD_MAX_CHUNK_SIZE:
+        return {'message': 'Chunk is larger than the maximum chunk size', 'code': 'CHUNK_TOO_LARGE'}, 400
+
+    checksum = chunk_checksum(request.form.get('checksum'))
+    if checksum is None:
+        return {'message': 'Unsupported checksum'}, 400
+    hasher, expected = checksum
+
+    if 'file' not in request.files:
+        return {'message': 'No file part'}, 400
+    file_content = request.files['file'].read()
+    if len(file_content) != session.chunk_length(chunk_index, count):
+        return {'message': 'Chunk is likely corruputed', 'code': 'CORRUPTED'}, 400
+
+    if hasher is not None:
+        # the data is in memory so it can be verified before writing it
+        hasher.update(file_content)
+        if hasher.hexdigest() != expected:
+            return {'message': 'Chunk checksum mismatch', 'code': 'CORRUPTED'}, 400
+        hasher = None
+
+    try:
+        crcs = session.write_chunk(chunk_index, file_content, count)
+    except FileNotFoundError:
+        # the upload was restarted or finished by another session
+        return {'message': 'Upload session not found', 'code': 'SESSION_NOT_FOUND'}, 404
+
+    return finish_chunk(session_id, session, chunk_index, crcs, hasher, expected)
+
+
+@app.route('/upload/chunk', methods=['PUT'])
+def upload_chunk_stream():
+    """
+    Write one or more consecutive chunks of an upload session sent as the raw request
+    body (application/octet-stream). The body is streamed to disk so each upload only
+    holds one buffer of UPLOAD_STREAM_BUFFER_SIZE bytes in memory, no matter the
+    chunk size.
+
+    The headers are 'X-Upload-Session', 'X-Upload-Chunk' (the chunk index),
+    'X-Upload-Count' (the number of consecutive chunks sent, 1 by default) and
+    optionally 'X-Chunk-Checksum' in the same format as the 'checksum' field of the
+    form upload. A chunk failing its checksum is written but stays missing.
+    'X-Upload-Checksum: crc32' returns the crc32 of the written data.
+
+    :return: A json with the code 'SUCCESS' once every chunk is received or
+    'CONTINUE', and the 'checksum' if requested.
+    """
+    session_id = request.headers.get('X-Upload-Session')
+    session = get_upload_session(session_id)
+    if session is None:
+        return {'message': 'Upload session not found', 'code': 'SESSION_NOT_FOUND'}, 404
+
+    try:
+        chunk_index = int(request.headers.get('X-Upload-Chunk'))
+        count = int(request.headers.get('X-Upload-Count', 1))
+    except (ValueError, TypeError):
+        return {'message': 'Invalid chunk index'}, 400
+    if not 0 <= chunk_index < chunk_index + count <= session.total_chunks:
+        return {'message': 'Invalid chunk index'}, 400
+    length = session.chunk_length(chunk_index, count)
+    if length > UPLOAD_MAX_CHUNK_SIZE:
+        return {'message': 'Chunk is larger than the maximum chunk size', 'code': 'CHUNK_TOO_LARGE'}, 400
+    if request.content_length != length:
+        return {'message': 'Chunk is likely corruputed', 'code': 'CORRUPTED'}, 400
+
+    report_checksum = request.headers.get('X-Upload-Checksum')
+    if report_checksum not in (None, 'crc32'):
+        return {'message': 'Unsupported checksum'}, 400
+    checksum = chunk_checksum(request.headers.get('X-Chunk-Checksum'))
+    if checksum is None:
+        return {'message': 'Unsupported checksum'}, 400
+    hasher, expected = checksum
+
+    try:
+        crcs = session.write_stream(chunk_index, count, request.stream, UPLOAD_STREAM_BUFFER_SIZE, hasher)
+    except FileNotFoundError:
+        # the upload was restarted or finished by another session
+        return {'message': 'Upload session not found', 'code': 'SESSION_NOT_FOUND'}, 404
+    except EOFError:
+        return {'message': 'Chunk is likely corruputed', 'code': 'CORRUPTED'}, 400
+
+    response, status = finish_chunk(session_id, session, chunk_index, crcs, hasher, expected)
+    if report_checksum and status == 200:
+        response['checksum'] = format_digest(combine_chunk_crcs(crcs, session.chunk_size, length))
+    return response, status
+
+
+@app.route('/upload/batch', methods=['PUT'])
+def upload_batch():
+    """
+    Upload many small files in one request sent as a tar stream (application/x-tar),
+    for example with `tar -c -C folder . | curl -T - <url>`. Files are written as
+    they arrive and moved into place together once the whole request is received.
+    Their paths are sanitized like the folder of the other uploads, and entries
+    other than regular files and directories are skipped.
+
+    The url arguments are 'folder', 'resume' and optionally 'checksum' of the whole
+    request body in the same format as the 'checksum' field of /upload/chunk. With
+    'resume=true', files already on the server with the same content are left as is.
+    The request is streamed to disk so it is only limited to upload_batch_max_size
+    bytes, not the size of a chunk.
+
+    :return: A json with the code 'SUCCESS', the number of 'written' and 'unchanged'
+    files, the names of the 'skipped' entries and the 'errors' of the entries that
+    couldn't be written, like a file in the way of a folder, as a list of 'name'
+    and 'message'.
+    """
+    request.max_content_length = UPLOAD_BATCH_MAX_SIZE
+    folder = os.path.normpath(request.args.get('folder', ''))
+    resume = request.args.get('resume', 'false') == 'true'
+    checksum = chunk_checksum(request.args.get('checksum'))
+    if checksum is None:
+        return {'message': 'Unsupported checksum'}, 400
+    hasher, expected = checksum
+
+    folder_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, folder))
+    created = set()
+
+    def destination(name, is_dir):
+        parent, filename = (name, '') if is_dir else os.path.split(os.path.normpath(name))
+        directory = os.path.join(folder_path, secure_folderpath(folder_path, os.path.normpath(parent or '.')))
+        if directory not in created:
+            makedirs(directory)
+            created.add(directory)
+        if is_dir:
+            return directory
+        filename = secure_filename(filename)
+        file_path = os.path.join(directory, filename)
+        # a folder in the way of a file is left as is
+        return file_path if filename and not os.path.isdir(file_path) else None
+
+    batch = UploadBatch(request.stream, UPLOAD_STREAM_BUFFER_SIZE, hasher)
+    try:
+        batch.extract(destination)
+    except (tarfile.TarError, EOFError):
+        return {'message': 'The request is not a valid tar stream', 'code': 'CORRUPTED'}, 400
+    if not batch.verify(expected):
+        batch.discard()
+        return {'message': 'Batch checksum mismatch', 'code': 'CORRUPTED'}, 400
+
+    def unchanged(part_path, path):
+        return os.path.isfile(path) and filecmp.cmp(part_path, path, shallow=False)
+
+    written, kept = batch.commit(unchanged if resume else None)
+    for path, size, crc in written:
+        path_updated(path)
+        DIGEST_INDEX.set(path, format_digest(crc))
+        record_content(path, size)
+    return {'message': 'Files uploaded successfully', 'code': 'SUCCESS', 'written': len(written),
+            'unchanged': kept, 'skipped': batch.skipped, 'errors': batch.errors}, 200
+
+
+def delta_file_path(values):
+    """
+    :param values: The form or url arguments of a delta upload with 'folder' and 'filename'.
+    :return: The path of the file being replaced or None if the file name is invalid.
+    """
+    filename = values.get('filename')
+    if not isinstance(filename, str) or not secure_filename(filename):
+        return None
+    folder = os.path.normpath(values.get('folder', ''))
+    folder_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, folder))
+    return os.path.join(folder_path, secure_filename(filename))
+
+
+def delta_upload(values):
+    """
+    Check the arguments shared by the requests of a delta upload.
+
+    :return: A tuple of the path of the file, the path it is built in, the os.stat_result
+    of the existing file and the new file size, or an error response.
+    """
+    file_path = delta_file_path(values)
+    if file_path is None:
+        return {'message': 'Invalid file name'}, 400
+    upload_id = values.get('upload', '')
+    if len(upload_id) != 16 or not all(c in '0123456789abcdef' for c in upload_id):
+        return {'message': 'Invalid upload id'}, 400
+    try:
+        file_size = int(values.get('fileSize'))
+        if file_size < 0:
+            return {'message': 'Invalid file size'}, 400
+    except (ValueError, TypeError):
+        return {'message': 'Invalid file size'}, 400
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        st = None
+    if st is None or values.get('basis') != f'{st.st_size}:{st.st_mtime_ns}':
+        try:
+            os.remove(delta_part_path(file_path, upload_id))
+        except OSError:
+            pass
+        return {'message': 'The file changed on the server, upload it again', 'code': 'BASIS_CHANGED'}, 409
+    return file_path, delta_part_path(file_path, upload_id), st, file_size
+
+
+@app.route('/upload/delta', methods=['POST'])
+def start_delta_upload():
+    """
+    Start uploading a new version of a file that exists on the server by sending only
+    what changed, like rsync.
+
+    The form fields are 'folder' and 'filename'. The response has the 'blockSize', the
+    'signatures' of the existing file as base64 of a little endian (adler32, crc32)
+    pair of uint32 for each full block, the 'basis' version of the file and an 'upload'
+    id. The client then sends the instructions building the new file with PUT
+    /upload/delta and finishes with /upload/delta/commit, passing 'folder', 'filename',
+    'upload', 'basis' and 'fileSize' to every request.
+
+    :return: A json with the code 'DELTA_STARTED', or 'NO_BASIS' with a 404 status
+    when the file doesn't exist and must be uploaded normally.
+    """
+    file_path = delta_file_path(request.form)
+    if file_path is None:
+        return {'message': 'Invalid file name'}, 400
+    if not os.path.isfile(file_path):
+        return {'message': 'The file is not on the server', 'code': 'NO_BASIS'}, 404
+    try:
+        size, st, signatures = DELTA_SIGNATURES.get(file_path)
+    except OSError as e:
+        print(f'Delta signature error: {e}')
+        return {'message': 'The file can not be read', 'code': 'NO_BASIS'}, 404
+    return {'message': 'Delta upload started', 'code': 'DELTA_STARTED', 'upload': secrets.token_hex(8),
+            'blockSize': size, 'basis': f'{st.st_size}:{st.st_mtime_ns}',
+            'signatures': base64.b64encode(signatures).decode()}, 200
+
+
+@app.route('/upload/delta', methods=['PUT'])
+def upload_delta():
+    """
+    Write part of a delta upload. The url arguments are those of /upload/delta and
+    'offset', the position in the new file of the first instruction. The body
+    (application/octet-stream) is a sequence of instructions, each a type byte then:
+    - 0: the uint32 index of a block of the existing file and the uint32 number of
+      consecutive blocks to copy from there.
+    - 1: a uint32 length then as many bytes to write.
+    Integers are little endian. Requests may be sent in parallel for different offsets
+    and are limited to 'maxChunkSize' bytes like a chunk.
+
+    :return: A json with the code 'CONTINUE' and the 'offset' after the instructions,
+    or 'BASIS_CHANGED' with a 409 status when the existing file was modified.
+    """
+    checked = delta_upload(request.args)
+    if not isinstance(checked[0], str):
+        return checked
+    file_path, part_path, st, file_size = checked
+    try:
+        offset = int(request.args.get('offset'))
+        if offset < 0:
+            return {'message': 'Invalid offset'}, 400
+    except (ValueError, TypeError):
+        return {'message': 'Invalid offset'}, 400
+    try:
+        end = write_delta(request.stream, file_path, part_path, offset, file_size,
+                          block_size(st.st_size), UPLOAD_STREAM_BUFFER_SIZE)
+    except (ValueError, struct.error):
+        return {'message': 'Invalid delta instructions', 'code': 'CORRUPTED'}, 400
+    except EOFError:
+        return {'message': 'Delta is likely corrupted', 'code': 'CORRUPTED'}, 400
+    return {'message': 'Delta received', 'code': 'CONTINUE', 'offset': end}, 200
+
+
+@app.route('/upload/delta/commit', methods=['POST'])
+def commit_delta_upload():
+    """
+    Replace the file with the one built by a delta upload once its 'checksum' is
+    verified. The form fields are those of /upload/delta and 'checksum' of the whole
+    new file as 'sha256=<hex>'. The file is swapped in atomically and keeps the
+    permissions of the one it replaces.
+
+    :return: A json with the code 'SUCCESS' and the 'digest' of the file, or
+    'CORRUPTED' in which case the file should be uploaded normally.
+    """
+    checked = delta_upload(request.form)
+    if not isinstance(checked[0], str):
+        return checked
+    file_path, part_path, st, file_size = checked
+    parsed = parse_checksum(request.form.get('checksum'))
+    if parsed is None or parsed[0] != 'sha256':
+        # the blocks were matched with crc32, the whole file needs a stronger hash
+        return {'message': 'Unsupported checksum'}, 400
+    try:
+        with open(part_path, 'ab') as f:
+            f.truncate(file_size)
+        # the copied blocks never went through the server, so the whole file is read back
+        crc, sha256 = file_checksums(part_path)
+        if sha256 != parsed[1]:
+            os.remove(part_path)
+            return {'message': 'Checksum mismatch, upload the whole file', 'code': 'CORRUPTED'}, 400
+        os.chmod(part_path, stat.S_IMODE(st.st_mode))
+        os.replace(part_path, file_path)
+    except OSError as e:
+        print(f'Delta commit error: {e}')
+        return {'message': 'An unexpected error occurred'}, 405
+    path_updated(file_path)
+    DIGEST_INDEX.set(file_path, format_digest(crc))
+    try:
+        CONTENT_INDEX.add(file_path, os.stat(file_path), sha256)
+    except OSError:
+        pass
+    return {'message': 'File uploaded successfully', 'code': 'SUCCESS', 'digest': format_digest(crc)}, 200
+
 
 @app.route('/download/<path:inputPath>', methods=['GET'])
 def download_file(inputPath):
-    """Handle file downloads."""
-    return send_from_directory(UPLOAD_FOLDER, inputPath, as_attachment=False)
+    """
+    Handle file downloads with support for Range and conditional requests.
+
+    The digest of the file is sent in the 'X-File-Digest' header when it is known,
+    or always when the request has a 'Want-Digest' header. A HEAD request with
+    'Want-Digest' lets clients skip downloading files they already have.
+    """
+    file_path = safe_join(UPLOAD_FOLDER, inputPath)
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+    response = serve_file(request, file_path)
+    digest = DIGEST_INDEX.get(file_path, compute='Want-Digest' in request.headers)
+    if digest is not None:
+        response.headers['X-File-Digest'] = digest
+    return response
+
+
+@app.route('/thumb/<path:inputPath>', methods=['GET'])
+def thumbnail(inputPath):
+    """
+    Send a downscaled jpeg of an image, or of a frame of a video when ffmpeg is
+    installed. Thumbnails are made by a pool of processes and cached on disk.
+
+    The url arguments are:
+    - 'size': The maximum width and height in pixels, rounded up to 128, 256, 512
+      or 1024. 256 by default.
+    - 'v': Any value that changes with the file like its mtime. The browser then
+      keeps the thumbnail without checking if it changed.
+
+    :return: The jpeg, a json with the code 'PENDING', a 202 status and a Retry-After
+    header while it is being made, or a json error with the code 'BUSY' and a
+    Retry-After header when too many thumbnails are being made.
+    """
+    if THUMBNAILER is None:
+        return {'message': 'Thumbnails need the Pillow package'}, 501
+    try:
+        size = thumbnail_size(int(request.args.get('size', 256)))
+    except ValueError:
+        return {'message': 'Invalid size'}, 400
+    file_path = safe_join(UPLOAD_FOLDER, inputPath)
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+    if not can_thumbnail(file_path):
+        return {'message': 'No thumbnail can be made of this file'}, 415
+    try:
+        cached = THUMBNAILER.get(file_path, size)
+    except Pending:
+        return ({'message': 'The thumbnail is being made', 'code': 'PENDING'}, 202,
+                {'Retry-After': '1', 'Cache-Control': 'no-store'})
+    except Busy:
+        return {'message': 'Too many thumbnails are being made', 'code': 'BUSY'}, 503, {'Retry-After': '1'}
+    if cached is None:
+        return {'message': 'No thumbnail can be made of this file'}, 415
+    response = serve_file(request, cached)
+    if 'v' in request.args:
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/thumb', methods=['POST'])
+def warm_thumbnails():
+    """
+    Make the thumbnails of the files of a folder in the background, for example
+    when it is opened, so they are ready when they are shown.
+
+    The form fields are 'folder' and optionally 'size' like for /thumb.
+    """
+    if THUMBNAILER is None:
+        return {'message': 'Thumbnails need the Pillow package'}, 501
+    try:
+        size = thumbnail_size(int(request.form.get('size', 256)))
+    except ValueError:
+        return {'message': 'Invalid size'}, 400
+    folder = os.path.normpath(request.form.get('folder', ''))
+    folder_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, folder))
+    if not os.path.isdir(folder_path):
+        return {'message': 'Folder not found'}, 404
+
+    paths = [os.path.join(folder_path, name) for name, is_dir, _, _ in METADATA_CACHE.scan(folder_path)
+             if not is_dir and can_thumbnail(name)]
+    THUMBNAILER.warm(paths, size)
+    return {'message': f'Making {len(paths)} thumbnails'}, 200
 
 
 @app.route('/zip/', defaults={'inputPath': ''}, methods=['GET'])
 @app.route('/zip/<path:inputPath>', methods=['GET'])
 def download_zip(inputPath):
-    """Download an entire directory by downloading a zip file on the fly"""
+    """
+    Download an entire directory by downloading a zip file on the fly.
+
+    With the 'store' argument set to true, files are not compressed and the layout
+    of the archive is computed before sending it. The download then has a length
+    and supports byte ranges so it can be resumed. See download_zip_layout().
+    """
     folder_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER,os.path.normpath(inputPath)))
-    seen_links = set()
-    if not os.path.exists(folder_path):
-        return {'message', 'Path not found'}, 404
-    if os.path.isfile(folder_path):
-        paths = [{'fs': folder_path, 'n': os.path.basename(folder_path)}]
-    elif os.path.isdir(folder_path):
-        paths = []
-        for root, dirs, files in os.walk(folder_path, followlinks=True):
-            for file in files:
-                file_path = os.path.join(root, file)
-                paths.append({
-                    'fs': file_path,
-                    'n': os.path.relpath(file_path, folder_path)
-                })
-            for dir in dirs:
-                if os.path.islink(dir):
-                    if dir in seen_links:
-                        break
-                seen_links.add(dir)
-            else:
-                continue
-            break
+    item = path_metadata(folder_path)
+    if item is None:
+        return {'message': 'Path not found'}, 404
+    if request.args.get('store') == 'true':
+        return download_zip_layout(folder_path, item[1])
+    if not item[1]:
+        entries = [(folder_path, os.path.basename(folder_path), item[2], item[3])]
     else:
-        return {'message': 'Path is not directory or file.'}, 404
+        # a generator so the archive starts streaming while the tree is still walked
+        entries = ((os.path.join(folder_path, relative_path), relative_path, size, mtime)
+                   for relative_path, is_dir, size, mtime in walk_directory(folder_path, METADATA_CACHE.scan)
+                   if not is_dir)
 
-
-    zfly = zipfly.ZipFly( paths=paths )
-
-    z = zfly.generator()
+    z = track_archive(ZipStream(entries, compresslevel=ZIP_COMPRESS_LEVEL, threads=ZIP_THREADS).generator(), 'zip')
 
     response = Response(z, mimetype='application/zip')
     response.headers['Content-Disposition'] = 'attachment; filename=archive.zip'
     return response
 
 
+
+def download_zip_layout(folder_path, is_dir):
+    """
+    Send a store only zip whose layout is computed from an os.stat of every file.
+
+    :param folder_path: The absolute path of the directory or file to zip.
+    :param is_dir: If folder_path is a directory.
+    :return: A flask response.
+    """
+    if not is_dir:
+        paths = [(folder_path, os.path.basename(folder_path))]
+    else:
+        paths = [(os.path.join(folder_path, relative_path), relative_path)
+                 for relative_path, is_dir, size, mtime in walk_directory(folder_path, METADATA_CACHE.scan)
+                 if not is_dir]
+    entries = []
+    for path, name in paths:
+        try:
+            entries.append((path, name, os.stat(path)))
+        except OSError:
+            continue # removed while walking
+    layout = ZipLayout(entries, DIGEST_INDEX)
+    read = lambda start, stop: track_archive(layout.read(start, stop), 'zip')
+    return serve_content(request, layout.size, layout.etag, layout.mtime, read, 'application/zip',
+                         {'Content-Disposition': 'attachment; filename=archive.zip'})
+
+
+@app.route('/tar/', defaults={'inputPath': ''}, methods=['GET'])
+@app.route('/tar/<path:inputPath>', methods=['GET'])
+def download_tar(inputPath):
+    """
+    Download an entire directory as a tar archive streamed on the fly. The
+    'compression' argument can be gzip or zstd to compress the archive.
+    """
+    folder_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER,os.path.normpath(inputPath)))
+    item = path_metadata(folder_path)
+    if item is None:
+        return {'message': 'Path not found'}, 404
+    compression = request.args.get('compression') or None
+    if compression not in available_compressions():
+        return {'message': f'Unsupported compression {compression}', 'code': 'UNSUPPORTED_COMPRESSION'}, 400
+    if not item[1]:
+        entries = [(folder_path, os.path.basename(folder_path), False)]
+    else:
+        entries = ((os.path.join(folder_path, relative_path), relative_path, is_dir)
+                   for relative_path, is_dir, size, mtime in walk_directory(folder_path, METADATA_CACHE.scan))
+
+    t = track_archive(TarStream(entries, compression, level=TAR_COMPRESS_LEVEL, threads=TAR_THREADS).generator(), 'tar')
+
+    mimetype, extension = COMPRESSIONS[compression]
+    response = Response(t, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=archive.{extension}'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Report the metrics of every worker in the prometheus text format.
+    """
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/files', methods=['GET'])
 def list_files():
     """
@@ -247,10 +1312,21 @@ def list_files():
     - 'files': An array of relative paths to the files found
     - 'folders': An array of relative paths to the subdirectories found
 
+    When the 'lazy' argument is true, only one page of the directory is listed
+    instead. See list_files_lazy().
+
+    When the 'compact' argument is true, paths are not repeated:
+    - 'folders': An array of [parent, name] where parent is the index of the parent
+      folder in this array or -1 for the listed folder
+    - 'files': An array of [parent, name, name, ...] listing the files of each
+      folder with the same parent indexes
+
     :return: A json with keys 'files' and 'folders'.
     """
+    if request.args.get('lazy', 'false') == 'true':
+        return list_files_lazy()
+
     folder = os.path.normpath(request.args.get('folder', ''))
-    seen_links = set() # to detect symlink loops.
     file_list = []
     folder_list = []
     if folder:
@@ -260,86 +1336,337 @@ def list_files():
         # List all files in the upload directory if no folder is specified
         folder_path = UPLOAD_FOLDER
 
-    if os.path.exists(folder_path):
+    compact = request.args.get('compact', 'false') == 'true'
+    folder_indexes = {'': -1}
+    folder_files = {} # parent index -> [parent, name, ...] of the compact form
+    if os.path.isdir(folder_path):
         # we use symbolic links to link multiple folder paths
-        for root, dirs, files in os.walk(folder_path,followlinks=True):
-            for file in files:
-                relative_path = os.path.relpath(os.path.join(root, file), folder_path)
-                file_list.append(relative_path)
-            for dir in dirs:
-                if os.path.islink(dir):
-                    if dir in seen_links:
-                        break
-                    seen_links.add(dir)
-
-                relative_path = os.path.relpath(os.path.join(root, dir), folder_path)
-                folder_list.append(relative_path)
+        for relative_path, is_dir, size, mtime in walk_directory(folder_path, METADATA_CACHE.scan):
+            if not compact:
+                (folder_list if is_dir else file_list).append(relative_path)
+                continue
+            # folders are walked before their content
+            parent, _, name = relative_path.rpartition('/')
+            parent = folder_indexes[parent]
+            if is_dir:
+                folder_indexes[relative_path] = len(folder_list)
+                folder_list.append([parent, name])
             else:
-                continue # if the inner loop didn't break, continue
-            break
+                folder_files.setdefault(parent, [parent]).append(name)
 
+    if compact:
+        file_list = list(folder_files.values())
     return {'files': file_list, 'folders': folder_list}
 
 
+def list_files_lazy():
+    """
+    List a directory one level (or a few levels with 'depth') at a time.
+
+    The url arguments are:
+    - 'folder': The directory relative to the upload folder.
+    - 'depth': How many levels to descend, 1 by default.
+    - 'cursor': The 'cursor' value from the previous page.
+    - 'limit': The number of entries per page.
+
+    The function returns a json containing:
+    - 'entries': An array of {'name', 'path', 'type', 'size', 'mtime'} where path
+      is relative to the folder and type is either 'file' or 'folder'. Files also
+      have a 'digest' (like 'crc32:1a2b3c4d') when the server already knows it and
+      'thumbnail' set to true when /thumb can make a preview of them.
+    - 'cursor': The cursor to get the next page or null on the last page.
+
+    :return: A json with keys 'entries' and 'cursor'.
+    """
+    folder = os.path.normpath(request.args.get('folder', ''))
+    cursor = request.args.get('cursor', '')
+    try:
+        depth = int(request.args.get('depth', 1))
+        limit = int(request.args.get('limit', LISTING_PAGE_SIZE))
+    except ValueError:
+        return {'message': 'Invalid depth or limit'}, 400
+    if depth < 1 or limit < 1:
+        return {'message': 'Invalid depth or limit'}, 400
+    limit = min(limit, LISTING_PAGE_SIZE)
+
+    folder_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, folder))
+    if not os.path.isdir(folder_path):
+        return {'message': 'Folder not found'}, 404
+
+    entries, next_cursor = list_directory(folder_path, depth, cursor, limit, METADATA_CACHE.scan)
+    for entry in entries:
+        if entry['type'] == 'file':
+            annotate_file(os.path.join(folder_path, entry['path']), entry)
+    return {'entries': entries, 'cursor': next_cursor}
+
+
+@app.route('/events', methods=['GET'])
+def events():
+    """
+    A stream of server sent events (text/event-stream) with the changes to the
+    served files, made through the server or by other programs in the folders
+    being listed, so clients can patch their listings instead of reloading them.
+
+    Changes are coalesced over a short window and sent as 'change' events whose id
+    is the number of the batch and whose data is a json array of records with a
+    path relative to the upload folder:
+    - {'type': 'changed', 'path', 'entry'}: The path was created or modified, entry
+      is like in /files?lazy=true without its path.
+    - {'type': 'moved', 'path', 'from', 'entry'}: The path was moved from another.
+    - {'type': 'deleted', 'path'}: The path and everything under it was deleted.
+    - {'type': 'reset'}: Changes were lost, every listing should be reloaded.
+
+    The stream starts with a 'ready' event with the id of the last batch. It
+    continues after the 'Last-Event-ID' header sent by EventSource when it
+    reconnects, or the 'since' url argument. A 'reset' event is sent instead when
+    the batches after it were forgotten.
+
+    With gunicorn threads, a stream holds a thread so it ends after a while and the
+    browser reconnects, and streams past events_max_streams end right away, which
+    makes their clients poll. In asgi mode streams don't hold a thread.
+    """
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('since') or CHANGE_FEED.current())
+    except ValueError:
+        return {'message': 'Invalid event id'}, 400
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if ASYNC_BODY in request.environ:
+        request.environ[ASYNC_BODY] = event_stream_async(after)
+        return Response(iter(()), mimetype='text/event-stream', headers=headers)
+    return Response(event_stream(after), mimetype='text/event-stream', headers=headers)
+
+
+def format_events(after, batches):
+    """
+    :param after: The id of the last batch sent.
+    :param batches: The batches from CHANGE_FEED.changes().
+    :return: A tuple of the server sent events of the batches, or of a reset if
+    batches is None, and the id of the last batch sent.
+    """
+    if batches is None:
+        after = CHANGE_FEED.current()
+        return f'id: {after}\nevent: reset\ndata: {{}}\n\n', after
+    text = ''.join(f'id: {batch_id}\nevent: change\ndata: {records}\n\n' for batch_id, records in batches)
+    return text, batches[-1][0] if batches else after
+
+
+def event_stream(after):
+    """
+    Send the changes after a batch for EVENTS_HOLD seconds, or only the ones
+    already known when EVENTS_MAX_STREAMS streams already hold a thread.
+    """
+    held = EVENT_STREAMS.acquire(blocking=False)
+    try:
+        yield f'retry: {EVENTS_RETRY}\nid: {after}\nevent: ready\ndata: {{}}\n\n'
+        deadline = time.monotonic() + (EVENTS_HOLD if held else 0)
+        while True:
+            text, after = format_events(after, CHANGE_FEED.changes(after))
+            if text:
+                yield text
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not CHANGE_FEED.wait(after, min(remaining, EVENTS_HEARTBEAT)):
+                yield ': keep alive\n\n'
+    finally:
+        if held:
+            EVENT_STREAMS.release()
+
+
+async def event_stream_async(after):
+    """event_stream() sent by the event loop of the asgi bridge for as long as the client is connected."""
+    loop = asyncio.get_running_loop()
+    yield f'retry: {EVENTS_RETRY}\nid: {after}\nevent: ready\ndata: {{}}\n\n'.encode()
+    while True:
+        text, after = format_events(after, await loop.run_in_executor(None, CHANGE_FEED.changes, after))
+        if text:
+            yield text.encode()
+        if not await CHANGE_FEED.wait_async(after, EVENTS_HEARTBEAT):
+            yield b': keep alive\n\n'
+
+
+@app.route('/search', methods=['GET'])
+def search():
+    """
+    Search the names of everything under a folder with an index kept in memory.
+
+    The url arguments are all optional and every one given must match:
+    - 'q': A case insensitive substring of the name.
+    - 'glob': A case insensitive glob of the whole name like '*.jp?g'.
+    - 'ext': Comma separated extensions like 'jpg,png'.
+    - 'type': 'file' or 'folder'.
+    - 'minSize', 'maxSize': The size range of files in bytes.
+    - 'after', 'before': The mtime range as unix timestamps.
+    - 'folder': The directory relative to the upload folder to search in.
+    - 'cursor': The 'cursor' value from the previous page.
+    - 'limit': The number of entries per page.
+
+    :return: A json with 'entries' in the same format as /files?lazy=true except
+    that paths are relative to the upload folder, the 'cursor' of the next page or
+    null, and 'complete' which is false while the index is still being built.
+    """
+    try:
+        numbers = {key: float(request.args[key]) if request.args.get(key) else None
+                   for key in ('minSize', 'maxSize', 'after', 'before')}
+        limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+    except ValueError:
+        return {'message': 'Invalid number'}, 400
+    if limit < 1:
+        return {'message': 'Invalid limit'}, 400
+    kind = request.args.get('type') or None
+    if kind not in (None, 'file', 'folder'):
+        return {'message': 'Invalid type'}, 400
+    query = request.args.get('q', '')
+    glob = request.args.get('glob') or None
+    if '\n' in query or (glob and '\n' in glob):
+        return {'message': 'Invalid query'}, 400
+    folder = os.path.normpath(request.args.get('folder', ''))
+    if folder == '.':
+        folder = ''
+    elif not safe_join(UPLOAD_FOLDER, folder):
+        return {'message': 'Folder not found'}, 404
+
+    try:
+        entries, cursor = SEARCH_INDEX.search(
+            query, glob, [e for e in request.args.get('ext', '').split(',') if e], kind,
+            numbers['minSize'], numbers['maxSize'], numbers['after'], numbers['before'],
+            folder.replace(os.sep, '/'), request.args.get('cursor'), min(limit, LISTING_PAGE_SIZE))
+    except ValueError:
+        return {'message': 'The search index was rebuilt, search again', 'code': 'CURSOR_EXPIRED'}, 409
+    return {'entries': entries, 'cursor': cursor, 'complete': SEARCH_INDEX.complete}
+
+
 @app.route('/delete', methods=['POST'])
 def delete_item():
     """
-    Deletes a file/directory
+    Deletes files/directories. The form can have several 'path' fields to delete
+    them all in one job, see job_response().
 
     :return: A json response with a message if the operation was successful or not.
     """
-    inputPath = os.path.normpath(request.form.get('path',''))
+    paths = []
+    for inputPath in request.form.getlist('path') or ['']:
+        inputPath = os.path.normpath(inputPath)
+        if not inputPath or inputPath == '.':
+            return {'message': 'Invalid path. Do not delete root.'}, 400
 
-    if not isinstance(inputPath, str) or not inputPath:
-        return {'message': 'Invalid path. Do not delete root.'}, 400
+        file_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, inputPath))
 
-    file_path = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, inputPath))
+        if file_path == UPLOAD_FOLDER:
+            return {'message': 'You cannot delete the root directory.'}, 400
+        if not os.path.lexists(file_path):
+            return {'message': 'File/folder not found'}, 404
+        paths.append(file_path)
+
+    return job_response(FILE_JOBS.start('delete', paths), 'Deleted')
+
+
+def transfer_items(operation):
+    """
+    Resolve the 'sourcePath' fields and the 'destinationPath' of a move or copy
+    like shutil.move: a source goes inside the destination if it is a directory,
+    otherwise it becomes the destination.
+
+    :return: A list of (source, destination) tuples or an error response.
+    """
+    sourcePaths = request.form.getlist('sourcePath') or ['']
+    destinationPath = os.path.normpath(request.form.get('destinationPath', ''))
+    if destinationPath == '.':
+        # assume user wants to move to root folder
+        destinationPath = ''
+    destinationPath = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, destinationPath))
+    into_folder = os.path.isdir(destinationPath)
+    if len(sourcePaths) > 1 and not into_folder:
+        return {'message': f'The destination must be a folder to {operation} several paths'}, 400
+
+    items = []
+    for sourcePath in sourcePaths:
+        sourcePath = os.path.normpath(sourcePath)
+        if not sourcePath or sourcePath == '.':
+            return {'message': 'Invalid path'}, 400
+        sourcePath = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, sourcePath))
+        if sourcePath == UPLOAD_FOLDER or not os.path.lexists(sourcePath):
+            return {'message': 'File/folder not found'}, 404
+        finalPath = os.path.join(destinationPath, os.path.basename(sourcePath)) if into_folder else destinationPath
+        if finalPath != sourcePath and (finalPath + os.sep).startswith(sourcePath + os.sep):
+            return {'message': f'Cannot {operation} a folder into itself'}, 400
+        items.append((sourcePath, finalPath))
+    return items
 
-    if file_path == UPLOAD_FOLDER:
-        return {'message': 'You cannot delete the root directory.'}, 400
-    if not os.path.exists(file_path):
-        return {'message': 'File/folder not found'}, 404
-    if os.path.isfile(file_path):
-        os.remove(file_path)
-    elif os.path.isdir(file_path):
-        try:
-            shutil.rmtree(file_path)
-        except Exception as e:
-            print(f'Delete error: {e}')
-            return {'message': 'An unexpected error occurred'}, 405
-        
-    return {'message': 'Deleted'}, 200
 
 @app.route('/move', methods=['POST'])
 def move_item():
     """
-    Move a file/directory
+    Move files/directories. The form can have several 'sourcePath' fields to move
+    them all into the 'destinationPath' folder in one job, see job_response().
 
     :return: A json response with a message if the operation was successful or not.
     """
-    sourcePath = os.path.normpath(request.form.get('sourcePath',''));
-    destinationPath = os.path.normpath(request.form.get('destinationPath'));
+    items = transfer_items('move')
+    if isinstance(items, tuple):
+        return items
+    return job_response(FILE_JOBS.start('move', items), 'Moved')
 
-    if not isinstance(sourcePath, str) or not sourcePath:
-        return {'message': 'Invalid path'}, 400
-    if not isinstance(destinationPath, str) or not destinationPath:
-        # assume user wants to move to root folder
-        destinationPath = ''
 
-    sourcePath = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, sourcePath))
-    destinationPath = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, destinationPath))
+@app.route('/copy', methods=['POST'])
+def copy_item():
+    """
+    Copy files/directories, with the same form as /move. An existing destination
+    is never replaced.
 
-    if not os.path.exists(sourcePath):
-        return {'message': 'File/folder not found'}, 404
+    :return: A json response with a message if the operation was successful or not.
+    """
+    items = transfer_items('copy')
+    if isinstance(items, tuple):
+        return items
+    return job_response(FILE_JOBS.start('copy', items), 'Copied')
+
+
+def job_response(job_id, message):
+    """
+    Wait a little for a job to finish, so quick operations are answered like any
+    other request.
+
+    :param job_id: The id of the job.
+    :param message: The message when the job succeeded.
+    :return: A json response with the message, or the errors of the job with a 400
+    status, or a 202 status with the job from /jobs/<job_id> when it is still running.
+    """
+    job = FILE_JOBS.wait(job_id, JOB_WAIT)
+    if job['state'] == 'done' and not job['errors']:
+        return {'message': message}, 200
+    if job['state'] == 'done':
+        return {'message': job['errors'][0]['message'], 'errors': job['errors']}, 400
+    return {'message': 'Started', 'code': 'JOB_STARTED', 'job': job}, 202
 
-    try:
-        shutil.move(sourcePath, destinationPath)
-        return {'message': 'Moved'}, 200
-    except FileNotFoundError:
-        return {'message': 'Path does not exist. Check if you enter the correct path'}, 400
-    except Exception as e:
-        print(f'Move error: {e}')
-        return {'message': 'An unexpected error occurred'}, 405
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    The progress of a delete, move or copy still running when its request was answered.
+
+    :return: A json response with the 'state' of the job: 'queued', 'running', 'done',
+    'cancelled' or 'interrupted' if the server stopped, the number of 'files' and 'bytes'
+    to process and how many are done in 'filesDone' and 'bytesDone', the 'current'
+    path and the 'errors' of the paths that failed.
+    """
+    job = FILE_JOBS.get(job_id)
+    if job is None:
+        return {'message': 'Job not found'}, 404
+    return job
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """
+    Cancel a job. Files already deleted stay deleted, a move or copy removes what it
+    copied so far.
+
+    :return: A json response with a message if the job was cancelled.
+    """
+    if not FILE_JOBS.cancel(job_id):
+        return {'message': 'The job is not running'}, 400
+    return {'message': 'Cancelling'}, 200
 
 
 @app.route('/newfile', methods=['POST'])
@@ -358,9 +1685,10 @@ def new_file():
     directory = secure_folderpath(UPLOAD_FOLDER,os.path.dirname(filename))
 
     try:
-        os.makedirs(directory,exist_ok=True)
+        makedirs(directory)
         with open(filename, 'x') as file:
             pass
+        path_updated(filename)
         return {'message': 'File created'}, 200
     except FileExistsError:
         return {'message': 'The path you gave already exists.'}, 400
@@ -384,7 +1712,7 @@ def new_folder():
     foldername = os.path.join(UPLOAD_FOLDER, secure_folderpath(UPLOAD_FOLDER, inputFoldername))
 
     try:
-        os.makedirs(foldername,exist_ok=True)
+        makedirs(foldername)
         return {'message': 'Folder created'}, 200
     except FileExistsError:
         return {'message': 'The path you gave already exists.'}, 400
@@ -396,14 +1724,101 @@ def new_folder():
 # setup some global variables and configurations for ease of use.
 TOKEN = qrFileServerConfig.token
 USERS = qrFileServerConfig.users 
+SESSION_COOKIE = 'qrFileServerSession'
+SESSIONS = SessionSigner(TOKEN, getattr(qrFileServerConfig, 'session_max_age', 7*24*3600))
 URLS = qrFileServerConfig.urls
 TEMPDIR = tempfile.mkdtemp()
 UPLOAD_FOLDER = setup_upload_paths(os.getenv('QR_FILE_SERVER_INPUT'))
 READONLY = qrFileServerConfig.readonly
-EXPECTED_CHUNK_SIZE = 1000*500 # if you want to change this, the js file needs changing also
-
-#flask writes temp files to disk when upload size are over 500KiB so this should cap it.
-app.config['MAX_CONTENT_LENGTH'] = 1024*500 
+EXPECTED_CHUNK_SIZE = 1000*500 # the chunk size of the deprecated /upload endpoint
+UPLOAD_MIN_CHUNK_SIZE = getattr(qrFileServerConfig, 'upload_min_chunk_size', 256*1024)
+UPLOAD_MAX_CHUNK_SIZE = getattr(qrFileServerConfig, 'upload_max_chunk_size', 16*1024*1024)
+UPLOAD_DEFAULT_CHUNK_SIZE = getattr(qrFileServerConfig, 'upload_default_chunk_size', 1024*1024)
+UPLOAD_STREAM_BUFFER_SIZE = getattr(qrFileServerConfig, 'upload_stream_buffer_size', 64*1024)
+UPLOAD_BATCH_MAX_FILE_SIZE = getattr(qrFileServerConfig, 'upload_batch_max_file_size', 256*1024)
+UPLOAD_BATCH_MAX_SIZE = getattr(qrFileServerConfig, 'upload_batch_max_size', 4*1024*1024*1024)
+DELTA_MIN_SIZE = getattr(qrFileServerConfig, 'delta_min_size', 1024*1024)
+DELTA_SIGNATURES = SignatureCache(getattr(qrFileServerConfig, 'delta_threads', os.cpu_count() or 1),
+                                  getattr(qrFileServerConfig, 'delta_cache_max_memory', 64*1024*1024))
+# shared by all workers, the gunicorn master sets QR_FILE_SERVER_STATE to a directory they all see
+UPLOAD_SESSIONS = SessionStore(os.path.join(os.getenv('QR_FILE_SERVER_STATE') or TEMPDIR, 'sessions.sqlite3'))
+UPLOAD_EXPIRE_INTERVAL = 3600 # seconds between removing the files of expired upload sessions
+threading.Thread(target=clean_uploads, name='upload-cleanup', daemon=True).start()
+DIGEST_INDEX = DigestIndex()
+# each worker has its own pool of processes, the cache on disk is shared by the workers
+THUMBNAILER = Thumbnailer(getattr(qrFileServerConfig, 'thumbnail_cache_path', None) or os.path.join(
+    os.getenv('QR_FILE_SERVER_STATE') or TEMPDIR, 'thumbnails'),
+    getattr(qrFileServerConfig, 'thumbnail_cache_max_size', 1024*1024*1024),
+    getattr(qrFileServerConfig, 'thumbnail_processes', 2)) if Image is not None else None
+RESPONSE_ENCODINGS = available_encodings(getattr(qrFileServerConfig, 'response_compression', ('zstd', 'br', 'gzip')))
+COMPRESS_MIN_SIZE = 1024 # smaller responses fit in a packet or two anyway
+COMPRESS_CACHE_ENTRY_SIZE = 1024*1024 # bigger files are compressed as they are sent
+COMPRESSED_CACHE = CompressedCache(getattr(qrFileServerConfig, 'compression_cache_max_memory', 16*1024*1024))
+DEDUP_METHODS = tuple(getattr(qrFileServerConfig, 'dedup_methods', ()))
+for method in DEDUP_METHODS:
+    if method not in (*CLONE_METHODS, 'copy'):
+        raise ValueError(f'Unknown dedup method {method}, use one of {", ".join((*CLONE_METHODS, "copy"))}')
+DEDUP_MIN_SIZE = getattr(qrFileServerConfig, 'dedup_min_size', 1024*1024)
+DEDUP_CANDIDATES = 16 # the files of the same size hashed when an upload isn't deduplicated
+# the sha256 of files, for dedup and to compare a resumed upload with the file already there.
+# Persisted across restarts when dedup_index_path is set, otherwise shared by the workers
+CONTENT_INDEX = ContentIndex(getattr(qrFileServerConfig, 'dedup_index_path', None) or os.path.join(
+    os.getenv('QR_FILE_SERVER_STATE') or TEMPDIR, 'content.sqlite3'))
+LISTING_PAGE_SIZE = 1000 # the maximum number of entries in one page of /files?lazy=true
+METADATA_CACHE = MetadataCache(getattr(qrFileServerConfig, 'cache_max_memory', 64*1024*1024), record_scan, path_changed)
+SEARCH_PAGE_SIZE = 100 # the default number of entries in one page of /search
+SEARCH_INDEX = SearchIndex(UPLOAD_FOLDER, getattr(qrFileServerConfig, 'search_rebuild_interval', 3600))
+SEARCH_INDEX.start()
+CHANGE_FEED = ChangeFeed(os.path.join(os.getenv('QR_FILE_SERVER_STATE') or TEMPDIR, 'events.sqlite3'), UPLOAD_FOLDER,
+                         describe_path)
+EVENTS_HOLD = getattr(qrFileServerConfig, 'events_hold', 30)
+EVENTS_MAX_STREAMS = getattr(qrFileServerConfig, 'events_max_streams', 4)
+EVENT_STREAMS = threading.BoundedSemaphore(EVENTS_MAX_STREAMS) # the streams holding a thread of this worker
+EVENTS_RETRY = 2000 # milliseconds before the browser reconnects to /events
+EVENTS_HEARTBEAT = 15 # seconds between comments keeping an idle stream open
+FILE_JOBS = FileJobs(os.path.join(os.getenv('QR_FILE_SERVER_STATE') or TEMPDIR, 'jobs.sqlite3'), UPLOAD_FOLDER,
+                     path_updated, path_removed, path_moved, getattr(qrFileServerConfig, 'job_threads', 2))
+JOB_WAIT = 2 # seconds a delete, move or copy is waited for before answering with its job
+TRANSFER_ENDPOINTS = {
+    'download_file': DOWNLOAD, 'download_zip': DOWNLOAD, 'download_tar': DOWNLOAD,
+    'upload_file': UPLOAD, 'upload_chunk': UPLOAD, 'upload_chunk_stream': UPLOAD, 'upload_batch': UPLOAD,
+    'upload_delta': UPLOAD,
+}
+FAIR_SHARE = FairShare(getattr(qrFileServerConfig, 'bandwidth_limit', 0),
+                       getattr(qrFileServerConfig, 'client_bandwidth_limit', 0),
+                       getattr(qrFileServerConfig, 'max_transfers', 12),
+                       getattr(qrFileServerConfig, 'client_max_transfers', 6),
+                       getattr(qrFileServerConfig, 'transfer_wait', 10), transfer_waited)
+ZIP_COMPRESS_LEVEL = getattr(qrFileServerConfig, 'zip_compress_level', 1)
+ZIP_THREADS = getattr(qrFileServerConfig, 'zip_threads', os.cpu_count() or 1)
+TAR_COMPRESS_LEVEL = getattr(qrFileServerConfig, 'tar_compress_level', 3)
+TAR_THREADS = getattr(qrFileServerConfig, 'tar_threads', os.cpu_count() or 1)
+
+# reported by /metrics, each worker shares its metrics through QR_FILE_SERVER_STATE
+METRICS = Registry(os.getenv('QR_FILE_SERVER_STATE'))
+REQUESTS = METRICS.counter('qrfileserver_requests_total', 'Requests handled.', ('route', 'method', 'status'))
+REQUEST_SECONDS = METRICS.histogram('qrfileserver_request_duration_seconds',
+                                    'Time from the request until its response is sent.', ('route', 'method'))
+RECEIVED_BYTES = METRICS.counter('qrfileserver_received_bytes_total', 'Bytes of request bodies.', ('route',))
+SENT_BYTES = METRICS.counter('qrfileserver_sent_bytes_total', 'Bytes of response bodies.', ('route',))
+ARCHIVE_STREAMS = METRICS.gauge('qrfileserver_archive_streams', 'Zip and tar archives being sent.', ('format',))
+TRANSFERS = METRICS.gauge('qrfileserver_transfers', 'Downloads, archives and uploads in progress.', ('direction',))
+TRANSFER_REJECTIONS = METRICS.counter('qrfileserver_transfer_rejections_total',
+                                      'Transfers refused because the server or the client had too many.', ('reason',))
+TRANSFER_THROTTLED_SECONDS = METRICS.counter('qrfileserver_transfer_throttled_seconds_total',
+                                             'Time transfers waited for the bandwidth limits.', ('direction',))
+UPLOAD_REJECTION_CODES = {'CORRUPTED', 'RESUME_UPLOAD', 'SESSION_NOT_FOUND', 'CHUNK_TOO_LARGE'}
+UPLOAD_REJECTIONS = METRICS.counter('qrfileserver_upload_rejections_total', 'Upload chunks rejected by code.', ('code',))
+DIRECTORY_SCAN_SECONDS = METRICS.histogram('qrfileserver_directory_scan_seconds',
+                                           'Time to read a directory from the filesystem on a cache miss.')
+METRICS.collector(upload_sessions_metric)
+
+# cap uploads to the largest chunk plus some room for the multipart form.
+# Note that flask writes file parts over 500KiB to temp files.
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_CHUNK_SIZE + 64*1024
+
+# The app for asgi servers, used by start-qrFileServer.py --asgi.
+asgi = AsgiBridge(app, threads=getattr(qrFileServerConfig, 'asgi_threads', 64))
 
 atexit.register(cleanup)
 
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Benchmark the endpoints of qrFileServer against a temporary directory of generated
+files. Run it from the repository root after copying the example configs as
+described in the README:
+
+    python benchmarks/benchmark.py --output before.json
+    ...change something...
+    python benchmarks/benchmark.py --output after.json
+    python benchmarks/benchmark.py --compare before.json after.json
+
+The results are a json document with the commit, the machine and one entry per
+benchmark, so runs of different commits can be compared.
+"""
+import argparse, base64, http.client, json, os, platform, random, shutil, statistics, struct, subprocess, sys
+import tempfile, threading, time, urllib.parse, zlib
+from concurrent.futures import ThreadPoolExecutor
+import psutil
+from loadTest import TOKEN, free_port, start_server, stop_server, create_session, put_chunks, request
+
+MiB = 1024*1024
+
+
+class PeakRss:
+    """Sample the memory of the server and its workers in a thread."""
+
+    def __init__(self, pid, interval=0.05):
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+        self.thread = None
+
+    def _sample(self):
+        while self.running:
+            try:
+                processes = [self.process] + self.process.children(recursive=True)
+                self.peak = max(self.peak, sum(p.memory_info().rss for p in processes))
+            except psutil.Error:
+                pass
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+
+
+def generate_tree(root, files, per_directory=100):
+    """Create a tree with the given number of small files."""
+    for i in range(files):
+        directory = os.path.join(root, f'dir{i // per_directory}')
+        if i % per_directory == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, f'file{i % per_directory}.txt'), 'w') as f:
+            f.write(f'{i}\n'*20)
+
+
+def generate_deep_tree(root, depth):
+    path = root
+    for i in range(depth):
+        path = os.path.join(path, f'level{i}')
+    os.makedirs(path)
+    with open(os.path.join(path, 'leaf.txt'), 'w') as f:
+        f.write('leaf\n')
+
+
+def generate_sparse_file(path, size):
+    """A file of zeros that takes no space on disk."""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+def timed_get(port, path, headers=None, token=True):
+    """
+    :param token: If the token is added to the url.
+    :return: A tuple of (status, time to first byte, total time, bytes).
+    """
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+    start = time.perf_counter()
+    if token:
+        path += f"{'&' if '?' in path else '?'}token={TOKEN}"
+    connection.request('GET', path, headers=headers or {})
+    response = connection.getresponse()
+    received = len(response.read(1))
+    first_byte = time.perf_counter() - start
+    while data := response.read(MiB):
+        received += len(data)
+    total = time.perf_counter() - start
+    connection.close()
+    return response.status, first_byte, total, received
+
+
+def median_get(port, path, runs, headers=None, token=True):
+    """:return: A dict of the median latencies of several requests."""
+    results = [timed_get(port, path, headers, token) for _ in range(runs)]
+    return {
+        'status': results[0][0],
+        'ttfb_ms': round(statistics.median(r[1] for r in results)*1000, 2),
+        'latency_ms': round(statistics.median(r[2] for r in results)*1000, 2),
+        'bytes': results[0][3],
+    }
+
+
+def session_cookie(port):
+    """:return: The session cookie the server sends for a valid token."""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    connection.request('GET', f'/upload/config?token={TOKEN}')
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.getheader('Set-Cookie').split(';')[0]
+
+
+def transfer_get(port, path, headers=None):
+    status, first_byte, total, received = timed_get(port, path, headers)
+    return {
+        'status': status,
+        'ttfb_ms': round(first_byte*1000, 2),
+        'seconds': round(total, 3),
+        'bytes': received,
+        'megabytes_per_second': round(received/total/MiB, 1),
+    }
+
+
+def upload_parallel(port, data, request_size, concurrency, name):
+    """Upload one file with several connections sending chunks in parallel."""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+    start = time.perf_counter()
+    session = create_session(connection, 'uploads', name, len(data))
+    per_request = max(1, request_size // session['chunkSize'])
+    total_chunks = -(-len(data) // session['chunkSize'])
+    groups = [(chunk, min(per_request, total_chunks - chunk)) for chunk in range(0, total_chunks, per_request)]
+    local = threading.local()
+
+    def send(group):
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+        put_chunks(local.connection, session, data, *group)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, groups))
+    total = time.perf_counter() - start
+    return {
+        'seconds': round(total, 3),
+        'bytes': len(data),
+        'megabytes_per_second': round(len(data)/total/MiB, 1),
+    }
+
+
+def change_blocks(data, percent, block_size):
+    """:return: A copy of data with percent of its blocks overwritten with random bytes."""
+    changed = bytearray(data)
+    blocks = len(data) // block_size
+    for index in random.Random(percent).sample(range(blocks), blocks*percent // 100):
+        changed[index*block_size:(index + 1)*block_size] = os.urandom(block_size)
+    return bytes(changed)
+
+
+def post_form(connection, path, fields):
+    """:return: A tuple of the status and the json response."""
+    connection.request('POST', f'{path}?token={TOKEN}', body=urllib.parse.urlencode(fields),
+                       headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def upload_delta(port, data, request_size, concurrency, name):
+    """
+    Upload a new version of a file with /upload/delta. Only block aligned offsets are
+    matched, which finds every unchanged block of change_blocks() without rolling a
+    checksum in python, unlike the browser which also finds blocks that moved.
+    """
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+    start = time.perf_counter()
+    fields = {'folder': 'uploads', 'filename': name}
+    status, delta = post_form(connection, '/upload/delta', fields)
+    if status != 200:
+        raise RuntimeError(f'Delta upload failed with status {status}')
+    block_size = delta['blockSize']
+    signatures = base64.b64decode(delta['signatures'])
+    blocks = dict(((weak, strong), index) for index, (weak, strong) in enumerate(struct.iter_unpack('<II', signatures)))
+    fields.update(upload=delta['upload'], basis=delta['basis'], fileSize=len(data))
+
+    parts = []
+    body = bytearray()
+    body_offset = 0
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        index = blocks.get((zlib.adler32(block), zlib.crc32(block))) if len(block) == block_size else None
+        body += struct.pack('<BII', 0, index, 1) if index is not None else struct.pack('<BI', 1, len(block)) + block
+        if len(body) >= request_size:
+            parts.append((body_offset, bytes(body)))
+            body = bytearray()
+            body_offset = offset + len(block)
+    if body:
+        parts.append((body_offset, bytes(body)))
+    local = threading.local()
+
+    def send(part):
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+        query = urllib.parse.urlencode(dict(fields, offset=part[0]))
+        status, _ = request(local.connection, 'PUT', f'/upload/delta?{query}', part[1],
+                            {'Content-Type': 'application/octet-stream'})
+        if status != 200:
+            raise RuntimeError(f'Delta upload failed with status {status}')
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, parts))
+    status, _ = post_form(connection, '/upload/delta/commit', dict(fields, checksum=f'crc32={zlib.crc32(data):08x}'))
+    if status != 200:
+        raise RuntimeError(f'Delta upload failed with status {status}')
+    total = time.perf_counter() - start
+    sent = sum(len(body) for _, body in parts)
+    return {
+        'seconds': round(total, 3),
+        'bytes': len(data),
+        'bytes_sent': sent,
+        'megabytes_per_second': round(len(data)/total/MiB, 1),
+    }
+
+
+def run(args):
+    root = tempfile.mkdtemp(prefix='qrFileServer-bench-')
+    results = []
+
+    def record(name, params, server, measure):
+        with PeakRss(server.pid) as rss:
+            metrics = measure()
+        metrics['peak_rss_mb'] = round(rss.peak/MiB, 1)
+        result = {'name': name, 'params': params, 'metrics': metrics}
+        print(json.dumps(result), file=sys.stderr, flush=True)
+        results.append(result)
+
+    try:
+        tree_sizes = [int(n) for n in args.tree_sizes.split(',')]
+        for files in tree_sizes:
+            generate_tree(os.path.join(root, f'tree{files}'), files)
+        generate_deep_tree(os.path.join(root, 'deep'), args.depth)
+        os.makedirs(os.path.join(root, 'sparse'))
+        generate_sparse_file(os.path.join(root, 'sparse', 'big.bin'), args.sparse_size*MiB*1024)
+        os.makedirs(os.path.join(root, 'uploads'))
+
+        port = free_port()
+        server, state_dir = start_server(root, port, args.workers, args.asgi)
+        try:
+            # the same small response authenticated each way, and a static file without auth
+            basic = base64.b64encode(f'token:{TOKEN}'.encode()).decode()
+            for method, path, headers, token in (
+                    ('static', '/static/css/styles.css', None, False),
+                    ('token', '/upload/config', None, True),
+                    ('cookie', '/upload/config', {'Cookie': session_cookie(port)}, False),
+                    ('basic', '/upload/config', {'Authorization': f'Basic {basic}'}, False)):
+                record('auth', {'method': method}, server,
+                       lambda: median_get(port, path, args.runs*20, headers, token))
+
+            for files in tree_sizes:
+                record('files', {'files': files}, server,
+                       lambda: median_get(port, f'/files?folder=tree{files}', args.runs))
+                record('files_lazy', {'files': files}, server,
+                       lambda: median_get(port, f'/files?lazy=true&folder=tree{files}&depth=2', args.runs))
+            record('files_lazy_deep', {'depth': args.depth}, server,
+                   lambda: median_get(port, f'/files?lazy=true&folder=deep&depth={args.depth + 1}', args.runs))
+
+            size = args.sparse_size*MiB*1024
+            record('download', {'bytes': size}, server, lambda: transfer_get(port, '/download/sparse/big.bin'))
+            record('download_range', {'bytes': size // 2}, server,
+                   lambda: transfer_get(port, '/download/sparse/big.bin', {'Range': f'bytes={size // 2}-'}))
+
+            small = f'tree{tree_sizes[-1]}'
+            for name, path in (('zip', f'/zip/{small}'), ('zip_store', f'/zip/{small}?store=true'),
+                               ('tar', f'/tar/{small}'), ('tar_gzip', f'/tar/{small}?compression=gzip'),
+                               ('zip_sparse', '/zip/sparse')):
+                record(name, {'path': path.split('?')[0]}, server, lambda: transfer_get(port, path))
+
+            data = os.urandom(args.upload_size*MiB)
+            for request_size in [int(s)*1024 for s in args.chunk_sizes.split(',')]:
+                for concurrency in [int(c) for c in args.concurrency.split(',')]:
+                    name = f'upload-{request_size}-{concurrency}.bin'
+                    record('upload', {'bytes': len(data), 'request_size': request_size, 'concurrency': concurrency},
+                           server, lambda: upload_parallel(port, data, request_size, concurrency, name))
+                    os.remove(os.path.join(root, 'uploads', name))
+
+            # a new version of a file already on the server, sent whole then as a delta
+            original = os.urandom(args.delta_size*MiB)
+            concurrency = max(int(c) for c in args.concurrency.split(','))
+            for percent in [int(p) for p in args.delta_changes.split(',')]:
+                name = f'delta-{percent}.bin'
+                changed = change_blocks(original, percent, 64*1024)
+                params = {'bytes': len(original), 'changed_percent': percent, 'concurrency': concurrency}
+                upload_parallel(port, original, 4*MiB, concurrency, name)
+                record('upload_full', params, server,
+                       lambda: dict(upload_parallel(port, changed, 4*MiB, concurrency, name), bytes_sent=len(changed)))
+                upload_parallel(port, original, 4*MiB, concurrency, name)
+                record('upload_delta', params, server, lambda: upload_delta(port, changed, 4*MiB, concurrency, name))
+                os.remove(os.path.join(root, 'uploads', name))
+        finally:
+            stop_server(server, state_dir)
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(old_path, new_path):
+    """Print the relative change of every metric between two result files."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}")
+    old_results = {(r['name'], json.dumps(r['params'], sort_keys=True)): r['metrics'] for r in old['results']}
+    for result in new['results']:
+        before = old_results.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+        if before is None:
+            continue
+        changes = []
+        for metric, value in result['metrics'].items():
+            if metric in ('status', 'bytes') or not before.get(metric):
+                continue
+            changes.append(f'{metric} {before[metric]} -> {value} ({(value - before[metric])/before[metric]*100:+.1f}%)')
+        print(f"{result['name']} {result['params']}: " + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the endpoints of qrFileServer.')
+    parser.add_argument('--output', '-o', help='Write the results to this json file instead of stdout.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files.')
+    parser.add_argument('--tree-sizes', default='1000,10000,50000', help='Comma separated numbers of small files.')
+    parser.add_argument('--depth', type=int, default=50, help='The depth of the deep tree.')
+    parser.add_argument('--sparse-size', type=int, default=4, help='The size of the sparse file in GiB.')
+    parser.add_argument('--upload-size', type=int, default=64, help='The size of the uploaded file in MiB.')
+    parser.add_argument('--chunk-sizes', default='256,1024,4096', help='Comma separated upload request sizes in KiB.')
+    parser.add_argument('--concurrency', default='1,4', help='Comma separated parallel upload requests.')
+    parser.add_argument('--delta-size', type=int, default=32, help='The size of the file uploaded as a delta in MiB.')
+    parser.add_argument('--delta-changes', default='1,10,50', help='Comma separated percentages of changed data.')
+    parser.add_argument('--runs', type=int, default=5, help='Requests per latency measurement.')
+    parser.add_argument('--workers', type=int, default=1, help='The number of gunicorn workers.')
+    parser.add_argument('--asgi', action='store_true', help='Use uvicorn workers.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not os.path.exists('qrFileServerConfig.py'):
+        print('Copy qrFileServerConfig.py.example to qrFileServerConfig.py first, see the README.')
+        sys.exit(1)
+
+    document = {
+        'commit': commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'workers': args.workers,
+        'asgi': args.asgi,
+        'results': run(args),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+    else:
+        print(json.dumps(document, indent=2))
+
+
+if __name__ == '__main__':
+    main()
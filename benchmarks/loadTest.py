@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Load test qrFileServer with several gunicorn worker counts to see how throughput
+scales across cores. Run it from the repository root after copying the example
+configs as described in the README:
+
+    python benchmarks/loadTest.py --workers 1,2,4 --clients 16 --duration 10
+
+Each scenario is run by client processes for a fixed duration against a server
+serving a temporary directory of generated files. Results are printed as one json
+object per line.
+"""
+import argparse, base64, http.client, json, multiprocessing, os, secrets, shutil, socket
+import subprocess, sys, tempfile, time, zlib
+
+TOKEN = secrets.token_urlsafe(16)
+SCENARIOS = ['list', 'download', 'upload', 'zip']
+
+
+def generate_files(root):
+    """Create the files served during the load test."""
+    tree = os.path.join(root, 'tree')
+    for i in range(20):
+        os.makedirs(os.path.join(tree, f'dir{i}'))
+        for j in range(50):
+            with open(os.path.join(tree, f'dir{i}', f'file{j}.txt'), 'w') as f:
+                f.write(f'{i} {j}\n'*10)
+    os.makedirs(os.path.join(root, 'data'))
+    with open(os.path.join(root, 'data', 'file.bin'), 'wb') as f:
+        f.write(os.urandom(8*1024*1024))
+    os.makedirs(os.path.join(root, 'text'))
+    for i in range(8):
+        with open(os.path.join(root, 'text', f'log{i}.txt'), 'w') as f:
+            f.write(''.join(f'{n} GET /download/file{n % 97}.txt 200\n' for n in range(20000)))
+    os.makedirs(os.path.join(root, 'uploads'))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(root, port, workers, asgi):
+    """:return: A tuple of the server process and its shared state directory."""
+    state_dir = tempfile.mkdtemp(prefix='qrFileServer-load-')
+    env = dict(os.environ,
+               QR_FILE_SERVER_INPUT=base64.b64encode(root.encode()).decode(),
+               QR_FILE_SERVER_BIND=f'127.0.0.1:{port}',
+               QR_FILE_SERVER_TOKEN=TOKEN,
+               QR_FILE_SERVER_READONLY='false',
+               QR_FILE_SERVER_SECURE='false',
+               QR_FILE_SERVER_STATE=state_dir)
+    worker = ['-k', 'uvicorn_worker.UvicornWorker', 'app:asgi'] if asgi else ['-k', 'gthread', '--threads', '16', 'app:app']
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+                               '--workers', str(workers), '--timeout', '120'] + worker,
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            status, _ = request(http.client.HTTPConnection('127.0.0.1', port), 'GET', '/upload/config')
+            if status == 200:
+                return server, state_dir
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    shutil.rmtree(state_dir)
+    raise RuntimeError('The server did not start')
+
+
+def stop_server(server, state_dir):
+    server.terminate()
+    server.wait()
+    shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def request(connection, method, path, body=None, headers=None):
+    """:return: A tuple of the status and the length of the body received."""
+    separator = '&' if '?' in path else '?'
+    connection.request(method, f'{path}{separator}token={TOKEN}', body=body, headers=headers or {})
+    response = connection.getresponse()
+    received = 0
+    while data := response.read(1024*1024):
+        received += len(data)
+    return response.status, received
+
+
+def create_session(connection, folder, filename, file_size):
+    """:return: The json of /upload/session."""
+    boundary = secrets.token_hex(8)
+    fields = {'folder': folder, 'filename': filename, 'fileSize': file_size, 'resume': 'false'}
+    form = ''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n' for k, v in fields.items())
+    form += f'--{boundary}--\r\n'
+    connection.request('POST', f'/upload/session?token={TOKEN}', body=form.encode(),
+                       headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    return json.loads(connection.getresponse().read())
+
+
+def put_chunks(connection, session, data, chunk, count):
+    """Send count consecutive chunks starting at chunk as a raw request body."""
+    chunk_size = session['chunkSize']
+    body = data[chunk*chunk_size:(chunk + count)*chunk_size]
+    status, _ = request(connection, 'PUT', '/upload/chunk', body, {
+        'X-Upload-Session': session['session'], 'X-Upload-Chunk': str(chunk), 'X-Upload-Count': str(count),
+        'X-Chunk-Checksum': f'crc32={zlib.crc32(body):08x}'})
+    if status != 200:
+        raise RuntimeError(f'Upload failed with status {status}')
+
+
+def upload(connection, client, index, data, request_size=1024*1024):
+    """
+    Upload a file with a session and raw chunks.
+
+    :param request_size: Roughly how many bytes to send per request.
+    :return: The bytes sent.
+    """
+    session = create_session(connection, 'uploads', f'{client}-{index}.bin', len(data))
+    per_request = max(1, request_size // session['chunkSize'])
+    total_chunks = -(-len(data) // session['chunkSize'])
+    for chunk in range(0, total_chunks, per_request):
+        put_chunks(connection, session, data, chunk, min(per_request, total_chunks - chunk))
+    return len(data)
+
+
+def client(args):
+    """Run one scenario in a loop. :return: A tuple of (requests, bytes, errors)."""
+    port, scenario, duration, client_id, root = args
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    data = os.urandom(2*1024*1024) if scenario == 'upload' else None
+    requests = transferred = errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            if scenario == 'list':
+                status, received = request(connection, 'GET', '/files?lazy=true&folder=tree&depth=2')
+            elif scenario == 'download':
+                status, received = request(connection, 'GET', '/download/data/file.bin')
+            elif scenario == 'zip':
+                status, received = request(connection, 'GET', '/zip/text')
+            else:
+                received = upload(connection, client_id, requests, data)
+                os.remove(os.path.join(root, 'uploads', f'{client_id}-{requests}.bin'))
+                status = 200
+        except (OSError, RuntimeError, ValueError, KeyError):
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+            errors += 1
+            continue
+        if status != 200:
+            errors += 1
+        requests += 1
+        transferred += received
+    return requests, transferred, errors
+
+
+def run_scenario(port, scenario, clients, duration, root):
+    with multiprocessing.Pool(clients) as pool:
+        start = time.time()
+        results = pool.map(client, [(port, scenario, duration, i, root) for i in range(clients)])
+        elapsed = time.time() - start
+    requests = sum(r[0] for r in results)
+    transferred = sum(r[1] for r in results)
+    return {
+        'requests': requests,
+        'errors': sum(r[2] for r in results),
+        'requests_per_second': round(requests/elapsed, 1),
+        'megabytes_per_second': round(transferred/elapsed/1024/1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test qrFileServer with several worker counts.')
+    parser.add_argument('--workers', default='1,2,4', help='Comma separated gunicorn worker counts.')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent client processes.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per scenario.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated scenarios.')
+    parser.add_argument('--asgi', action='store_true', help='Use uvicorn workers.')
+    args = parser.parse_args()
+
+    if not os.path.exists('qrFileServerConfig.py'):
+        print('Copy qrFileServerConfig.py.example to qrFileServerConfig.py first, see the README.')
+        sys.exit(1)
+
+    root = tempfile.mkdtemp(prefix='qrFileServer-data-')
+    try:
+        generate_files(root)
+        for workers in [int(w) for w in args.workers.split(',')]:
+            port = free_port()
+            server, state_dir = start_server(root, port, workers, args.asgi)
+            try:
+                for scenario in args.scenarios.split(','):
+                    result = run_scenario(port, scenario, args.clients, args.duration, root)
+                    print(json.dumps({'scenario': scenario, 'workers': workers, 'clients': args.clients,
+                                      'asgi': args.asgi, **result}), flush=True)
+            finally:
+                stop_server(server, state_dir)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import asyncio, io, sys
+from concurrent.futures import ThreadPoolExecutor
+
+END = object()
+# A wsgi app may replace this environ key, set to None by the bridge, with an async
+# iterator of bytes sent as the response body instead of the wsgi iterable, so long
+# lived responses like server sent events don't hold a thread while they wait.
+ASYNC_BODY = 'qrFileServer.async_body'
+
+
+class ClientDisconnected(OSError):
+    pass
+
+
+class RequestBody(io.RawIOBase):
+    """
+    The wsgi.input of a request whose body is received by the event loop. Small
+    bodies are received before the request is handled, larger ones are read on
+    demand from the thread handling the request.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = bytearray()
+        self.more_body = True
+
+    def _add(self, message):
+        if message['type'] == 'http.disconnect':
+            self.more_body = False
+            raise ClientDisconnected('The client disconnected while sending the request')
+        self.buffer += message.get('body', b'')
+        self.more_body = message.get('more_body', False)
+
+    async def prefetch(self):
+        """Receive the whole body without blocking a thread."""
+        while self.more_body:
+            self._add(await self.receive())
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and self.more_body:
+            self._add(asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result())
+        length = min(len(b), len(self.buffer))
+        b[:length] = self.buffer[:length]
+        del self.buffer[:length]
+        return length
+
+
+class AsgiBridge:
+    """
+    Serve a wsgi app like flask with an asgi server such as uvicorn.
+
+    Requests are handled in a thread pool but responses are sent by the event loop.
+    Only reading the next piece of a response, such as a block of a file or of a
+    zip, runs in a thread, so slow clients don't hold a thread while they download.
+    """
+
+    def __init__(self, wsgi_app, threads=64, prefetch_size=256*1024):
+        """
+        :param wsgi_app: The wsgi app.
+        :param threads: The number of threads running the wsgi app.
+        :param prefetch_size: Request bodies up to this size are received before
+        handling the request so no thread waits on the network for them.
+        """
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.prefetch_size = prefetch_size
+        self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    # created here so the threads belong to the worker process
+                    self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='wsgi')
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False, cancel_futures=True)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        if self.executor is None: # the server doesn't support lifespan
+            self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='wsgi')
+        await self.handle(scope, receive, send)
+
+    def environ(self, scope, body):
+        """Build the wsgi environ of an asgi http scope."""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'SERVER_SOFTWARE': 'qrFileServer-asgi',
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.input_terminated': True, # the body ends when the server says so, even if chunked
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            ASYNC_BODY: None,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = f'HTTP_{name}'
+            if name in environ:
+                # repeated cookie headers are separate cookies, not a list of values
+                value = f"{environ[name]}{'; ' if name == 'HTTP_COOKIE' else ','}{value}"
+            environ[name] = value
+        return environ
+
+    async def handle(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body = RequestBody(receive, loop)
+        environ = self.environ(scope, body)
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        try:
+            if content_length <= self.prefetch_size:
+                await body.prefetch()
+        except ClientDisconnected:
+            return
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return self._write_unsupported
+
+        iterable = await loop.run_in_executor(self.executor, self.wsgi_app, environ, start_response)
+        if environ[ASYNC_BODY] is not None:
+            await self._send_async(environ[ASYNC_BODY], iterable, started, receive, send)
+            return
+        disconnected = None
+        try:
+            iterator = iter(iterable)
+            data = await loop.run_in_executor(self.executor, next, iterator, END)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            started['sent'] = True
+            if not body.more_body:
+                disconnected = asyncio.create_task(self._wait_disconnect(receive))
+            while data is not END:
+                if data:
+                    await send({'type': 'http.response.body', 'body': bytes(data), 'more_body': True})
+                if disconnected is not None and disconnected.done():
+                    return # stop reading a stream nobody receives
+                data = await loop.run_in_executor(self.executor, next, iterator, END)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if disconnected is not None:
+                disconnected.cancel()
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+    async def _send_async(self, body, iterable, started, receive, send):
+        loop = asyncio.get_running_loop()
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(self.executor, iterable.close)
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        disconnected = asyncio.create_task(self._wait_disconnect(receive))
+        data = None
+        try:
+            while True:
+                data = asyncio.create_task(anext(body, END))
+                await asyncio.wait((data, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if not data.done():
+                    return # the client is gone
+                if data.result() is END:
+                    break
+                await send({'type': 'http.response.body', 'body': bytes(data.result()), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            disconnected.cancel()
+            if data is not None and not data.done():
+                data.cancel()
+                await asyncio.gather(data, return_exceptions=True)
+            await body.aclose()
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    def _write_unsupported(data):
+        raise RuntimeError('write() is not supported, return an iterable instead')
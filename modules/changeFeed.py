@@ -0,0 +1,222 @@
+import os, sqlite3, threading, time, json, asyncio
+from collections import deque
+from modules.uploadSession import is_upload_file
+
+# Records of a reset tell clients that changes were lost so they reload their listings.
+RESET = {'type': 'reset'}
+
+
+class ChangeFeed:
+    """
+    A feed of the paths created, modified, moved or deleted under the served
+    folder, for clients to patch their listings instead of reloading them.
+
+    Changes are coalesced per path over a short window, then the final state of
+    each path is stored as one batch in an sqlite database shared by every gunicorn
+    worker, so a client connected to any worker sees the changes made through the
+    others. Batches are numbered so a client that reconnects gets the ones it
+    missed, or a reset once they were forgotten.
+    """
+
+    def __init__(self, path, root, describe, window=0.25, max_age=600, memory_batches=1000):
+        """
+        :param path: The path of the database, shared by all workers.
+        :param root: The served folder, paths in the feed are relative to it.
+        :param describe: A function returning the listing entry of an absolute path
+        or None if it doesn't exist.
+        :param window: The seconds changes are coalesced over.
+        :param max_age: Batches older than this many seconds are forgotten.
+        :param memory_batches: The number of recent batches kept in memory.
+        """
+        self.path = path
+        self.root = root
+        self.describe = describe
+        self.window = window
+        self.max_age = max_age
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = {} # relative path -> relative source of a move or None
+        self.reset_pending = False
+        self.batches = deque(maxlen=memory_batches) # (id, json of the records)
+        self.last_id = None
+        self.listening_until = 0
+        self.waiters = set() # (loop, asyncio.Event) of async readers
+        self.thread = None
+        self.pid = None
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS change_batches (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                       'created REAL NOT NULL, records TEXT NOT NULL)')
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def _relative(self, path):
+        relative = os.path.relpath(os.path.normpath(path), self.root)
+        if relative == '.' or relative.startswith('..') or is_upload_file(os.path.basename(relative)):
+            return None
+        return relative.replace(os.sep, '/')
+
+    def publish(self, path, source=None):
+        """
+        Record a change of a path. Its state is read when the window ends, so
+        publishing the same path several times only sends it once.
+
+        :param path: The absolute path created, modified or deleted.
+        :param source: The absolute path it was moved from, if it was moved.
+        """
+        relative = self._relative(path)
+        if relative is None:
+            return
+        with self.lock:
+            if source is not None:
+                source = self._relative(source)
+                self.pending.pop(source, None)
+            self.pending[relative] = source or self.pending.get(relative)
+            self._start()
+
+    def reset(self):
+        """Tell clients that changes were lost, like when a watch overflowed."""
+        with self.lock:
+            self.reset_pending = True
+            self._start()
+
+    def _start(self):
+        if self.thread is None or self.pid != os.getpid():
+            # started lazily so the thread belongs to the worker process
+            self.thread = threading.Thread(target=self._loop, name='change-feed', daemon=True)
+            self.pid = os.getpid()
+            self.thread.start()
+        self.changed.notify_all()
+
+    def _loop(self):
+        last_trim = 0
+        while True:
+            with self.lock:
+                while not self.pending and not self.reset_pending and time.monotonic() > self.listening_until:
+                    self.changed.wait()
+            time.sleep(self.window)
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                reset, self.reset_pending = self.reset_pending, False
+            records = [RESET] if reset else []
+            for relative, source in pending.items():
+                records.extend(self._records(relative, source))
+            try:
+                if records:
+                    with self._connection() as db:
+                        db.execute('INSERT INTO change_batches (created, records) VALUES (?, ?)',
+                                   (time.time(), json.dumps(records)))
+                if time.monotonic() - last_trim > self.max_age / 10:
+                    with self._connection() as db:
+                        db.execute('DELETE FROM change_batches WHERE created < ?', (time.time() - self.max_age,))
+                    last_trim = time.monotonic()
+                self._poll()
+            except sqlite3.Error as e:
+                print(f'Change feed error: {e}')
+
+    def _records(self, relative, source):
+        entry = self.describe(os.path.join(self.root, relative))
+        if entry is None:
+            deleted = [{'type': 'deleted', 'path': relative}]
+            return deleted + ([{'type': 'deleted', 'path': source}] if source else [])
+        if source is not None:
+            return [{'type': 'moved', 'path': relative, 'from': source, 'entry': entry}]
+        return [{'type': 'changed', 'path': relative, 'entry': entry}]
+
+    def _poll(self):
+        """Read the batches stored by every worker since the last poll."""
+        if self.last_id is None:
+            self._init_last_id()
+        rows = self._connection().execute('SELECT id, records FROM change_batches WHERE id > ? ORDER BY id',
+                                          (self.last_id,)).fetchall()
+        if not rows:
+            return
+        with self.lock:
+            self.batches.extend(rows)
+            self.last_id = rows[-1][0]
+            self.changed.notify_all()
+            for loop, event in self.waiters:
+                loop.call_soon_threadsafe(event.set)
+
+    def _init_last_id(self):
+        last_id = self._sequence()
+        with self.lock:
+            if self.last_id is None:
+                self.last_id = last_id
+
+    def current(self):
+        """:return: The id of the latest batch, to read the changes after it."""
+        if self.last_id is None:
+            self._init_last_id()
+        return self.last_id
+
+    def changes(self, after):
+        """
+        :param after: The id of the last batch a client received.
+        :return: A list of (id, json list of records) after it, or None if some of
+        them were forgotten.
+        """
+        with self.lock:
+            if self.last_id is not None and after == self.last_id:
+                return []
+            if self.last_id is not None and after < self.last_id and self.batches and self.batches[0][0] <= after + 1:
+                return [batch for batch in self.batches if batch[0] > after]
+        # not in memory, like for a client that was offline a while or got newer
+        # batches from another worker
+        db = self._connection()
+        last_id = self._sequence()
+        if after > last_id:
+            return None # from before the server restarted
+        if after == last_id:
+            return []
+        oldest = db.execute('SELECT MIN(id) FROM change_batches').fetchone()[0]
+        if oldest is None or oldest > after + 1:
+            return None
+        return db.execute('SELECT id, records FROM change_batches WHERE id > ? AND id <= ? ORDER BY id',
+                          (after, last_id)).fetchall()
+
+    def _sequence(self):
+        # the last id given to a batch, even if it was deleted since
+        row = self._connection().execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_batches'").fetchone()
+        return row[0] if row else 0
+
+    def _listen(self, seconds):
+        with self.lock:
+            self.listening_until = max(self.listening_until, time.monotonic() + seconds + self.window)
+            self._start()
+
+    def wait(self, after, timeout):
+        """
+        Wait until there are batches after an id.
+
+        :return: If there are.
+        """
+        self._listen(timeout)
+        with self.lock:
+            return self.changed.wait_for(lambda: self.last_id is not None and self.last_id > after, timeout)
+
+    async def wait_async(self, after, timeout):
+        """wait() for an event loop, which doesn't hold a thread."""
+        self._listen(timeout)
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            if self.last_id is not None and self.last_id > after:
+                return True
+            self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
@@ -0,0 +1,127 @@
+import gzip, threading, zlib
+from collections import OrderedDict
+
+# Optional brotli and zstd response compression, gzip is always available.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The compression levels of responses compressed for each request and of the
+# responses kept in the cache, which are compressed once.
+LEVELS = {
+    'zstd': (3, 12),
+    'br': (4, 9),
+    'gzip': (6, 9),
+}
+
+# Compressible types besides text/*.
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/javascript', 'application/xml', 'application/x-ndjson',
+    'application/manifest+json', 'image/svg+xml',
+}
+
+
+def available_encodings(preferred):
+    """
+    :param preferred: Content encodings in the order the server prefers them.
+    :return: The encodings of preferred supported by the installed packages.
+    """
+    return [e for e in preferred if e in LEVELS and (e != 'br' or brotli is not None)
+            and (e != 'zstd' or zstandard is not None)]
+
+
+def is_compressible(mimetype):
+    """:return: If a response of this type is text that compresses well."""
+    # server sent events must reach the client as soon as they are sent
+    return (mimetype is not None and mimetype != 'text/event-stream'
+            and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES))
+
+
+def compress(data, encoding, level):
+    """:return: The bytes compressed with a content encoding."""
+    if encoding == 'gzip':
+        return gzip.compress(data, level, mtime=0)
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class StreamCompressor:
+    """A compressobj like wrapper of every content encoding."""
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == 'br':
+            self.compressor = brotli.Compressor(quality=level)
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self.compressor.process(data)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Compress a streamed response body.
+
+    :param chunks: An iterable of bytes, closed when done if it has a close method.
+    :return: A generator of compressed bytes.
+    """
+    compressor = StreamCompressor(encoding, level)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class CompressedCache:
+    """
+    An LRU cache of compressed responses keyed by their etag, which changes with
+    the mtime of a file, and the content encoding.
+    """
+
+    def __init__(self, max_memory):
+        """:param max_memory: The maximum size in bytes of the compressed data kept."""
+        self.max_memory = max_memory
+        self.entries = OrderedDict()
+        self.memory = 0
+        self.lock = threading.Lock()
+
+    def get(self, etag, encoding):
+        """:return: The compressed bytes or None."""
+        with self.lock:
+            data = self.entries.get((etag, encoding))
+            if data is not None:
+                self.entries.move_to_end((etag, encoding))
+            return data
+
+    def put(self, etag, encoding, data):
+        if len(data) > self.max_memory:
+            return
+        with self.lock:
+            old = self.entries.pop((etag, encoding), None)
+            if old is not None:
+                self.memory -= len(old)
+            self.entries[(etag, encoding)] = data
+            self.memory += len(data)
+            while self.memory > self.max_memory:
+                self.memory -= len(self.entries.popitem(last=False)[1])
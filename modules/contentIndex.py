@@ -0,0 +1,202 @@
+import os, sqlite3, threading, hashlib, secrets
+from collections import deque
+from modules.uploadSession import PART_SUFFIX
+
+READ_SIZE = 1024*1024
+# Files waiting to be hashed, the oldest are dropped when uploads arrive faster.
+MAX_PENDING = 10000
+# The ioctl cloning a whole file on btrfs, xfs and other copy on write filesystems.
+FICLONE = 0x40049409
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def reflink(source, destination):
+    """
+    Create destination sharing the data of source without copying it.
+
+    :raises OSError: If the filesystem can't clone files, like across devices.
+    """
+    if fcntl is None:
+        raise OSError('Cloning files is not supported on this platform')
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+# Ways to create a file with the content of another, tried in the configured order.
+# They take a moment whatever the size, unlike a copy which the server runs as a job.
+METHODS = {
+    'reflink': reflink,
+    'hardlink': os.link,
+}
+
+
+class ContentIndex:
+    """
+    The sha256 of files stored in an sqlite database keyed by (device, inode, size,
+    mtime) so a hash is never computed twice for the same content and is ignored
+    as soon as the file changes. It is persisted across restarts and shared by every
+    gunicorn worker.
+
+    Files are hashed by the server in a background thread, a hash sent by a client
+    is only used to look up content.
+    """
+
+    def __init__(self, path):
+        """:param path: The path of the database, its directory is created if needed."""
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.local = threading.local()
+        self.pending = deque(maxlen=MAX_PENDING)
+        self.wakeup = threading.Event()
+        self.thread = None
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS content_hashes (device INTEGER NOT NULL, '
+                       'inode INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                       'sha256 TEXT NOT NULL, path TEXT NOT NULL, PRIMARY KEY (device, inode, size, mtime_ns))')
+            db.execute('CREATE INDEX IF NOT EXISTS content_hashes_sha256 ON content_hashes (sha256)')
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    @staticmethod
+    def key(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, st):
+        """:return: The known sha256 of the file with this os.stat_result or None."""
+        row = self._connection().execute(
+            'SELECT sha256 FROM content_hashes WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+            self.key(st)).fetchone()
+        return row[0] if row else None
+
+    def add(self, path, st, sha256):
+        """Record the sha256 of the file at path with this os.stat_result."""
+        with self._connection() as db:
+            db.execute('INSERT OR REPLACE INTO content_hashes VALUES (?, ?, ?, ?, ?, ?)',
+                       self.key(st) + (sha256, os.path.realpath(path)))
+
+    def hash(self, path):
+        """
+        Get the sha256 of a file, hashing it when it isn't known yet.
+
+        :return: The hex sha256 or None if the file can't be read or changed while hashing.
+        """
+        try:
+            st = os.stat(path)
+            known = self.get(st)
+            if known is not None:
+                return known
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                while data := f.read(READ_SIZE):
+                    hasher.update(data)
+            if self.key(os.stat(path)) != self.key(st):
+                return None # modified while hashing
+        except OSError:
+            return None
+        self.add(path, st, hasher.hexdigest())
+        return hasher.hexdigest()
+
+    def find(self, sha256, size):
+        """
+        :param sha256: The hex sha256 of some content.
+        :param size: The size of the content.
+        :return: A tuple of the path of an unchanged file with this content and its
+        key, or None.
+        """
+        rows = self._connection().execute(
+            'SELECT device, inode, size, mtime_ns, path FROM content_hashes WHERE sha256 = ? AND size = ?',
+            (sha256, size)).fetchall()
+        for *key, path in rows:
+            key = tuple(key)
+            try:
+                if self.key(os.stat(path)) == key:
+                    return path, key
+            except OSError:
+                pass
+            # the file was modified, replaced or deleted since it was hashed
+            with self._connection() as db:
+                db.execute('DELETE FROM content_hashes WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                           key)
+        return None
+
+    def queue(self, item):
+        """
+        Hash files later in a background thread of this process.
+
+        :param item: The path of a file, or a function returning the paths to hash so
+        looking for them doesn't hold the caller either.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._hash_loop, name='content-index', daemon=True)
+            self.thread.start()
+        self.pending.append(item)
+        self.wakeup.set()
+
+    def _hash_loop(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                item = self.pending.popleft()
+                try:
+                    paths = item() if callable(item) else (item,)
+                except Exception as e:
+                    print(f'Content index error: {e}')
+                    continue
+                for path in paths:
+                    self.hash(path)
+
+    def materialize(self, sha256, size, destination, methods):
+        """
+        Create or replace destination with a file already on the server with the
+        same content, trying each method until one works. The file appears atomically.
+
+        :param sha256: The hex sha256 of the content.
+        :param size: The size of the content.
+        :param destination: The path to create.
+        :param methods: Names of METHODS in the order to try them, others are skipped.
+        :return: A tuple of the name of the method used and the source path, or None
+        if the content isn't known or no method worked.
+        """
+        found = self.find(sha256, size)
+        if found is None:
+            return None
+        source, key = found
+        if os.path.exists(destination) and os.path.samefile(source, destination):
+            return 'existing', source
+        directory, name = os.path.split(destination)
+        # a hidden part file name so listings skip it until it is in place
+        temporary = os.path.join(directory, f'.{name}.{secrets.token_hex(4)}{PART_SUFFIX}')
+        for method in methods:
+            if method not in METHODS:
+                continue
+            try:
+                METHODS[method](source, temporary)
+                if self.key(os.stat(source)) != key:
+                    raise OSError(f'{source} changed while it was cloned')
+                os.replace(temporary, destination)
+            except OSError:
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+                continue
+            try:
+                self.add(destination, os.stat(destination), sha256)
+            except OSError:
+                pass
+            return method, source
+        return None
@@ -0,0 +1,205 @@
+import os, zlib, struct, threading, hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from modules.fileJobs import COPY_RANGE_ERRORS
+from modules.uploadSession import PART_SUFFIX
+
+# Each full block of a file is signed by its adler32, which clients compute at every
+# offset of their file with a rolling sum, and its crc32 which confirms a match.
+# The short block at the end of a file is never matched.
+SIGNATURE = struct.Struct('<II')
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 1024*1024
+READ_SIZE = 1024*1024
+
+# A delta is a sequence of instructions, each a type byte followed by its arguments:
+# copy count blocks starting at a block index of the existing file, or write the
+# length bytes that follow.
+COPY = 0
+DATA = 1
+COPY_ARGS = struct.Struct('<II')
+DATA_ARGS = struct.Struct('<I')
+
+
+def block_size(file_size):
+    """:return: The block size of a file, about the square root of its size like rsync."""
+    size = MIN_BLOCK_SIZE
+    while size*size < file_size and size < MAX_BLOCK_SIZE:
+        size *= 2
+    return size
+
+
+def delta_part_path(file_path, upload_id):
+    """:return: The hidden file a delta upload to file_path is built in."""
+    directory, name = os.path.split(file_path)
+    return os.path.join(directory, f'.{name}.{upload_id}{PART_SUFFIX}')
+
+
+def sign_blocks(path, size, start, end):
+    """:return: The packed signatures of the blocks from index start to end of a file."""
+    signatures = bytearray()
+    with open(path, 'rb') as f:
+        f.seek(start*size)
+        for _ in range(start, end):
+            data = f.read(size)
+            signatures += SIGNATURE.pack(zlib.adler32(data), zlib.crc32(data))
+    return bytes(signatures)
+
+
+def read_exact(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise EOFError()
+        data += more
+    return data
+
+
+def copy_range(source, destination, length, source_offset, destination_offset):
+    """Copy part of a file into another with copy_file_range, or pread and pwrite."""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while length:
+                copied = os.copy_file_range(source, destination, length, source_offset, destination_offset)
+                if not copied:
+                    raise EOFError()
+                length -= copied
+                source_offset += copied
+                destination_offset += copied
+            return
+        except OSError as e:
+            if e.errno not in COPY_RANGE_ERRORS:
+                raise
+    while length:
+        data = os.pread(source, min(length, READ_SIZE), source_offset)
+        if not data:
+            raise EOFError()
+        written = os.pwrite(destination, data, destination_offset)
+        length -= written
+        source_offset += written
+        destination_offset += written
+
+
+def write_delta(stream, basis_path, part_path, offset, file_size, size, buffer_size):
+    """
+    Write the instructions of a delta to the file being built, starting at an offset.
+    Requests can write different parts of the new file in parallel.
+
+    :param stream: The request body.
+    :param basis_path: The existing file the blocks are copied from.
+    :param part_path: The file being built, created if needed.
+    :param offset: The offset in the new file of the first instruction.
+    :param file_size: The size of the new file, nothing is written past it.
+    :param size: The block size of the signatures of basis_path.
+    :param buffer_size: The size of the buffer used to write data.
+    :return: The offset after the last instruction.
+    :raises ValueError: If an instruction is invalid.
+    :raises EOFError: If the body ends in the middle of an instruction.
+    """
+    source = os.open(basis_path, os.O_RDONLY)
+    try:
+        blocks = os.fstat(source).st_size // size
+        destination = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            while kind := stream.read(1):
+                if kind[0] == COPY:
+                    index, count = COPY_ARGS.unpack(read_exact(stream, COPY_ARGS.size))
+                    if index + count > blocks or offset + count*size > file_size:
+                        raise ValueError('Copy out of range')
+                    copy_range(source, destination, count*size, index*size, offset)
+                    offset += count*size
+                elif kind[0] == DATA:
+                    (length,) = DATA_ARGS.unpack(read_exact(stream, DATA_ARGS.size))
+                    if offset + length > file_size:
+                        raise ValueError('Data out of range')
+                    while length:
+                        data = stream.read(min(length, buffer_size))
+                        if not data:
+                            raise EOFError()
+                        length -= len(data)
+                        while data:
+                            written = os.pwrite(destination, data, offset)
+                            data = data[written:]
+                            offset += written
+                else:
+                    raise ValueError('Unknown instruction')
+        finally:
+            os.close(destination)
+    finally:
+        os.close(source)
+    return offset
+
+
+def file_checksums(path):
+    """:return: A tuple of the crc32 and the hex sha256 of a file, read once."""
+    crc = 0
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while data := f.read(READ_SIZE):
+            crc = zlib.crc32(data, crc)
+            hasher.update(data)
+    return crc, hasher.hexdigest()
+
+
+class SignatureCache:
+    """
+    The block signatures of files for delta uploads, computed in a pool of threads
+    where each reads a range of the file (zlib releases the GIL while hashing), and
+    kept in an LRU cache keyed by (path, size, mtime) so they are only computed again
+    once the file changes.
+    """
+
+    def __init__(self, threads, max_memory):
+        """
+        :param threads: The number of threads computing signatures.
+        :param max_memory: The maximum size in bytes of the signatures kept.
+        """
+        self.threads = threads
+        self.max_memory = max_memory
+        self.entries = OrderedDict()
+        self.memory = 0
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pid = None
+
+    def _pool(self):
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = ThreadPoolExecutor(self.threads, thread_name_prefix='delta-signatures')
+                self.pid = os.getpid()
+            return self.pool
+
+    def get(self, path):
+        """
+        :param path: The path of a regular file.
+        :return: A tuple of the block size, the os.stat_result the signatures are of
+        and the packed signatures of every full block.
+        :raises OSError: If the file can't be read or changed while it was signed.
+        """
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+                return cached
+        size = block_size(st.st_size)
+        blocks = st.st_size // size
+        step = max(1, -(-blocks // self.threads))
+        pool = self._pool()
+        futures = [pool.submit(sign_blocks, path, size, start, min(start + step, blocks))
+                   for start in range(0, blocks, step)]
+        signatures = b''.join(future.result() for future in futures)
+        after = os.stat(path)
+        if (after.st_size, after.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            raise OSError(f'{path} changed while it was signed')
+        entry = (size, st, signatures)
+        if len(signatures) <= self.max_memory:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = entry
+                    self.memory += len(signatures)
+                while self.memory > self.max_memory:
+                    self.memory -= len(self.entries.popitem(last=False)[1][2])
+        return entry
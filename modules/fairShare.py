@@ -0,0 +1,231 @@
+import io, threading, time
+
+# The directions of a transfer, each with its own bandwidth limits.
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+# Transfers are throttled in pieces of at most this many bytes so they stay smooth.
+SLICE_SIZE = 256*1024
+
+
+class TooManyTransfers(Exception):
+    """Raised when a transfer can't start, reason is 'server' or 'client'."""
+
+    def __init__(self, reason):
+        super().__init__(f'Too many transfers ({reason})')
+        self.reason = reason
+
+
+class TokenBucket:
+    """
+    A rate in bytes per second that allows bursts of up to burst bytes. Callers
+    reserve bytes and sleep for the returned delay, so no lock is held while waiting
+    and concurrent callers are served in the order they reserved.
+    """
+
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.empty_at = time.monotonic() - burst/rate # starts full
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+
+    def reserve(self, amount):
+        """:return: The seconds to wait before sending amount bytes."""
+        with self.lock:
+            now = time.monotonic()
+            self.empty_at = max(self.empty_at, now - self.burst/self.rate) + amount/self.rate
+            return max(0.0, self.empty_at - now)
+
+
+class Client:
+    def __init__(self):
+        self.transfers = {DOWNLOAD: 0, UPLOAD: 0}
+        self.waiting = 0
+        self.evicted = 0 # waiting transfers that must give up their place
+        self.buckets = {} # direction -> TokenBucket while it has transfers
+
+    def count(self):
+        return sum(self.transfers.values())
+
+
+class FairShare:
+    """
+    Share the threads and the bandwidth of a worker between clients, so one client
+    pulling a large zip doesn't slow down the others or the listings they load.
+
+    Downloads, archives and uploads are transfers. At most max_transfers run at
+    once, so the other threads are always free for small requests such as listings
+    which never wait here, and each client runs at most client_transfers of them.
+    A client over its limit waits for one of its transfers to end, up to wait
+    seconds, unless another client needs its place.
+
+    The bandwidth of each direction is limited by a token bucket per client whose
+    rate is the smallest of client_rate and an equal share of rate between the
+    clients transferring in that direction, so together they never exceed rate.
+    """
+
+    def __init__(self, rate=0, client_rate=0, max_transfers=0, client_transfers=0, wait=10, waited=None):
+        """
+        :param rate: The bytes per second of all the transfers in each direction, 0 for no limit.
+        :param client_rate: The bytes per second of each client in each direction, 0 for no limit.
+        :param max_transfers: The number of transfers running at once, 0 for no limit.
+        :param client_transfers: The number of transfers of a client running at once, 0 for no limit.
+        :param wait: The seconds a transfer waits for a client to end another.
+        :param waited: An optional function of (direction, seconds) called when a
+        transfer is slowed down, to report it.
+        """
+        self.rate = rate
+        self.client_rate = client_rate
+        self.max_transfers = max_transfers
+        self.client_transfers = client_transfers
+        self.wait = wait
+        self.waited = waited
+        self.clients = {}
+        self.transfers = 0 # running or waiting for the client limit
+        self.condition = threading.Condition()
+
+    def acquire(self, client, direction):
+        """
+        Start a transfer, waiting for the client to end another if it is at its limit.
+
+        :param client: The address of the client.
+        :param direction: DOWNLOAD or UPLOAD.
+        :return: A Transfer to release() once it is sent.
+        :raises TooManyTransfers: If the worker or the client has too many transfers.
+        """
+        with self.condition:
+            state = self.clients.setdefault(client, Client())
+            over_limit = self.client_transfers and state.count() >= self.client_transfers
+            if self.max_transfers and self.transfers >= self.max_transfers:
+                # a client waiting for its own transfers gives its place to a client
+                # under its limit, so one client can't take every place
+                waiting = next((s for s in self.clients.values() if s.waiting > s.evicted), None)
+                if waiting is None or over_limit:
+                    self._forget(client, state)
+                    raise TooManyTransfers('server')
+                waiting.evicted += 1
+                self.condition.notify_all()
+            else:
+                self.transfers += 1
+            if over_limit:
+                state.waiting += 1
+                started = self.condition.wait_for(
+                    lambda: state.evicted or state.count() < self.client_transfers, self.wait)
+                state.waiting -= 1
+                if state.evicted:
+                    state.evicted -= 1 # its place was given to another client
+                    self._forget(client, state)
+                    raise TooManyTransfers('client')
+                if not started:
+                    self.transfers -= 1
+                    self._forget(client, state)
+                    raise TooManyTransfers('client')
+            state.transfers[direction] += 1
+            self._share(direction)
+            return Transfer(self, client, state, direction)
+
+    def _forget(self, client, state):
+        if not state.count() and not state.waiting and self.clients.get(client) is state:
+            del self.clients[client]
+
+    def release(self, transfer):
+        with self.condition:
+            state = transfer.state
+            state.transfers[transfer.direction] -= 1
+            if not state.transfers[transfer.direction]:
+                state.buckets.pop(transfer.direction, None)
+            self._forget(transfer.client, state)
+            self.transfers -= 1
+            self._share(transfer.direction)
+            self.condition.notify_all()
+
+    def _share(self, direction):
+        # called with the lock held whenever the clients of a direction change
+        active = [state for state in self.clients.values() if state.transfers[direction]]
+        rates = [r for r in (self.client_rate, self.rate/len(active) if self.rate and active else 0) if r]
+        if not rates:
+            return
+        rate = min(rates)
+        for state in active:
+            bucket = state.buckets.get(direction)
+            if bucket is None:
+                state.buckets[direction] = TokenBucket(rate, min(rate, SLICE_SIZE*4))
+            else:
+                bucket.set_rate(rate)
+
+    def limited(self):
+        """:return: If transfers are throttled."""
+        return bool(self.rate or self.client_rate)
+
+
+class Transfer:
+    """A running transfer of a client, throttled by its token bucket."""
+
+    def __init__(self, scheduler, client, state, direction):
+        self.scheduler = scheduler
+        self.client = client
+        self.state = state
+        self.direction = direction
+        self.released = False
+
+    def throttle(self, amount):
+        """Sleep until amount bytes may be sent."""
+        bucket = self.state.buckets.get(self.direction)
+        if bucket is None:
+            return
+        delay = bucket.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+            if self.scheduler.waited is not None:
+                self.scheduler.waited(self.direction, delay)
+
+    def chunks(self, chunks):
+        """
+        Throttle a response body.
+
+        :param chunks: An iterable of bytes, closed when done if it has a close method.
+        :return: A generator of the same bytes.
+        """
+        try:
+            for data in chunks:
+                for start in range(0, len(data), SLICE_SIZE):
+                    piece = data[start:start + SLICE_SIZE]
+                    self.throttle(len(piece))
+                    yield piece
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def input(self, stream):
+        """:return: A wsgi.input that throttles reading a request body."""
+        return ThrottledInput(stream, self)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release(self)
+
+
+class ThrottledInput(io.RawIOBase):
+    """A request body whose reads wait for the token bucket of the transfer."""
+
+    def __init__(self, stream, transfer):
+        self.stream = stream
+        self.transfer = transfer
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(min(len(b), SLICE_SIZE))
+        self.transfer.throttle(len(data))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self, size=-1):
+        data = self.stream.readline(size)
+        self.transfer.throttle(len(data))
+        return data
@@ -0,0 +1,237 @@
+import os, zlib, hashlib, threading
+from collections import OrderedDict
+
+# Optional faster checksums. crc32 and sha256 are always available.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+READ_SIZE = 1024*1024
+
+
+class Crc32:
+    """A hashlib like wrapper of zlib.crc32."""
+
+    def __init__(self, value=0):
+        self.value = value
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f'{self.value:08x}'
+
+
+class Crc32c(Crc32):
+    """A hashlib like wrapper of the optional crc32c package."""
+
+    def update(self, data):
+        self.value = crc32c.crc32c(data, self.value)
+
+
+def new_hasher(algorithm):
+    """
+    Create a hasher for a checksum algorithm sent by a client.
+
+    :param algorithm: One of 'crc32', 'crc32c', 'xxh64' or 'sha256'.
+    :return: An object with update() and hexdigest() or None if not supported.
+    """
+    if algorithm == 'crc32':
+        return Crc32()
+    if algorithm == 'crc32c' and crc32c is not None:
+        return Crc32c()
+    if algorithm == 'xxh64' and xxhash is not None:
+        return xxhash.xxh64()
+    if algorithm == 'sha256':
+        return hashlib.sha256()
+    return None
+
+
+def parse_checksum(value):
+    """
+    Parse a checksum in the 'algorithm=hex' format, for example 'crc32=1a2b3c4d'.
+
+    :return: A tuple of (algorithm, hex) or None if it is malformed.
+    """
+    if not isinstance(value, str) or '=' not in value:
+        return None
+    algorithm, _, digest = value.partition('=')
+    return algorithm.strip().lower(), digest.strip().lower()
+
+
+def _gf2_times(matrix, vector):
+    result = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def crc32_shift_matrix(length):
+    """
+    Build the operator that appends length zero bytes to a crc32, as done by zlib's
+    crc32_combine(). Building it once per block size makes combining cheap.
+
+    :param length: The number of bytes of the second crc.
+    :return: A list of 32 rows to use with crc32_combine().
+    """
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    result = [1 << n for n in range(32)] # identity
+    while length:
+        even = _gf2_square(odd)
+        if length & 1:
+            result = [_gf2_times(even, row) for row in result]
+        length >>= 1
+        if not length:
+            break
+        odd = _gf2_square(even)
+        if length & 1:
+            result = [_gf2_times(odd, row) for row in result]
+        length >>= 1
+    return result
+
+
+def crc32_combine(crc1, crc2, shift_matrix):
+    """
+    Combine the crc32 of two consecutive pieces of data.
+
+    :param crc1: The crc32 of the first piece.
+    :param crc2: The crc32 of the second piece.
+    :param shift_matrix: crc32_shift_matrix() of the length of the second piece.
+    :return: The crc32 of both pieces.
+    """
+    return _gf2_times(shift_matrix, crc1) ^ crc2
+
+
+def combine_chunk_crcs(crcs, chunk_size, file_size):
+    """
+    Compute the crc32 of a file from the crc32 of each of its chunks.
+
+    :param crcs: The crc32 of every chunk in order.
+    :param chunk_size: The size of every chunk except the last one.
+    :param file_size: The size of the file.
+    :return: The crc32 of the whole file.
+    """
+    if not crcs:
+        return 0
+    full = crc32_shift_matrix(chunk_size)
+    last_length = file_size - (len(crcs) - 1)*chunk_size
+    last = full if last_length == chunk_size else crc32_shift_matrix(last_length)
+    value = crcs[0]
+    for i, crc in enumerate(crcs[1:], 1):
+        value = crc32_combine(value, crc, last if i == len(crcs) - 1 else full)
+    return value
+
+
+def format_digest(crc):
+    """:return: The digest string of a crc32 as used in the api."""
+    return f'crc32:{crc:08x}'
+
+
+class DigestIndex:
+    """
+    An in-memory LRU index of file digests keyed by (device, inode, size, mtime) so
+    a digest is dropped as soon as the file changes.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.digests = OrderedDict()
+        self.paths = {} # path -> (size, mtime, digest) to look up digests without a stat
+        self.lock = threading.Lock()
+
+    def peek(self, path, size, mtime):
+        """
+        Get a known digest using the size and mtime from a directory listing.
+
+        :param path: The path of a file.
+        :param size: The size of the file.
+        :param mtime: The mtime of the file in seconds.
+        :return: The digest string or None.
+        """
+        known = self.paths.get(path)
+        if known is not None and known[:2] == (size, mtime):
+            return known[2]
+        return None
+
+    @staticmethod
+    def key(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, path, compute=False):
+        """
+        :param path: The path of a file.
+        :param compute: If true, hash the file when its digest isn't known yet.
+        :return: The digest string or None.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        digest = self._known(st)
+        if digest is None and compute:
+            digest = self._compute(path, st)
+        return digest
+
+    def crc32(self, path, st):
+        """
+        Get the crc32 of a file, hashing it when it isn't known yet.
+
+        :param path: The path of a file.
+        :param st: The os.stat_result of the file the crc32 must match.
+        :return: The crc32 as an int.
+        :raises OSError: If the file can't be read or changed since st.
+        """
+        digest = self._known(st) or self._compute(path, st)
+        if digest is None:
+            raise OSError(f'{path} changed while hashing')
+        return int(digest.partition(':')[2], 16)
+
+    def _known(self, st):
+        key = self.key(st)
+        with self.lock:
+            known = self.digests.get(key)
+            if known is None:
+                return None
+            self.digests.move_to_end(key)
+            return known[1]
+
+    def _compute(self, path, st):
+        crc = 0
+        with open(path, 'rb') as f:
+            while data := f.read(READ_SIZE):
+                crc = zlib.crc32(data, crc)
+        if self.key(os.stat(path)) != self.key(st):
+            return None # modified while hashing
+        digest = format_digest(crc)
+        self.set_key(path, st, digest)
+        return digest
+
+    def set(self, path, digest):
+        """Record the digest of a file that was just written."""
+        self.set_key(path, os.stat(path), digest)
+
+    def set_key(self, path, st, digest):
+        with self.lock:
+            key = self.key(st)
+            self.digests[key] = (path, digest)
+            self.digests.move_to_end(key)
+            self.paths[path] = (st.st_size, int(st.st_mtime), digest)
+            while len(self.digests) > self.max_entries:
+                old_path, old_digest = self.digests.popitem(last=False)[1]
+                if self.paths.get(old_path, (0, 0, None))[2] == old_digest:
+                    del self.paths[old_path]
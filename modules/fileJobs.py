@@ -0,0 +1,371 @@
+import os, sqlite3, threading, time, json, errno, secrets, shutil
+from concurrent.futures import ThreadPoolExecutor
+from modules.contentIndex import reflink
+from modules.uploadSession import PART_SUFFIX
+
+# Bytes copied by one copy_file_range call, progress and cancellation are checked between calls.
+COPY_SIZE = 16*1024*1024
+READ_SIZE = 1024*1024
+# Progress is written to the database at most this often.
+PROGRESS_INTERVAL = 0.5
+# copy_file_range fails with these when it can't copy between the two files.
+COPY_RANGE_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+FINISHED = ('done', 'cancelled', 'interrupted')
+
+
+class Cancelled(Exception):
+    """The job was cancelled."""
+
+
+class JobError(Exception):
+    """An item of a job can't be done, the message is shown to the user."""
+
+
+def copy_file(source, destination, progress):
+    """
+    Copy the content of a file. It is cloned when the filesystem supports it,
+    otherwise copied by the kernel with copy_file_range without going through the
+    process, or read and written when that isn't supported either.
+
+    :param progress: A function called with the number of bytes copied since its
+    last call, which may raise Cancelled.
+    """
+    try:
+        reflink(source, destination)
+        progress(os.path.getsize(destination))
+        return
+    except OSError:
+        pass
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        if hasattr(os, 'copy_file_range'):
+            copied = 0
+            try:
+                while n := os.copy_file_range(src.fileno(), dst.fileno(), COPY_SIZE):
+                    copied += n
+                    progress(n)
+                return
+            except OSError as e:
+                if copied or e.errno not in COPY_RANGE_ERRORS:
+                    raise
+        while data := src.read(READ_SIZE):
+            dst.write(data)
+            progress(len(data))
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Job:
+    """The progress of a job running in this process."""
+
+    def __init__(self, jobs, job_id):
+        self.jobs = jobs
+        self.id = job_id
+        self.files = self.files_done = self.bytes = self.bytes_done = 0
+        self.current = None
+        self.errors = []
+        self.cancelled = False
+        self.finished = threading.Event()
+        self.flushed = 0
+
+    def add(self, files, size):
+        """Add files and bytes to the total."""
+        self.files += files
+        self.bytes += size
+
+    def progress(self, files=0, size=0, current=None):
+        """
+        Count files and bytes done.
+
+        :raises Cancelled: If the job was cancelled.
+        """
+        self.files_done += files
+        self.bytes_done += size
+        if current is not None:
+            self.current = current
+        if time.monotonic() - self.flushed > PROGRESS_INTERVAL:
+            self.flush('running')
+        if self.cancelled:
+            raise Cancelled()
+
+    def flush(self, state):
+        self.flushed = time.monotonic()
+        with self.jobs._connection() as db:
+            db.execute('UPDATE jobs SET state = ?, updated = ?, files = ?, files_done = ?, bytes = ?, bytes_done = ?, '
+                       'current = ?, errors = ? WHERE id = ?',
+                       (state, time.time(), self.files, self.files_done, self.bytes, self.bytes_done,
+                        self.jobs.relative(self.current), json.dumps(self.errors), self.id))
+            # a cancel sent to another worker
+            if db.execute('SELECT cancelled FROM jobs WHERE id = ?', (self.id,)).fetchone()[0]:
+                self.cancelled = True
+
+
+class FileJobs:
+    """
+    Deletes, moves and copies run by a pool of threads instead of the request
+    thread, since moving a folder between filesystems or deleting a large tree can
+    take longer than a request may. Their progress is stored in an sqlite database
+    shared by every gunicorn worker so any worker can report it or cancel them.
+
+    Moves are renames when possible. Copies, and moves between filesystems, are
+    written to a hidden part file or folder next to the destination which is renamed
+    into place once complete, so a cancelled or failed job leaves the source as it was
+    and no partial destination.
+    """
+
+    def __init__(self, path, root, updated, removed, moved, threads=2, max_age=24*3600):
+        """
+        :param path: The path of the database, shared by all workers.
+        :param root: The served folder, paths shown in the progress are relative to it.
+        :param updated: A function called with a path created or modified by a job.
+        :param removed: A function called with a path deleted by a job.
+        :param moved: A function called with the source and destination of a move.
+        :param threads: The number of jobs run at the same time by each worker.
+        :param max_age: Finished jobs older than this many seconds are forgotten.
+        """
+        self.path = path
+        self.root = root
+        self.updated = updated
+        self.removed = removed
+        self.moved = moved
+        self.threads = threads
+        self.max_age = max_age
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.running = {} # job id -> Job of the jobs started by this process
+        self.executor = None
+        self.pid = None
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, operation TEXT NOT NULL, '
+                       'state TEXT NOT NULL, pid INTEGER NOT NULL, created REAL NOT NULL, updated REAL NOT NULL, '
+                       'files INTEGER NOT NULL DEFAULT 0, files_done INTEGER NOT NULL DEFAULT 0, '
+                       'bytes INTEGER NOT NULL DEFAULT 0, bytes_done INTEGER NOT NULL DEFAULT 0, current TEXT, '
+                       "errors TEXT NOT NULL DEFAULT '[]', cancelled INTEGER NOT NULL DEFAULT 0)")
+            db.execute('DELETE FROM jobs WHERE updated < ?', (time.time() - self.max_age,))
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def relative(self, path):
+        if path is None:
+            return None
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def start(self, operation, items):
+        """
+        Start a job.
+
+        :param operation: 'delete', 'move' or 'copy'.
+        :param items: The absolute paths to delete, or (source, destination) tuples
+        of absolute paths to move or copy where destination is the final path.
+        :return: The id of the job.
+        """
+        job_id = secrets.token_urlsafe(12)
+        now = time.time()
+        with self._connection() as db:
+            db.execute('INSERT INTO jobs (id, operation, state, pid, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                       (job_id, operation, 'queued', os.getpid(), now, now))
+        job = Job(self, job_id)
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix='file-job')
+                self.pid = os.getpid()
+            self.running[job_id] = job
+            self.executor.submit(self._run, job, operation, items)
+        return job_id
+
+    def _run(self, job, operation, items):
+        state = 'done'
+        try:
+            job.flush('running')
+            if job.cancelled:
+                raise Cancelled()
+            run = {'delete': self._delete, 'move': self._move, 'copy': self._copy}[operation]
+            for item in items:
+                item = item if isinstance(item, tuple) else (item,)
+                try:
+                    run(job, *item)
+                except JobError as e:
+                    job.errors.append({'path': self.relative(item[0]), 'message': str(e)})
+                except OSError as e:
+                    print(f'{operation.capitalize()} error: {e}')
+                    job.errors.append({'path': self.relative(item[0]), 'message': e.strerror or str(e)})
+        except Cancelled:
+            state = 'cancelled'
+        except Exception as e:
+            print(f'{operation.capitalize()} error: {e}')
+            job.errors.append({'path': None, 'message': 'An unexpected error occurred'})
+        finally:
+            job.current = None
+            try:
+                job.flush(state)
+            finally:
+                with self.lock:
+                    del self.running[job.id]
+                job.finished.set()
+
+    def get(self, job_id):
+        """
+        :return: A dict of the state and progress of a job or None if it is unknown.
+        The state is 'queued', 'running', 'done', 'cancelled' or 'interrupted' when
+        the worker running it stopped.
+        """
+        row = self._connection().execute(
+            'SELECT operation, state, pid, files, files_done, bytes, bytes_done, current, errors FROM jobs '
+            'WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        operation, state, pid, files, files_done, size, bytes_done, current, errors = row
+        if state not in FINISHED and job_id not in self.running and not is_alive(pid):
+            state = 'interrupted'
+        return {'id': job_id, 'operation': operation, 'state': state, 'files': files, 'filesDone': files_done,
+                'bytes': size, 'bytesDone': bytes_done, 'current': current, 'errors': json.loads(errors)}
+
+    def wait(self, job_id, timeout):
+        """
+        Wait for a job started by this process to finish.
+
+        :return: Its state like get().
+        """
+        job = self.running.get(job_id)
+        if job is not None:
+            job.finished.wait(timeout)
+        return self.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel a job, which stops after the file being copied or deleted.
+
+        :return: If the job was queued or running.
+        """
+        with self._connection() as db:
+            cancelled = db.execute("UPDATE jobs SET cancelled = 1 WHERE id = ? AND state IN ('queued', 'running')",
+                                   (job_id,)).rowcount > 0
+        job = self.running.get(job_id)
+        if cancelled and job is not None:
+            job.cancelled = True
+        return cancelled
+
+    def _count(self, job, path, follow=False):
+        """Add the files and bytes under a path to the total of a job."""
+        if not os.path.isdir(path) or (os.path.islink(path) and not follow):
+            job.add(1, os.lstat(path).st_size)
+            return
+        for directory, dirnames, filenames in os.walk(path):
+            for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(directory, d))]:
+                try:
+                    job.add(1, os.lstat(os.path.join(directory, name)).st_size)
+                except OSError:
+                    pass
+
+    def _delete(self, job, path):
+        if not os.path.lexists(path):
+            raise JobError('File/folder not found')
+        self._count(job, path)
+        try:
+            if os.path.islink(path) or not os.path.isdir(path):
+                os.remove(path)
+                job.progress(1, current=path)
+            else:
+                self._remove_tree(path, job)
+        finally:
+            if os.path.lexists(path):
+                self.updated(path) # partly deleted
+            else:
+                self.removed(path)
+
+    def _remove_tree(self, path, job=None):
+        # symbolic links to folders are removed, never followed
+        for directory, dirnames, filenames in os.walk(path, topdown=False):
+            for name in filenames:
+                os.remove(os.path.join(directory, name))
+                if job is not None:
+                    job.progress(1, current=directory)
+            for name in dirnames:
+                child = os.path.join(directory, name)
+                if os.path.islink(child):
+                    os.remove(child)
+                    if job is not None:
+                        job.progress(1, current=directory)
+                else:
+                    os.rmdir(child)
+        os.rmdir(path)
+
+    def _move(self, job, source, destination):
+        if not os.path.lexists(source):
+            raise JobError('File/folder not found')
+        # rename replaces an existing file, which a move never does, like a copy
+        if os.path.lexists(destination) and destination != source:
+            raise JobError(f'{self.relative(destination)} already exists')
+        job.progress(current=source)
+        try:
+            os.rename(source, destination)
+            job.add(1, 0)
+            job.progress(1)
+            self.moved(source, destination)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        # across filesystems, copy then delete the source
+        self._copy_into_place(job, source, destination, os.replace)
+        if os.path.islink(source) or not os.path.isdir(source):
+            os.remove(source)
+        else:
+            self._remove_tree(source)
+        self.moved(source, destination)
+
+    def _copy(self, job, source, destination):
+        if not os.path.exists(source):
+            raise JobError('File/folder not found')
+        if os.path.lexists(destination):
+            raise JobError(f'{self.relative(destination)} already exists')
+        self._copy_into_place(job, source, destination, os.rename)
+        self.updated(destination)
+
+    def _copy_into_place(self, job, source, destination, rename):
+        self._count(job, source, follow=True)
+        directory, name = os.path.split(destination)
+        temporary = os.path.join(directory, f'.{name}.{secrets.token_hex(4)}{PART_SUFFIX}')
+        try:
+            # the source itself is followed, like the linked folders at the root
+            self._copy_tree(job, source, temporary, follow=True)
+            rename(temporary, destination)
+        except BaseException:
+            if os.path.isdir(temporary) and not os.path.islink(temporary):
+                shutil.rmtree(temporary, ignore_errors=True)
+            elif os.path.lexists(temporary):
+                os.remove(temporary)
+            raise
+
+    def _copy_tree(self, job, source, destination, follow=False):
+        if os.path.islink(source) and not follow:
+            os.symlink(os.readlink(source), destination)
+            job.progress(1, current=source)
+        elif os.path.isdir(source):
+            os.mkdir(destination)
+            with os.scandir(source) as entries:
+                names = sorted(entry.name for entry in entries)
+            for name in names:
+                self._copy_tree(job, os.path.join(source, name), os.path.join(destination, name))
+            shutil.copystat(source, destination)
+        elif os.path.isfile(source):
+            job.progress(current=source)
+            copy_file(source, destination, lambda size: job.progress(size=size))
+            shutil.copystat(source, destination)
+            job.progress(1)
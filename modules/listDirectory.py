@@ -0,0 +1,117 @@
+import os
+from modules.uploadSession import is_upload_file
+
+def scan_directory(path):
+    """
+    Read a single directory level with os.scandir. Files of unfinished uploads are skipped.
+
+    :param path: The absolute path of the directory to read.
+    :return: A list of (name, is_dir, size, mtime) tuples sorted by name.
+    """
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if is_upload_file(entry.name):
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=True)
+                stat = entry.stat(follow_symlinks=True)
+            except OSError:
+                # broken symlinks or files removed while scanning
+                continue
+            entries.append((entry.name, is_dir, 0 if is_dir else stat.st_size, int(stat.st_mtime)))
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+
+def list_directory(root, depth=1, cursor='', limit=1000, scan=scan_directory):
+    """
+    List a directory one level at a time in a stable depth first order so the
+    listing can be paginated with a cursor.
+
+    Entries are ordered so that the relative path of every entry, split into its
+    components, sorts after the one before it. This lets a cursor, which is just
+    the relative path of the last entry returned, skip whole subtrees that were
+    already sent without reading them again.
+
+    :param root: The absolute path of the directory to list.
+    :param depth: How many directory levels to descend. 1 only lists root itself.
+    :param cursor: The relative path of the last entry of the previous page.
+    :param limit: The maximum number of entries to return.
+    :param scan: The function used to read a single directory level.
+    :return: A tuple of the list of entry dicts and the cursor of the next page
+    (None when there are no more entries).
+    """
+    cursor_parts = tuple(p for p in cursor.split('/') if p) if cursor else ()
+    results = []
+    # realpaths of the directories being descended to detect symlink loops.
+    ancestors = {os.path.realpath(root)}
+
+    def walk(path, prefix, level):
+        try:
+            entries = scan(path)
+        except OSError:
+            return True
+        for name, is_dir, size, mtime in entries:
+            parts = prefix + (name,)
+            if cursor_parts and parts <= cursor_parts:
+                if parts != cursor_parts[:len(parts)]:
+                    continue # this entry and its subtree were on a previous page
+                # the cursor itself or one of its parents, only descend into it
+            else:
+                if len(results) >= limit:
+                    return False
+                results.append({
+                    'name': name,
+                    'path': '/'.join(parts),
+                    'type': 'folder' if is_dir else 'file',
+                    'size': size,
+                    'mtime': mtime,
+                })
+
+            if is_dir and level < depth:
+                child = os.path.join(path, name)
+                real = os.path.realpath(child)
+                if real in ancestors:
+                    continue # symlink loop
+                ancestors.add(real)
+                finished = walk(child, parts, level + 1)
+                ancestors.discard(real)
+                if not finished:
+                    return False
+        return True
+
+    if walk(root, (), 1):
+        return results, None
+    return results, results[-1]['path']
+
+
+def walk_directory(root, scan=scan_directory):
+    """
+    Recursively walk a directory following symbolic links while skipping symlink loops.
+
+    :param root: The absolute path of the directory to walk.
+    :param scan: The function used to read a single directory level.
+    :return: A generator of (relative_path, is_dir, size, mtime) tuples.
+    """
+    # realpaths of the directories being descended to detect symlink loops.
+    ancestors = {os.path.realpath(root)}
+
+    def walk(path, prefix):
+        try:
+            entries = scan(path)
+        except OSError:
+            return
+        for name, is_dir, size, mtime in entries:
+            relative_path = prefix + name
+            yield relative_path, is_dir, size, mtime
+            if is_dir:
+                child = os.path.join(path, name)
+                real = os.path.realpath(child)
+                if real in ancestors:
+                    continue # symlink loop
+                ancestors.add(real)
+                yield from walk(child, relative_path + '/')
+                ancestors.discard(real)
+
+    yield from walk(root, '')
@@ -0,0 +1,333 @@
+import os, stat, threading, struct, ctypes, ctypes.util, errno, time
+from collections import OrderedDict
+from modules.listDirectory import scan_directory
+from modules.uploadSession import is_upload_file
+
+# inotify constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+# rough memory used by a cached directory and by each of its entries.
+DIRECTORY_OVERHEAD = 512
+ENTRY_OVERHEAD = 160
+
+
+def stat_entry(path):
+    """:return: The (name, is_dir, size, mtime) tuple of a path like scan_directory() or None."""
+    name = os.path.basename(path)
+    if is_upload_file(name):
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    is_dir = stat.S_ISDIR(st.st_mode)
+    return (name, is_dir, 0 if is_dir else st.st_size, int(st.st_mtime))
+
+
+class InotifyWatcher:
+    """
+    A minimal inotify binding using ctypes. A daemon thread reads the events and
+    passes them to a callback.
+    """
+
+    def __init__(self, callback):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.callback = callback
+        thread = threading.Thread(target=self._read_events, name='inotify', daemon=True)
+        thread.start()
+
+    def add_watch(self, path):
+        """
+        :return: The watch descriptor or -1 if the path cannot be watched.
+        """
+        return self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+
+    def remove_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, 64*1024)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                print(f'inotify error: {e}')
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset+length].rstrip(b'\0'))
+                offset += length
+                self.callback(wd, mask, name)
+
+
+class MetadataCache:
+    """
+    An in-memory LRU cache of directory listings with the size and mtime of each entry.
+
+    Cached directories are watched with inotify on linux so they are patched as
+    entries change. Without inotify, a directory is rescanned when its mtime changes
+    which means size changes of existing files are only seen after the directory
+    itself changes or is evicted.
+    """
+
+    def __init__(self, max_memory, on_scan=None, on_change=None):
+        """
+        :param max_memory: The approximate number of bytes the cache may use before
+        evicting the least recently used directories.
+        :param on_scan: Called with the seconds spent reading a directory from the
+        filesystem on every cache miss.
+        :param on_change: Called from the inotify thread with each path changed in a
+        watched directory, or None when events were lost.
+        """
+        self.max_memory = max_memory
+        self.on_scan = on_scan
+        self.on_change = on_change
+        self.memory = 0
+        self.directories = OrderedDict() # path -> dict of the cached directory
+        self.watches = {} # watch descriptor -> set of cached paths
+        self.pending = {} # paths being scanned -> if they changed while scanning
+        self.lock = threading.RLock()
+        self.watcher = None
+        self.watcher_failed = False
+
+    def scan(self, path):
+        """
+        A cached replacement of scan_directory().
+
+        :param path: The absolute path of the directory to read.
+        :return: A list of (name, is_dir, size, mtime) tuples sorted by name.
+        """
+        path = os.path.normpath(path)
+        with self.lock:
+            directory = self.directories.get(path)
+            if directory is not None and directory['wd'] < 0:
+                # not watched, fallback to checking the mtime of the directory
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError:
+                    mtime_ns = None
+                if mtime_ns != directory['mtime_ns']:
+                    self._drop(path)
+                    directory = None
+            if directory is not None:
+                self.directories.move_to_end(path)
+                if directory['sorted'] is None:
+                    directory['sorted'] = sorted(directory['entries'].values())
+                return directory['sorted']
+
+        # scan outside of the lock so slow disks don't block other requests
+        wd = self._watch(path)
+        start = time.perf_counter()
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            entries = scan_directory(path)
+        except OSError:
+            with self.lock:
+                self._unwatch(wd, path)
+            raise
+        finally:
+            if self.on_scan is not None:
+                self.on_scan(time.perf_counter() - start)
+        with self.lock:
+            changed = self.pending.pop(path, False)
+            if changed or path in self.directories:
+                # modified while scanning (or scanned twice at once), don't cache it
+                if path not in self.directories:
+                    self._unwatch(wd, path)
+                return entries
+            self.directories[path] = {
+                'entries': {e[0]: e for e in entries},
+                'sorted': entries,
+                'mtime_ns': mtime_ns,
+                'wd': wd,
+                'memory': DIRECTORY_OVERHEAD + sum(ENTRY_OVERHEAD + len(e[0]) for e in entries),
+            }
+            self.memory += self.directories[path]['memory']
+            self._evict()
+        return entries
+
+    def lookup(self, path):
+        """
+        Get the cached metadata of a single path from the listing of its parent.
+        A path missing from the listing is checked on disk, since it may have been
+        created by another program or worker before inotify or the mtime check saw it.
+
+        :param path: An absolute path.
+        :return: A (name, is_dir, size, mtime) tuple or None if it doesn't exist.
+        """
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+        try:
+            entries = self.scan(parent)
+        except OSError:
+            return None
+        with self.lock:
+            directory = self.directories.get(parent)
+            entry = directory['entries'].get(name) if directory is not None else None
+        if directory is None:
+            entry = next((e for e in entries if e[0] == name), None)
+        if entry is not None:
+            return entry
+        entry = stat_entry(path)
+        if entry is not None:
+            with self.lock:
+                directory = self.directories.get(parent)
+                if directory is not None:
+                    self._set_entry(directory, name, entry)
+        return entry
+
+    def update_path(self, path):
+        """
+        Refresh a single path in the listing of its parent without rescanning.
+        Used by the endpoints that modify files.
+
+        :param path: The absolute path that was created or modified.
+        """
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+        entry = stat_entry(path)
+        if entry is None:
+            self.remove_path(path)
+            return
+        with self.lock:
+            directory = self.directories.get(parent)
+            if directory is None:
+                return
+            self._set_entry(directory, name, entry)
+            self._refresh_mtime(parent, directory)
+
+    def remove_path(self, path):
+        """
+        Remove a deleted or moved path from the cache including everything under it.
+
+        :param path: The absolute path that was removed.
+        """
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+        with self.lock:
+            prefix = path + os.sep
+            for cached in [p for p in self.directories if p == path or p.startswith(prefix)]:
+                self._drop(cached)
+            directory = self.directories.get(parent)
+            if directory is not None:
+                self._set_entry(directory, name, None)
+                self._refresh_mtime(parent, directory)
+
+    def makedirs(self, path):
+        """
+        os.makedirs() that adds the created directories to the cache.
+
+        :param path: The absolute path of the directory to create.
+        """
+        missing = []
+        current = os.path.normpath(path)
+        while current and not os.path.isdir(current):
+            missing.append(current)
+            current = os.path.dirname(current)
+        os.makedirs(path, exist_ok=True)
+        for created in reversed(missing):
+            self.update_path(created)
+
+    def clear(self):
+        with self.lock:
+            for path in list(self.directories):
+                self._drop(path)
+
+    def _set_entry(self, directory, name, entry):
+        old = directory['entries'].pop(name, None)
+        if old is not None:
+            directory['memory'] -= ENTRY_OVERHEAD + len(name)
+            self.memory -= ENTRY_OVERHEAD + len(name)
+        if entry is not None:
+            directory['entries'][name] = entry
+            directory['memory'] += ENTRY_OVERHEAD + len(name)
+            self.memory += ENTRY_OVERHEAD + len(name)
+        directory['sorted'] = None
+
+    def _refresh_mtime(self, path, directory):
+        # our own changes should not make the mtime fallback rescan the directory
+        if directory['wd'] < 0:
+            try:
+                directory['mtime_ns'] = os.stat(path).st_mtime_ns
+            except OSError:
+                self._drop(path)
+
+    def _drop(self, path):
+        directory = self.directories.pop(path, None)
+        if directory is None:
+            return
+        self.memory -= directory['memory']
+        self._unwatch(directory['wd'], path)
+
+    def _unwatch(self, wd, path):
+        self.pending.pop(path, None)
+        if wd < 0:
+            return
+        paths = self.watches.get(wd, set())
+        paths.discard(path)
+        if not paths:
+            self.watches.pop(wd, None)
+            self.watcher.remove_watch(wd)
+
+    def _evict(self):
+        while self.memory > self.max_memory and len(self.directories) > 1:
+            self._drop(next(iter(self.directories)))
+
+    def _watch(self, path):
+        # start watching lazily so the thread is created in the worker process
+        with self.lock:
+            if self.watcher is None and not self.watcher_failed:
+                try:
+                    self.watcher = InotifyWatcher(self._on_event)
+                except (OSError, AttributeError):
+                    # not linux, fallback to mtime checks
+                    self.watcher_failed = True
+            if self.watcher is None:
+                return -1
+            wd = self.watcher.add_watch(path)
+            if wd >= 0:
+                self.watches.setdefault(wd, set()).add(path)
+                self.pending[path] = False
+            return wd
+
+    def _on_event(self, wd, mask, name):
+        with self.lock:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost so nothing in the cache can be trusted
+                self.clear()
+                if self.on_change is not None:
+                    self.on_change(None)
+                return
+            paths = list(self.watches.get(wd, ()))
+            for path in paths:
+                if path in self.pending:
+                    self.pending[path] = True
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                for path in paths:
+                    self._drop(path)
+                return
+        for path in paths:
+            if name:
+                self.update_path(os.path.join(path, name))
+                if self.on_change is not None:
+                    self.on_change(os.path.join(path, name))
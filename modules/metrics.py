@@ -0,0 +1,220 @@
+import os, json, math, threading, time, glob
+
+# The upper bounds in seconds of the latency histograms.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """The base of metrics with labels, rendered in the prometheus text format."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {} # label values -> value
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        """:return: A json serializable copy of the values."""
+        with self.lock:
+            return [[list(k), v] for k, v in self.values.items()]
+
+    def merge(self, values, snapshot):
+        """Add a snapshot of the same metric from another worker to values."""
+        for key, value in snapshot:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def samples(self, values):
+        for key, value in values.items():
+            yield self.name, format_labels(self.labels, key), value
+
+    def render(self, snapshots=()):
+        """
+        :param snapshots: Snapshots of this metric from other workers to add.
+        :return: The metric in the prometheus text format.
+        """
+        values = {tuple(k): v for k, v in self.snapshot()}
+        for snapshot in snapshots:
+            self.merge(values, snapshot)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {format_value(value)}' for name, labels, value in self.samples(values)]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # the count of each bucket followed by the sum of the values
+                counts = self.values[labels] = [0]*len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(k), list(v)] for k, v in self.values.items()]
+
+    def merge(self, values, snapshot):
+        for key, counts in snapshot:
+            key = tuple(key)
+            if key in values:
+                values[key] = [a + b for a, b in zip(values[key], counts)]
+            else:
+                values[key] = counts
+
+    def samples(self, values):
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f'{self.name}_bucket', format_labels(self.labels + ('le',), key + (format_value(bound),)), cumulative
+            yield f'{self.name}_sum', format_labels(self.labels, key), counts[-1]
+            yield f'{self.name}_count', format_labels(self.labels, key), cumulative
+
+
+class Registry:
+    """
+    The metrics of one process. With several gunicorn workers, each worker writes a
+    snapshot of its metrics to a shared directory every few seconds and render()
+    adds the snapshots of the other workers, so any worker can answer a scrape.
+    """
+
+    def __init__(self, shared_dir=None, interval=5):
+        """
+        :param shared_dir: A directory shared by the workers or None for one process.
+        :param interval: How often in seconds the snapshot is written.
+        """
+        self.metrics = []
+        self.collectors = []
+        self.shared_dir = shared_dir
+        self.interval = interval
+        self.thread = None
+        self.pid = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def collector(self, function):
+        """
+        Add a function returning prometheus text computed at scrape time, for values
+        that are already shared by the workers.
+        """
+        self.collectors.append(function)
+        return function
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.shared_dir, f'metrics-{pid}.json')
+
+    def start(self):
+        """Start writing snapshots in this process, once per worker."""
+        if self.shared_dir is None or self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        data = {m.name: m.snapshot() for m in self.metrics}
+        path = self._snapshot_path(os.getpid())
+        try:
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(f'{path}.tmp', path)
+        except OSError:
+            pass
+
+    def _other_snapshots(self):
+        snapshots = []
+        if self.shared_dir is None:
+            return snapshots
+        for path in glob.glob(os.path.join(self.shared_dir, 'metrics-*.json')):
+            try:
+                pid = int(os.path.basename(path)[8:-5])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                # a worker that exited, its counts are lost like a restarted process
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        """:return: Every metric in the prometheus text format."""
+        snapshots = self._other_snapshots()
+        parts = [m.render([s[m.name] for s in snapshots if m.name in s]) for m in self.metrics]
+        parts += [collector() for collector in self.collectors]
+        return '\n'.join(parts) + '\n'
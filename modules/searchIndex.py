@@ -0,0 +1,578 @@
+import os, re, stat, threading, time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from modules.listDirectory import scan_directory, walk_directory
+
+# The number of changes kept on top of the index before it is rebuilt.
+COMPACT_LIMIT = 100000
+# How often in seconds the partial index is published while it is first built.
+PUBLISH_INTERVAL = 1
+
+
+def bracket_end(pattern, i):
+    """:return: The index of the ']' closing a '[' just before i or -1."""
+    j = i + 1 if pattern[i:i + 1] == '!' else i
+    if pattern[j:j + 1] == ']':
+        j += 1
+    return pattern.find(']', j)
+
+
+def glob_to_regex(pattern):
+    """
+    Translate a glob matching a whole name into a regex matching the name with the
+    newline before it in the names joined by newlines. Starting with a literal
+    newline lets the regex engine skip quickly to the start of each name.
+    Supports *, ? and [...] like fnmatch.
+
+    :param pattern: A glob like '*.jp?g'.
+    :return: A regex string.
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            parts.append('[^\n]*')
+        elif c == '?':
+            parts.append('[^\n]')
+        elif c == '[':
+            end = bracket_end(pattern, i)
+            if end == -1:
+                parts.append('\\[')
+                continue
+            body = pattern[i:end].replace('\\', '\\\\')
+            i = end + 1
+            if body.startswith('!'):
+                parts.append('[^\n' + body[1:] + ']')
+            elif body.startswith('^'):
+                parts.append('[\\' + body + ']')
+            else:
+                parts.append('[' + body + ']')
+        else:
+            parts.append(re.escape(c))
+    return '\n' + ''.join(parts) + '(?=\n)'
+
+
+def glob_literal(pattern):
+    """
+    :param pattern: A glob.
+    :return: A tuple of the literal to find in the names joined by newlines and
+    the length of the newline added before it, when the glob is only a literal
+    with * at its ends, or None.
+    """
+    core = pattern.strip('*')
+    if not core or any(c in core for c in '*?['):
+        return None
+    starts, ends = not pattern.startswith('*'), not pattern.endswith('*')
+    return ('\n' if starts else '') + core + ('\n' if ends else ''), 1 if starts else 0
+
+
+class IndexSnapshot:
+    """
+    The entries of the index in breadth first order, so the children of every
+    directory are consecutive and sorted by name, and the descendants of a
+    directory at each depth are consecutive too. Names are kept in one string
+    joined by newlines, and lowercased in another, so they can be searched with
+    str.find or a regex without a python loop over every entry. Once complete, the
+    files sorted by size, the entries sorted by mtime and the folders are kept to
+    answer searches without a name.
+
+    The arrays are only appended to, a snapshot only uses its first count entries.
+    """
+
+    def __init__(self, generation, count, names, folded, offsets, folded_offsets,
+                 parents, first_children, child_counts, sizes, mtimes):
+        self.generation = generation
+        self.count = count
+        self.names = names
+        self.folded = folded
+        self.offsets = offsets
+        self.folded_offsets = folded_offsets
+        self.parents = parents
+        self.first_children = first_children # -1 for files
+        self.child_counts = child_counts
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.orders = None
+
+    def sort(self):
+        """Compute the orders used by searches without a name."""
+        files = [i for i in range(1, self.count) if self.first_children[i] < 0]
+        by_size = array('i', sorted(files, key=self.sizes.__getitem__))
+        by_mtime = array('i', sorted(range(1, self.count), key=self.mtimes.__getitem__))
+        self.orders = {
+            'size': (by_size, array('q', (self.sizes[i] for i in by_size))),
+            'mtime': (by_mtime, array('q', (self.mtimes[i] for i in by_mtime))),
+            'folder': array('i', (i for i in range(1, self.count) if self.first_children[i] >= 0)),
+        }
+
+    def name(self, i):
+        start = self.offsets[i]
+        return self.names[start:self.names.index('\n', start)]
+
+    def folded_name(self, i):
+        start = self.folded_offsets[i]
+        return self.folded[start:self.folded.index('\n', start)]
+
+    def folded_end(self, i):
+        """:return: The position in the folded names where entry i starts, or the end."""
+        return self.folded_offsets[i] if i < self.count else len(self.folded)
+
+    def is_dir(self, i):
+        return self.first_children[i] >= 0
+
+    def child(self, i, name):
+        """:return: The index of the child of directory i with this name or None."""
+        if self.first_children[i] < 0:
+            return None
+        lo = self.first_children[i]
+        end = hi = min(lo + self.child_counts[i], self.count)
+        while lo < hi:
+            mid = (lo + hi)//2
+            if self.name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < end and self.name(lo) == name:
+            return lo
+        return None
+
+    def descendants(self, i):
+        """:return: A list of (start, stop) index ranges of the descendants of i, one per depth."""
+        if i == 0:
+            return [(1, self.count)]
+        ranges = []
+        lo, hi = i, i + 1
+        while True:
+            # the children of the directories from lo to hi are consecutive
+            first, last = lo, hi - 1
+            while first <= last and self.child_counts[first] == 0:
+                first += 1
+            while last >= first and self.child_counts[last] == 0:
+                last -= 1
+            if first > last:
+                return ranges
+            lo = self.first_children[first]
+            hi = min(self.first_children[last] + self.child_counts[last], self.count)
+            if lo >= hi:
+                return ranges
+            ranges.append((lo, hi))
+
+    def entry_of(self, position):
+        """:return: The index of the entry whose name contains a position of the folded names."""
+        return bisect_right(self.folded_offsets, position, 0, self.count) - 1
+
+
+class SearchIndex:
+    """
+    An in memory index of the names of every file and directory under a root,
+    searched by substring, glob, extension, type, size and mtime.
+
+    The index is built in a background thread, publishing what it has found every
+    second the first time. Changes made through the endpoints are applied with
+    update_path() and remove_path() on top of the built index, which is rebuilt
+    once there are too many of them or every rebuild_interval seconds to see
+    changes made outside of the server.
+    """
+
+    def __init__(self, root, rebuild_interval=3600):
+        """
+        :param root: The absolute path of the directory to index.
+        :param rebuild_interval: Seconds between rebuilds or 0 to only rebuild
+        after many changes.
+        """
+        self.root = os.path.normpath(root)
+        self.rebuild_interval = rebuild_interval
+        self.snapshot = IndexSnapshot(0, 1, '\n', '\n', array('q', [0]), array('q', [0]), array('i', [0]),
+                                      array('i', [0]), array('i', [0]), array('q', [0]), array('q', [0]))
+        self.complete = False
+        self.overlay = {} # relative path -> (is_dir, size, mtime) of entries not in the snapshot
+        self.tombstones = set() # indexes of removed snapshot entries
+        self.attributes = {} # index -> (size, mtime) of modified snapshot entries
+        self.journal = None # paths changed while building, applied again to the new snapshot
+        self.lock = threading.RLock()
+        self.rebuild = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start building the index in a background thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._build_loop, name='search-index', daemon=True)
+            self.thread.start()
+
+    def _build_loop(self):
+        while True:
+            try:
+                self._build()
+            except Exception as e:
+                print(f'Search index error: {e}')
+            self.rebuild.wait(self.rebuild_interval or None)
+            self.rebuild.clear()
+
+    def _build(self):
+        with self.lock:
+            self.journal = []
+            generation = self.snapshot.generation + 1
+        names, folded = ['\n'], ['\n']
+        names_length = folded_length = 1
+        names_blob = folded_blob = ''
+        offsets, folded_offsets = array('q', [0]), array('q', [0])
+        parents, first_children, child_counts = array('i', [0]), array('i', [0]), array('i', [0])
+        sizes, mtimes = array('q', [0]), array('q', [0])
+        queue = deque([(0, self.root)])
+        # realpaths of the directories queued, to skip symlink loops and duplicates
+        visited = {os.path.realpath(self.root)}
+        last_publish = time.monotonic()
+
+        def publish():
+            nonlocal names_blob, folded_blob
+            names_blob += ''.join(names)
+            folded_blob += ''.join(folded)
+            names.clear()
+            folded.clear()
+            return IndexSnapshot(generation, len(parents), names_blob, folded_blob, offsets, folded_offsets,
+                                 parents, first_children, child_counts, sizes, mtimes)
+
+        while queue:
+            i, path = queue.popleft()
+            try:
+                entries = scan_directory(path)
+            except OSError:
+                entries = []
+            first_children[i] = len(parents)
+            for name, is_dir, size, mtime in entries:
+                if is_dir:
+                    child_path = os.path.join(path, name)
+                    real = os.path.realpath(child_path)
+                    if real not in visited:
+                        visited.add(real)
+                        queue.append((len(parents), child_path))
+                parents.append(i)
+                first_children.append(0 if is_dir else -1)
+                child_counts.append(0)
+                sizes.append(size)
+                mtimes.append(mtime)
+                offsets.append(names_length)
+                names.append(name + '\n')
+                names_length += len(name) + 1
+                lower = name.lower()
+                folded_offsets.append(folded_length)
+                folded.append(lower + '\n')
+                folded_length += len(lower) + 1
+            child_counts[i] = len(entries)
+            if not self.complete and time.monotonic() - last_publish > PUBLISH_INTERVAL:
+                # searches see the index grow while it is first built
+                snapshot = publish()
+                with self.lock:
+                    self.snapshot = snapshot
+                last_publish = time.monotonic()
+
+        snapshot = publish()
+        snapshot.sort()
+        with self.lock:
+            self.snapshot = snapshot
+            self.overlay = {}
+            self.tombstones = set()
+            self.attributes = {}
+            self.complete = True
+            journal, self.journal = self.journal, None
+        for path in journal:
+            self.update_path(path)
+
+    def _relative(self, path):
+        relative = os.path.relpath(os.path.normpath(path), self.root)
+        if relative == '.' or relative == '..' or relative.startswith('..' + os.sep):
+            return None
+        return relative.replace(os.sep, '/')
+
+    def _find(self, snapshot, relative):
+        """:return: The index of a path in the snapshot if it wasn't removed or None."""
+        i = 0
+        for name in relative.split('/'):
+            i = snapshot.child(i, name)
+            if i is None or i in self.tombstones:
+                return None
+        return i
+
+    def _exists(self, snapshot, relative):
+        return relative in self.overlay or self._find(snapshot, relative) is not None
+
+    def update_path(self, path):
+        """
+        Add or refresh a created or modified path. The content of a new directory,
+        like one that was moved, is added too.
+
+        :param path: An absolute path under the root.
+        """
+        relative = self._relative(path)
+        if relative is None:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.remove_path(path)
+            return
+        is_dir = stat.S_ISDIR(st.st_mode)
+        with self.lock:
+            if self.journal is not None:
+                self.journal.append(path)
+            added = self._set(relative, is_dir, 0 if is_dir else st.st_size, int(st.st_mtime))
+        if added and is_dir:
+            for relative_path, child_is_dir, size, mtime in walk_directory(path):
+                with self.lock:
+                    self._set(f'{relative}/{relative_path}', child_is_dir, size, mtime)
+        self._check_size()
+
+    def _set(self, relative, is_dir, size, mtime):
+        """:return: If the path is new to the index."""
+        snapshot = self.snapshot
+        i = self._find(snapshot, relative)
+        if i is not None:
+            if snapshot.is_dir(i) == is_dir:
+                if not is_dir:
+                    self.attributes[i] = (size, mtime)
+                return False
+            self.tombstones.add(i) # replaced by a directory or a file
+        new = relative not in self.overlay or self.overlay[relative][0] != is_dir
+        self.overlay[relative] = (is_dir, size, mtime)
+        parent = relative.rpartition('/')[0]
+        while parent and not self._exists(snapshot, parent):
+            self.overlay[parent] = (True, 0, mtime)
+            parent = parent.rpartition('/')[0]
+        return new
+
+    def remove_path(self, path):
+        """
+        Remove a deleted or moved path including everything under it.
+
+        :param path: An absolute path under the root.
+        """
+        relative = self._relative(path)
+        if relative is None:
+            return
+        with self.lock:
+            if self.journal is not None:
+                self.journal.append(path)
+            i = self._find(self.snapshot, relative)
+            if i is not None:
+                self.tombstones.add(i)
+                self.attributes.pop(i, None)
+            prefix = relative + '/'
+            for key in [k for k in self.overlay if k == relative or k.startswith(prefix)]:
+                del self.overlay[key]
+        self._check_size()
+
+    def _check_size(self):
+        if len(self.overlay) + len(self.tombstones) + len(self.attributes) > COMPACT_LIMIT:
+            self.rebuild.set()
+
+    def __len__(self):
+        """:return: The approximate number of entries indexed."""
+        return self.snapshot.count - 1 + len(self.overlay) - len(self.tombstones)
+
+    def _path(self, snapshot, i, folder_index=0):
+        """
+        :return: The relative path of a snapshot entry or None if it was removed or
+        is not under the folder.
+        """
+        parts = []
+        inside = folder_index == 0
+        j = i
+        while j > 0:
+            if j in self.tombstones:
+                return None
+            if j == folder_index and j != i:
+                inside = True
+            parts.append(snapshot.name(j))
+            j = snapshot.parents[j]
+        return '/'.join(reversed(parts)) if inside else None
+
+    def search(self, query='', glob=None, extensions=(), kind=None, min_size=None, max_size=None,
+               after=None, before=None, folder='', cursor=None, limit=100):
+        """
+        Find entries whose name matches every given filter. Size filters only match
+        files. Results are in index order, or by size or mtime when only those are
+        filtered, followed by the entries changed since the index was built.
+
+        :param query: A case insensitive substring of the name.
+        :param glob: A case insensitive glob matching the whole name.
+        :param extensions: File extensions without the dot, any of them matches.
+        :param kind: 'file', 'folder' or None for both.
+        :param min_size: The minimum size in bytes.
+        :param max_size: The maximum size in bytes.
+        :param after: The minimum mtime as a unix timestamp.
+        :param before: The maximum mtime as a unix timestamp.
+        :param folder: Only search under this path relative to the root.
+        :param cursor: The cursor returned with the previous page.
+        :param limit: The maximum number of entries to return.
+        :return: A tuple of the list of entry dicts and the cursor of the next page
+        (None when there are no more entries).
+        :raises ValueError: If the cursor is invalid or from an index since rebuilt.
+        """
+        query = query.lower()
+        regex = re.compile(glob_to_regex(glob.lower())) if glob else None
+        suffixes = tuple('.' + e.lower().lstrip('.') for e in extensions)
+        folder = folder.strip('/')
+        sized = min_size is not None or max_size is not None
+        if kind == 'folder' and sized:
+            return [], None
+        with self.lock:
+            snapshot = self.snapshot
+            folder_index = self._find(snapshot, folder) if folder else 0
+            # entries changed since the snapshot are searched after it, by path
+            changed = list(self.overlay.items())
+            for i, (size, mtime) in self.attributes.items():
+                path = self._path(snapshot, i)
+                if path is not None:
+                    changed.append((path, (False, size, mtime)))
+            changed.sort()
+
+        # find the candidates by the longest known part of the name in the names,
+        # then by glob, then in one of the sorted orders
+        literals = [(query, 0), (glob and glob_literal(glob.lower())) or ('', 0)]
+        if len(suffixes) == 1:
+            literals.append((suffixes[0] + '\n', 0))
+        literal = max(literals, key=lambda l: len(l[0]))
+        if literal[0]:
+            source = 'n'
+        elif regex is not None:
+            source = 'g'
+        elif snapshot.orders is None or folder_index != 0:
+            source = 'i'
+        elif sized or after is not None or before is not None:
+            # the sorted order with the fewest entries in range
+            spans = [(self._span(snapshot.orders['size'], min_size, max_size), 's') if sized else None,
+                     (self._span(snapshot.orders['mtime'], after, before), 't')
+                     if after is not None or before is not None else None]
+            source = min(s for s in spans if s is not None)[1]
+        elif kind == 'folder':
+            source = 'f'
+        else:
+            source = 'i'
+
+        start, after_path = None, None
+        if cursor:
+            generation, _, position = cursor.partition(':')
+            if generation != str(snapshot.generation):
+                raise ValueError('The search index was rebuilt')
+            if position.startswith('o:'):
+                after_path = position[2:]
+            else:
+                source, start = position[:1], int(position[1:])
+
+        def matches(name, is_dir, size, mtime):
+            if query and query not in name:
+                return False
+            if suffixes and not name.endswith(suffixes):
+                return False
+            if regex is not None and not regex.match(f'\n{name}\n'):
+                return False
+            if kind is not None and kind != ('folder' if is_dir else 'file'):
+                return False
+            if sized and is_dir:
+                return False
+            if (min_size is not None and size < min_size) or (max_size is not None and size > max_size):
+                return False
+            return (after is None or mtime >= after) and (before is None or mtime <= before)
+
+        results = []
+        if after_path is None and folder_index is not None:
+            # index ranges under the folder from the cursor on
+            ranges = [(max(lo, start or 1), hi) for lo, hi in snapshot.descendants(folder_index)
+                      if hi > (start or 1)]
+            if source == 'n':
+                candidates = self._find_literal(snapshot, ranges, *literal)
+            elif source == 'g':
+                candidates = self._find_regex(snapshot, ranges, regex)
+            elif source == 's':
+                candidates = self._find_range(snapshot.orders['size'], start, min_size, max_size)
+            elif source == 't':
+                candidates = self._find_range(snapshot.orders['mtime'], start, after, before)
+            elif source == 'f':
+                order = snapshot.orders['folder']
+                candidates = ((p, order[p]) for p in range(start or 0, len(order)))
+            else:
+                candidates = ((i, i) for lo, hi in ranges for i in range(lo, hi))
+            for position, i in candidates:
+                if i in self.attributes:
+                    continue # in changed
+                is_dir = snapshot.is_dir(i)
+                size, mtime = snapshot.sizes[i], snapshot.mtimes[i]
+                if not matches(snapshot.folded_name(i), is_dir, size, mtime):
+                    continue
+                path = self._path(snapshot, i)
+                if path is None:
+                    continue
+                if len(results) >= limit:
+                    return results, f'{snapshot.generation}:{source}{position}'
+                results.append(self._entry(path, is_dir, size, mtime))
+
+        prefix = folder + '/' if folder else ''
+        last = ''
+        for path, (is_dir, size, mtime) in changed:
+            if (after_path is not None and path <= after_path) or not path.startswith(prefix):
+                continue
+            if not matches(path.rpartition('/')[2].lower(), is_dir, size, mtime):
+                continue
+            if len(results) >= limit:
+                return results, f'{snapshot.generation}:o:{last}'
+            results.append(self._entry(path, is_dir, size, mtime))
+            last = path
+        return results, None
+
+    @staticmethod
+    def _find_literal(snapshot, ranges, literal, shift):
+        """
+        Yield (cursor position, index) of the entries in the ranges whose folded
+        name contains a literal.
+
+        :param shift: The length of the newline at the start of the literal.
+        """
+        for lo, hi in ranges:
+            position, end = snapshot.folded_offsets[lo] - shift, snapshot.folded_end(hi)
+            while (position := snapshot.folded.find(literal, position, end)) != -1:
+                i = snapshot.entry_of(position + shift)
+                yield i, i
+                position = snapshot.folded_end(i + 1) - shift
+
+    @staticmethod
+    def _find_regex(snapshot, ranges, regex):
+        """Yield (cursor position, index) of the entries in the ranges whose folded name matches."""
+        for lo, hi in ranges:
+            for match in regex.finditer(snapshot.folded, snapshot.folded_offsets[lo] - 1, snapshot.folded_end(hi)):
+                i = snapshot.entry_of(match.start() + 1)
+                yield i, i
+
+    @staticmethod
+    def _span(order, low, high):
+        """:return: The number of entries of a sorted order whose key is between low and high."""
+        keys = order[1]
+        return ((len(keys) if high is None else bisect_right(keys, high))
+                - (0 if low is None else bisect_left(keys, low)))
+
+    @staticmethod
+    def _find_range(order, start, low, high):
+        """
+        Yield (cursor position, index) of the entries of a sorted order whose key is
+        between low and high.
+
+        :param order: A tuple of the indexes and their keys sorted by key.
+        """
+        indexes, keys = order
+        end = len(keys) if high is None else bisect_right(keys, high)
+        if start is None:
+            start = 0 if low is None else bisect_left(keys, low)
+        for position in range(start, end):
+            yield position, indexes[position]
+
+    @staticmethod
+    def _entry(path, is_dir, size, mtime):
+        return {
+            'name': path.rpartition('/')[2],
+            'path': path,
+            'type': 'folder' if is_dir else 'file',
+            'size': size,
+            'mtime': mtime,
+        }
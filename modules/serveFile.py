@@ -0,0 +1,224 @@
+import os, mimetypes, secrets
+from datetime import datetime, timezone
+from flask import Response
+
+BLOCK_SIZE = 1024*1024
+
+
+def file_etag(st):
+    """
+    Make a strong etag from the metadata of a file.
+
+    :param st: The os.stat_result of the file.
+    :return: An unquoted etag string.
+    """
+    return f'{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}'
+
+
+def read_blocks(f, start, length):
+    """A generator reading a byte range of a file in blocks."""
+    f.seek(start)
+    while length > 0:
+        data = f.read(min(BLOCK_SIZE, length))
+        if not data:
+            break
+        length -= len(data)
+        yield data
+
+
+def read_range(f, start, length):
+    """
+    A generator reading a byte range of a file in blocks. Closes the file when done.
+    """
+    try:
+        yield from read_blocks(f, start, length)
+    finally:
+        f.close()
+
+
+def normalize_ranges(ranges, size):
+    """
+    Convert the ranges of a Range header into absolute byte ranges and merge the
+    overlapping ones.
+
+    :param ranges: A list of (start, stop) from werkzeug's Range where a negative
+    start is a suffix length and stop is exclusive or None for the end of the file.
+    :param size: The size of the file.
+    :return: A sorted list of (start, stop) or an empty list if nothing is satisfiable.
+    """
+    result = []
+    for start, stop in ranges:
+        if start < 0:
+            start, stop = max(0, size + start), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            result.append((start, stop))
+    result.sort()
+    merged = []
+    for start, stop in result:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def http_date(mtime):
+    return datetime.fromtimestamp(int(mtime), timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+
+def is_not_modified(request, etag, mtime):
+    """Check the If-None-Match and If-Modified-Since headers."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
+
+def range_applies(request, etag, mtime):
+    """Check the If-Range header. A range is only served if the content didn't change."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(mtime) <= if_range.date.timestamp()
+    return True
+
+
+def serve_file(request, path):
+    """
+    Send a file supporting conditional requests and single or multiple byte ranges.
+
+    Full files and single ranges are handed to the server as a file wrapper so
+    gunicorn can send them with os.sendfile without copying through python.
+
+    :param request: The flask request.
+    :param path: The absolute path of the file.
+    :return: A flask response.
+    """
+    f = open(path, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+    except OSError:
+        f.close()
+        raise
+    size = st.st_size
+    etag = file_etag(st)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(st.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'no-cache',
+    }
+
+    if is_not_modified(request, etag, st.st_mtime):
+        f.close()
+        return Response(status=304, headers=headers)
+
+    status = 200
+    start, stop = 0, size
+    if request.range and request.range.units == 'bytes' and range_applies(request, etag, st.st_mtime):
+        ranges = normalize_ranges(request.range.ranges, size)
+        if not ranges:
+            f.close()
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        if len(ranges) > 1:
+            return serve_multiple_ranges(lambda start, stop: read_blocks(f, start, stop - start),
+                                         ranges, size, mimetype, headers, close=f.close)
+        status = 206
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop-1}/{size}'
+
+    length = stop - start
+    # a file wrapper reads until the end of the file. gunicorn stops at the
+    # Content-Length but other servers may not, so only use it when that is safe.
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper and (stop == size or request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')):
+        f.seek(start)
+        body = file_wrapper(f, BLOCK_SIZE)
+    else:
+        body = read_range(f, start, length)
+
+    response = Response(body, status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
+    response.content_length = length
+    return response
+
+
+def serve_content(request, size, etag, mtime, read, mimetype, headers=None):
+    """
+    Send generated content supporting conditional requests and byte ranges.
+
+    :param request: The flask request.
+    :param size: The size of the content.
+    :param etag: An unquoted strong etag of the content.
+    :param mtime: The modification time of the content.
+    :param read: A function taking (start, stop) and returning a generator of the
+    bytes in that range.
+    :param mimetype: The mimetype of the content.
+    :param headers: Optional extra headers.
+    :return: A flask response.
+    """
+    headers = {
+        **(headers or {}),
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'no-cache',
+    }
+
+    if is_not_modified(request, etag, mtime):
+        return Response(status=304, headers=headers)
+
+    status = 200
+    start, stop = 0, size
+    if request.range and request.range.units == 'bytes' and range_applies(request, etag, mtime):
+        ranges = normalize_ranges(request.range.ranges, size)
+        if not ranges:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        if len(ranges) > 1:
+            return serve_multiple_ranges(read, ranges, size, mimetype, headers)
+        status = 206
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop-1}/{size}'
+
+    response = Response(read(start, stop), status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
+    response.content_length = stop - start
+    return response
+
+
+def serve_multiple_ranges(read, ranges, size, mimetype, headers, close=None):
+    """
+    Send a multipart/byteranges response.
+
+    :param read: A function taking (start, stop) and returning a generator of the
+    bytes in that range.
+    :param close: An optional function called once the response is sent.
+    :return: A flask response.
+    """
+    boundary = secrets.token_hex(16)
+    parts = []
+    for start, stop in ranges:
+        part_header = (f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                       f'Content-Range: bytes {start}-{stop-1}/{size}\r\n\r\n').encode()
+        parts.append((part_header, start, stop))
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+
+    def generate():
+        try:
+            for part_header, start, stop in parts:
+                yield part_header
+                yield from read(start, stop)
+            yield closing
+        finally:
+            if close is not None:
+                close()
+
+    response = Response(generate(), status=206, headers=headers, direct_passthrough=True,
+                        mimetype=f'multipart/byteranges; boundary={boundary}')
+    response.content_length = sum(len(h) + stop - start for h, start, stop in parts) + len(closing)
+    return response
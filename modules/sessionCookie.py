@@ -0,0 +1,48 @@
+import hmac, hashlib, base64, time
+
+
+class SessionSigner:
+    """
+    Sign and verify expiring session cookies with HMAC-SHA256. A cookie is the hex
+    expiry time and its signature, so verifying it needs no lookup or shared state
+    between workers.
+    """
+
+    def __init__(self, token, max_age):
+        """
+        :param token: The access token, the signing key is derived from it so
+        changing the token invalidates every session.
+        :param max_age: How many seconds a session lasts.
+        """
+        self.key = hashlib.sha256(b'qrFileServer session\0' + token.encode()).digest()
+        self.max_age = max_age
+
+    def _signature(self, expires):
+        digest = hmac.new(self.key, expires, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=')
+
+    def sign(self):
+        """:return: A new cookie value valid for max_age seconds."""
+        expires = format(int(time.time()) + self.max_age, 'x').encode()
+        return (expires + b'.' + self._signature(expires)).decode()
+
+    def verify(self, value):
+        """
+        :param value: A cookie value or None.
+        :return: The seconds left before the session expires or None if it is not valid.
+        """
+        if not value:
+            return None
+        expires, _, signature = value.encode().partition(b'.')
+        try:
+            remaining = int(expires, 16) - time.time()
+        except ValueError:
+            return None
+        if remaining <= 0 or not hmac.compare_digest(signature, self._signature(expires)):
+            return None
+        return remaining
+
+
+def equal(a, b):
+    """Compare two strings in constant time."""
+    return a is not None and b is not None and hmac.compare_digest(a.encode(), b.encode())
@@ -0,0 +1,72 @@
+import os, sqlite3, threading, time
+
+
+class SessionStore:
+    """
+    Upload sessions stored in an sqlite database in WAL mode so every gunicorn
+    worker sees the sessions created by the others. The chunks received are
+    already tracked in the state file of each upload, so only the parameters of a
+    session are stored here.
+    """
+
+    def __init__(self, path, max_age=7*24*3600):
+        """
+        :param path: The path of the database, shared by all workers.
+        :param max_age: Sessions older than this many seconds are forgotten.
+        """
+        self.path = path
+        self.max_age = max_age
+        self.local = threading.local()
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS upload_sessions (id TEXT PRIMARY KEY, '
+                       'path TEXT NOT NULL, file_size INTEGER NOT NULL, chunk_size INTEGER NOT NULL, '
+                       'created REAL NOT NULL)')
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def put(self, session_id, path, file_size, chunk_size):
+        """
+        :param session_id: The id given to the client.
+        :param path: The destination of the upload relative to the upload folder,
+        since each worker may have its own upload folder.
+        :param file_size: The size of the whole file.
+        :param chunk_size: The size of every chunk except the last one.
+        """
+        with self._connection() as db:
+            db.execute('INSERT OR REPLACE INTO upload_sessions VALUES (?, ?, ?, ?, ?)',
+                       (session_id, path, file_size, chunk_size, time.time()))
+
+    def get(self, session_id):
+        """:return: A tuple of (path, file_size, chunk_size) or None."""
+        row = self._connection().execute(
+            'SELECT path, file_size, chunk_size FROM upload_sessions WHERE id = ?', (session_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def remove(self, session_id):
+        with self._connection() as db:
+            db.execute('DELETE FROM upload_sessions WHERE id = ?', (session_id,))
+
+    def expire(self):
+        """
+        Forget the sessions older than max_age.
+
+        :return: The paths of the expired sessions, relative to the upload folder.
+        """
+        with self._connection() as db:
+            rows = db.execute('SELECT id, path FROM upload_sessions WHERE created < ?',
+                              (time.time() - self.max_age,)).fetchall()
+            db.executemany('DELETE FROM upload_sessions WHERE id = ?', [(row[0],) for row in rows])
+        return [row[1] for row in rows]
+
+    def count(self):
+        """:return: The number of sessions in progress."""
+        return self._connection().execute('SELECT COUNT(*) FROM upload_sessions').fetchone()[0]
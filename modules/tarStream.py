@@ -0,0 +1,143 @@
+import os, stat, struct, tarfile, zlib
+
+# Optional zstd compression.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+READ_SIZE = 1024*1024
+# Output is buffered up to this size before being sent.
+FLUSH_SIZE = 256*1024
+
+COMPRESSIONS = {
+    # compression: (mimetype, file extension)
+    None: ('application/x-tar', 'tar'),
+    'gzip': ('application/gzip', 'tar.gz'),
+    'zstd': ('application/zstd', 'tar.zst'),
+}
+
+
+def available_compressions():
+    """:return: A list of the compressions supported by TarStream."""
+    return [c for c in COMPRESSIONS if c != 'zstd' or zstandard is not None]
+
+
+USTAR_HEADER = struct.Struct('100s8s8s8s12s12s8s1s100s8s32s32s8s8s155s12s')
+USTAR_MAX_SIZE = 0o77777777777
+
+
+def tar_header(name, st, is_dir):
+    """
+    Build the header blocks of a tar entry. Plain ustar headers are packed directly
+    since tarfile's generic code dominates the time of archiving small files. Names
+    and sizes that don't fit in ustar use a pax header from tarfile.
+
+    :param name: The path of the entry in the archive.
+    :param st: The os.stat_result of the file.
+    :param is_dir: If the entry is a directory.
+    :return: The header bytes.
+    """
+    if is_dir:
+        name += '/'
+    size = 0 if is_dir else st.st_size
+    mode = stat.S_IMODE(st.st_mode)
+    mtime = max(0, int(st.st_mtime))
+    encoded_name = name.encode('utf-8', 'surrogateescape')
+    if len(encoded_name) > 100 or not encoded_name.isascii() or size > USTAR_MAX_SIZE:
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE if is_dir else tarfile.REGTYPE
+        info.size = size
+        info.mode = mode
+        info.mtime = mtime
+        return info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+
+    header = USTAR_HEADER.pack(encoded_name, b'%07o\0' % mode, b'0000000\0', b'0000000\0',
+                               b'%011o\0' % size, b'%011o\0' % mtime, b' '*8,
+                               tarfile.DIRTYPE if is_dir else tarfile.REGTYPE,
+                               b'', b'ustar\x0000', b'', b'', b'', b'', b'', b'')
+    # the checksum is computed with its own field filled with spaces
+    return header[:148] + b'%06o\0 ' % sum(header) + header[156:]
+
+
+class TarStream:
+    """
+    Stream a POSIX tar archive of files while they are still being listed,
+    optionally compressed with gzip or zstd.
+
+    Unlike zip there is no central directory or checksum to compute, so each file is
+    sent as it is read.
+    """
+
+    def __init__(self, entries, compression=None, level=3, threads=0):
+        """
+        :param entries: An iterable of (path, name in archive, is_dir). It may be a
+        generator still walking the directory.
+        :param compression: None, 'gzip' or 'zstd'.
+        :param level: The compression level.
+        :param threads: The number of threads zstd compresses with, 0 to compress in
+        the calling thread. gzip always uses a single thread.
+        """
+        if compression not in available_compressions():
+            raise ValueError(f'Unsupported compression {compression}')
+        self.entries = entries
+        self.compression = compression
+        self.level = level
+        self.threads = threads
+
+    def _compressor(self):
+        if self.compression == 'gzip':
+            return zlib.compressobj(self.level, zlib.DEFLATED, 31) # 31 writes a gzip header
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level, threads=self.threads).compressobj()
+        return None
+
+    def _archive(self):
+        """A generator of the uncompressed archive."""
+        for path, name, is_dir in self.entries:
+            if is_dir:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue # removed while walking
+                yield tar_header(name, st, True)
+                continue
+
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                continue # removed or unreadable
+            with f:
+                st = os.fstat(f.fileno())
+                yield tar_header(name, st, False)
+                remaining = st.st_size
+                while remaining > 0:
+                    data = f.read(min(READ_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+                # the size is already in the header, pad a file that shrank like tar does
+                yield bytes(remaining + (-st.st_size % BLOCK_SIZE))
+        yield bytes(2*BLOCK_SIZE)
+
+    def generator(self):
+        """:return: A generator of the bytes of the archive."""
+        compressor = self._compressor()
+        # small files make many small pieces, send them together
+        buffered = []
+        buffered_size = 0
+        for data in self._archive():
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                buffered.append(data)
+                buffered_size += len(data)
+            if buffered_size >= FLUSH_SIZE:
+                yield b''.join(buffered) if len(buffered) > 1 else buffered[0]
+                buffered = []
+                buffered_size = 0
+        if compressor is not None:
+            buffered.append(compressor.flush())
+        yield b''.join(buffered)
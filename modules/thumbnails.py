@@ -0,0 +1,286 @@
+import os, hashlib, multiprocessing, shutil, subprocess, threading, time
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Optional image thumbnails with Pillow, video thumbnails also need ffmpeg.
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+FFMPEG = shutil.which('ffmpeg')
+
+# Thumbnails are made in the smallest of these sizes at least as big as asked.
+SIZES = (128, 256, 512, 1024)
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+VIDEO_EXTENSIONS = {'.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi'}
+JPEG_QUALITY = 80
+# The most warm up thumbnails queued, the oldest are dropped first.
+WARM_QUEUE_SIZE = 10000
+# Cached thumbnails are touched when used at most this often, to evict the least recently used.
+TOUCH_INTERVAL = 3600
+# Files no thumbnail could be made of are tried again after this many seconds, in
+# case it failed for a moment, and at most this many failures are remembered.
+FAILED_EXPIRY = 3600
+FAILED_MAX = 10000
+
+
+class Busy(Exception):
+    """Too many thumbnails are being made, try again later."""
+
+
+class Pending(Exception):
+    """The thumbnail is being made, ask for it again a bit later."""
+
+
+def thumbnail_size(requested):
+    """:return: The size of the thumbnail made for a requested size."""
+    for size in SIZES:
+        if size >= requested:
+            return size
+    return SIZES[-1]
+
+
+def can_thumbnail(path):
+    """:return: If a thumbnail of a file can be made from its extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return Image is not None
+    return extension in VIDEO_EXTENSIONS and Image is not None and FFMPEG is not None
+
+
+def make_thumbnail(source, destination, size):
+    """
+    Write a jpeg of at most size x size pixels of an image or of a frame of a video.
+    Runs in a process of the pool.
+
+    :return: If the thumbnail was made.
+    """
+    temporary = f'{destination}.{os.getpid()}.tmp'
+    try:
+        if os.path.splitext(source)[1].lower() in VIDEO_EXTENSIONS:
+            return make_video_thumbnail(source, destination, temporary, size)
+        with Image.open(source) as image:
+            # jpegs are decoded directly at a fraction of their size
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.save(temporary, 'JPEG', quality=JPEG_QUALITY)
+        os.replace(temporary, destination)
+        return True
+    except Exception:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        return False
+
+
+def make_video_thumbnail(source, destination, temporary, size):
+    scale = f'scale={size}:{size}:force_original_aspect_ratio=decrease'
+    # a frame a second in, or the first one of shorter videos
+    for seek in ('1', '0'):
+        subprocess.run([FFMPEG, '-v', 'error', '-y', '-ss', seek, '-i', source, '-frames:v', '1', '-vf', scale,
+                        '-q:v', '4', '-f', 'mjpeg', temporary], stdin=subprocess.DEVNULL, timeout=60)
+        if os.path.exists(temporary) and os.path.getsize(temporary) > 0:
+            os.replace(temporary, destination)
+            return True
+    return False
+
+
+class Thumbnailer:
+    """
+    Make thumbnails in a pool of processes so decoding large images neither holds
+    the GIL of the request threads nor makes every request wait, and keep them in a
+    disk cache keyed by (path, size, file size, mtime) where the least recently
+    used are evicted.
+
+    Requests are limited to a few thumbnails queued per process of the pool. The
+    thumbnails of folders being browsed are made in the background when the pool
+    has nothing else to do.
+    """
+
+    def __init__(self, cache_dir, max_size, processes=2):
+        """
+        :param cache_dir: The directory of the cached thumbnails.
+        :param max_size: The maximum size in bytes of the cache.
+        :param processes: The number of processes making thumbnails.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.processes = processes
+        self.max_jobs = processes*4
+        self.pool = None
+        self.pid = None
+        self.jobs = {} # cache path -> future, shared by requests for the same thumbnail
+        self.failed = OrderedDict() # cache paths of files no thumbnail could be made of -> time.monotonic()
+        self.cache_bytes = None # measured the first time the cache grows
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.warm_queue = deque()
+        self.warm_thread = None
+
+    def cache_path(self, path, size, st):
+        key = f'{os.path.realpath(path)}\0{size}\0{st.st_size}\0{st.st_mtime_ns}'
+        digest = hashlib.sha256(key.encode(errors='surrogateescape')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f'{digest}.jpg')
+
+    def _pool(self):
+        if self.pool is None or self.pid != os.getpid():
+            # spawned so the processes don't inherit the threads of the server
+            self.pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+            self.pid = os.getpid()
+        return self.pool
+
+    def get(self, path, size):
+        """
+        Get the thumbnail of a file, starting to make it if needed. It never waits for
+        the thumbnail to be made so no request thread is held while it is.
+
+        :param path: The path of an image or video.
+        :param size: One of SIZES.
+        :return: The path of the cached thumbnail or None if none can be made.
+        :raises Pending: If the thumbnail is being made.
+        :raises Busy: If too many thumbnails are being made.
+        :raises OSError: If the file can't be read.
+        """
+        cached = self.cache_path(path, size, os.stat(path))
+        if self._cached(cached):
+            return cached
+        if self._failed(cached):
+            return None
+        if self._submit(path, size, cached, self.max_jobs) is None:
+            raise Busy()
+        raise Pending()
+
+    def _failed(self, cached):
+        """:return: If making this thumbnail failed recently."""
+        with self.lock:
+            failed = self.failed.get(cached)
+            if failed is not None and time.monotonic() - failed > FAILED_EXPIRY:
+                del self.failed[cached]
+                failed = None
+        return failed is not None
+
+    def _cached(self, cached):
+        try:
+            mtime = os.stat(cached).st_mtime
+        except OSError:
+            return False
+        if time.time() - mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(cached)
+            except OSError:
+                pass
+        return True
+
+    def _submit(self, path, size, cached, limit):
+        """:return: The future of the thumbnail or None if there are limit jobs already."""
+        with self.lock:
+            future = self.jobs.get(cached)
+            if future is not None:
+                return future
+            if len(self.jobs) >= limit:
+                return None
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            try:
+                future = self._pool().submit(make_thumbnail, path, cached, size)
+            except BrokenProcessPool:
+                self.pool = None # a process crashed, start a new pool
+                future = self._pool().submit(make_thumbnail, path, cached, size)
+            self.jobs[cached] = future
+        future.add_done_callback(lambda f: self._done(cached, f))
+        return future
+
+    def _done(self, cached, future):
+        error = future.exception()
+        made = error is None and future.result()
+        with self.lock:
+            del self.jobs[cached]
+            if isinstance(error, BrokenProcessPool):
+                self.pool = None # a process crashed, start a new pool
+            elif not made:
+                # the cache path changes with the size and mtime of the file, so a file
+                # replaced since is tried again anyway
+                self.failed[cached] = time.monotonic()
+                self.failed.move_to_end(cached)
+                while len(self.failed) > FAILED_MAX:
+                    self.failed.popitem(last=False)
+            self.idle.notify_all()
+        if made:
+            self._added(cached)
+
+    def _added(self, cached):
+        try:
+            size = os.path.getsize(cached)
+        except OSError:
+            return
+        with self.lock:
+            if self.cache_bytes is not None:
+                self.cache_bytes += size
+            over = self.cache_bytes is None or self.cache_bytes > self.max_size
+        if over:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used thumbnails until the cache is under 90% of its size."""
+        files = []
+        for directory, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(f[1] for f in files)
+        if total > self.max_size:
+            files.sort()
+            for _, size, path in files:
+                if total <= self.max_size*0.9:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+        with self.lock:
+            self.cache_bytes = total
+
+    def warm(self, paths, size):
+        """
+        Make the thumbnails of files in the background when the pool is idle. The
+        files of the latest call are made first.
+
+        :param paths: The paths of images or videos.
+        :param size: One of SIZES.
+        """
+        with self.lock:
+            self.warm_queue.extendleft((path, size) for path in reversed(paths))
+            while len(self.warm_queue) > WARM_QUEUE_SIZE:
+                self.warm_queue.pop()
+            if self.warm_thread is None:
+                self.warm_thread = threading.Thread(target=self._warm_loop, name='thumbnail-warm', daemon=True)
+                self.warm_thread.start()
+            self.idle.notify_all()
+
+    def _warm_loop(self):
+        while True:
+            with self.lock:
+                # one job per process so requests never wait behind warm ups
+                while not self.warm_queue or len(self.jobs) >= self.processes:
+                    self.idle.wait()
+                path, size = self.warm_queue.popleft()
+            try:
+                cached = self.cache_path(path, size, os.stat(path))
+            except OSError:
+                continue
+            if not self._failed(cached) and not os.path.exists(cached):
+                self._submit(path, size, cached, self.processes)
@@ -0,0 +1,136 @@
+import os, secrets, tarfile, zlib
+from modules.uploadSession import PART_SUFFIX
+
+
+class HashingStream:
+    """A file like wrapper of a request stream that hashes the data read from it."""
+
+    def __init__(self, stream, hasher):
+        self.stream = stream
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        return data
+
+
+class UploadBatch:
+    """
+    Many small files sent together as a tar stream in a single request, so uploading
+    a folder of thousands of files doesn't cost a request per file.
+
+    Each file is written to a hidden part file next to its destination as it
+    arrives. The files are moved into place together once the whole request was
+    read and its checksum verified, so a failed batch leaves no file behind and can
+    simply be sent again.
+    """
+
+    def __init__(self, stream, buffer_size, hasher=None):
+        """
+        :param stream: The request body.
+        :param buffer_size: The size of the buffer used to write each file.
+        :param hasher: An optional hasher of the whole body, see new_hasher().
+        """
+        self.stream = HashingStream(stream, hasher)
+        self.buffer_size = buffer_size
+        self.hasher = hasher
+        self.files = [] # (part path, destination, size, crc32) in the order they were sent
+        self.skipped = [] # names of the entries that aren't regular files or directories
+        self.errors = [] # {'name', 'message'} of the entries that couldn't be written
+
+    def extract(self, destination):
+        """
+        Write every regular file of the tar stream to a part file and create its
+        directories.
+
+        :param destination: A function of (name, is_dir) called for each entry which
+        returns the path to write a file to after creating its folder, or None to
+        skip the entry. An OSError it raises, like when a file is in the way of a
+        folder, is reported in errors and the other entries are still written.
+        :raises tarfile.TarError: If the body isn't a valid tar stream.
+        """
+        try:
+            with tarfile.open(fileobj=self.stream, mode='r|', bufsize=self.buffer_size) as tar:
+                for member in tar:
+                    if not (member.isfile() or member.isdir()):
+                        self.skipped.append(member.name) # links and devices are never created
+                        continue
+                    try:
+                        path = destination(member.name, member.isdir())
+                        f = self._create(path) if path is not None and member.isfile() else None
+                    except OSError as e:
+                        self.errors.append({'name': member.name, 'message': e.strerror or str(e)})
+                        continue
+                    if path is None:
+                        self.skipped.append(member.name)
+                    elif f is not None:
+                        self._write(tar.extractfile(member), f)
+            # the end of archive blocks are part of the checksum
+            while self.stream.read(self.buffer_size):
+                pass
+        except BaseException:
+            self.discard()
+            raise
+
+    def _create(self, path):
+        """:return: The part file of a destination, open for writing."""
+        directory, name = os.path.split(path)
+        part_path = os.path.join(directory, f'.{name}.{secrets.token_hex(4)}{PART_SUFFIX}')
+        f = open(part_path, 'wb')
+        # tracked as soon as it exists so a failure always removes it
+        self.files.append((part_path, path, None, None))
+        return f
+
+    def _write(self, source, f):
+        size = crc = 0
+        with f:
+            while data := source.read(self.buffer_size):
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                f.write(data)
+        part_path, path, _, _ = self.files[-1]
+        self.files[-1] = (part_path, path, size, crc)
+
+    def verify(self, expected):
+        """
+        :param expected: The hex digest of the body sent by the client or None.
+        :return: If the body matches it.
+        """
+        return expected is None or self.hasher.hexdigest() == expected
+
+    def commit(self, unchanged=None):
+        """
+        Move every file into place.
+
+        :param unchanged: An optional function of (part path, destination) that is
+        true when the destination already has the same content, which is then kept.
+        :return: A tuple of the list of (destination, size, crc32) of the written files and
+        the number of unchanged files.
+        """
+        written = []
+        kept = 0
+        try:
+            for part_path, path, size, crc in self.files:
+                if unchanged is not None and unchanged(part_path, path):
+                    os.remove(part_path)
+                    kept += 1
+                else:
+                    os.replace(part_path, path)
+                    written.append((path, size, crc))
+        except BaseException:
+            del self.files[:len(written) + kept]
+            self.discard()
+            raise
+        self.files = []
+        return written, kept
+
+    def discard(self):
+        """Remove the part files of a failed batch."""
+        for part_path, *_ in self.files:
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+        self.files = []
@@ -0,0 +1,248 @@
+import os, struct, math, fcntl, zlib, time
+from modules.fileDigest import combine_chunk_crcs, format_digest
+
+# The data of an unfinished upload is written to a hidden part file next to its
+# destination and the received chunks are tracked in a hidden state file.
+PART_SUFFIX = '.qrpart'
+STATE_SUFFIX = '.qrupload'
+
+# The state file is this header followed by one byte per chunk which is 1 once the
+# chunk is written, then the crc32 of each chunk as 4 bytes. A whole byte is used
+# per chunk so parallel writers never share one.
+STATE_MAGIC = b'QRUPLOAD'
+STATE_HEADER = struct.Struct('<8sQQ')
+
+
+def part_paths(file_path):
+    """
+    :param file_path: The destination of an upload.
+    :return: A tuple of the part file path and the state file path.
+    """
+    directory, name = os.path.split(file_path)
+    return os.path.join(directory, f'.{name}{PART_SUFFIX}'), os.path.join(directory, f'.{name}{STATE_SUFFIX}')
+
+
+def is_upload_file(name):
+    """Check if a file name belongs to an unfinished upload."""
+    return name.startswith('.') and (name.endswith(PART_SUFFIX) or name.endswith(STATE_SUFFIX))
+
+
+def remove_stale_uploads(directory, max_age):
+    """
+    Remove the files of unfinished uploads in a directory, including those of delta
+    uploads, that weren't written to for max_age seconds.
+
+    :param directory: The absolute path of the directory.
+    :param max_age: The seconds after which an upload is abandoned.
+    :return: The number of files removed.
+    """
+    removed = 0
+    limit = time.time() - max_age
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not is_upload_file(entry.name):
+                    continue
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime < limit:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return removed
+
+
+class UploadSession:
+    """
+    An upload where chunks can be written in parallel and in any order with os.pwrite.
+    The chunks received so far are persisted so an upload can be resumed exactly.
+    """
+
+    def __init__(self, file_path, file_size, chunk_size):
+        self.file_path = file_path
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.total_chunks = math.ceil(file_size/chunk_size)
+        self.part_path, self.state_path = part_paths(file_path)
+        self.digest = None
+
+    @classmethod
+    def open(cls, file_path, file_size, chunk_size, resume):
+        """
+        Start a new upload or continue the unfinished upload to the same destination.
+
+        :param file_path: The destination of the upload.
+        :param file_size: The size of the whole file.
+        :param chunk_size: The size of every chunk except the last one.
+        :param resume: If false, any unfinished upload is discarded.
+        :return: An UploadSession.
+        """
+        session = cls(file_path, file_size, chunk_size)
+        if resume and session._state_matches():
+            return session
+
+        # the part file is allocated to its full size so chunks can land anywhere
+        with open(session.part_path, 'wb') as f:
+            f.truncate(file_size)
+        with open(session.state_path, 'wb') as f:
+            f.write(STATE_HEADER.pack(STATE_MAGIC, file_size, chunk_size))
+            f.write(bytes(5*session.total_chunks))
+        return session
+
+    def _state_matches(self):
+        try:
+            with open(self.state_path, 'rb') as f:
+                magic, file_size, chunk_size = STATE_HEADER.unpack(f.read(STATE_HEADER.size))
+        except (OSError, struct.error):
+            return False
+        return ((magic, file_size, chunk_size) == (STATE_MAGIC, self.file_size, self.chunk_size)
+                and os.path.exists(self.part_path))
+
+    def chunk_length(self, index, count=1):
+        """:return: The expected size of count consecutive chunks starting at index."""
+        return min(self.file_size, (index + count)*self.chunk_size) - index*self.chunk_size
+
+    def received(self):
+        """:return: A bytes object with one byte per chunk which is 1 if it was received."""
+        fd = os.open(self.state_path, os.O_RDONLY)
+        try:
+            return os.pread(fd, self.total_chunks, STATE_HEADER.size)
+        finally:
+            os.close(fd)
+
+    def chunk_crcs(self):
+        """:return: A tuple of the crc32 of every chunk, 0 for missing chunks."""
+        fd = os.open(self.state_path, os.O_RDONLY)
+        try:
+            data = os.pread(fd, 4*self.total_chunks, STATE_HEADER.size + self.total_chunks)
+        finally:
+            os.close(fd)
+        return struct.unpack(f'<{self.total_chunks}I', data)
+
+    def missing_chunks(self):
+        """:return: A list of the indexes of chunks not received yet."""
+        return [i for i, done in enumerate(self.received()) if not done]
+
+    def write_chunk(self, index, data, count=1, hasher=None):
+        """
+        Write consecutive chunks at their offset. They are only marked as received
+        with mark_received() so they can be verified first.
+
+        :param index: The index of the first chunk.
+        :param data: The content of the chunks.
+        :param count: The number of consecutive chunks in data.
+        :param hasher: An optional hasher updated with the data.
+        :return: A list of the crc32 of each chunk.
+        """
+        data = memoryview(data)
+        if hasher is not None:
+            hasher.update(data)
+        crcs = [zlib.crc32(data[i:i+self.chunk_size]) for i in range(0, len(data), self.chunk_size)]
+        fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            offset = index*self.chunk_size
+            while data:
+                written = os.pwrite(fd, data, offset)
+                data = data[written:]
+                offset += written
+        finally:
+            os.close(fd)
+        return crcs
+
+    def write_stream(self, index, count, stream, buffer_size, hasher=None):
+        """
+        Write consecutive chunks read from a stream at their offset. Only one buffer
+        of buffer_size bytes is held in memory at a time. The chunks are only marked
+        as received with mark_received() so they can be verified first.
+
+        :param index: The index of the first chunk.
+        :param count: The number of consecutive chunks in the stream.
+        :param stream: A binary stream supporting readinto() such as request.stream.
+        :param buffer_size: The size of the buffer used to copy the stream to the file.
+        :param hasher: An optional hasher updated with the data while writing.
+        :return: A list of the crc32 of each chunk.
+        :raises EOFError: If the stream ends before the chunks are complete.
+        """
+        remaining = self.chunk_length(index, count)
+        offset = index*self.chunk_size
+        crcs = []
+        crc = 0
+        chunk_remaining = self.chunk_size
+        buffer = memoryview(bytearray(min(buffer_size, max(remaining, 1))))
+        fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            while remaining > 0:
+                # never read across a chunk boundary so every chunk gets its own crc
+                read = stream.readinto(buffer[:min(len(buffer), remaining, chunk_remaining)])
+                if not read:
+                    raise EOFError('The upload ended before the chunk was complete')
+                data = buffer[:read]
+                crc = zlib.crc32(data, crc)
+                if hasher is not None:
+                    hasher.update(data)
+                while data:
+                    written = os.pwrite(fd, data, offset)
+                    data = data[written:]
+                    offset += written
+                remaining -= read
+                chunk_remaining -= read
+                if chunk_remaining == 0 or remaining == 0:
+                    crcs.append(crc)
+                    crc = 0
+                    chunk_remaining = self.chunk_size
+        finally:
+            os.close(fd)
+        return crcs
+
+    def mark_received(self, index, crcs):
+        """
+        Mark consecutive chunks as received.
+
+        :param index: The index of the first chunk.
+        :param crcs: The crc32 of each chunk returned by write_chunk() or write_stream().
+        """
+        fd = os.open(self.state_path, os.O_WRONLY)
+        try:
+            # the crc goes first so a received chunk always has its crc
+            os.pwrite(fd, struct.pack(f'<{len(crcs)}I', *crcs),
+                      STATE_HEADER.size + self.total_chunks + 4*index)
+            os.pwrite(fd, b'\x01'*len(crcs), STATE_HEADER.size + index)
+        finally:
+            os.close(fd)
+
+    def finalize(self):
+        """
+        Move the part file to its destination once every chunk is received. The
+        digest of the whole file is combined from the crc32 of its chunks and saved
+        in self.digest.
+
+        :return: True if the upload is complete.
+        """
+        try:
+            fd = os.open(self.state_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return os.path.exists(self.file_path) # finished by a chunk written at the same time
+        try:
+            # a lock on the state file works across threads and gunicorn workers
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if not os.path.exists(self.state_path):
+                return os.path.exists(self.file_path) # finished while waiting for the lock
+            if 0 in self.received():
+                return False
+            crc = combine_chunk_crcs(self.chunk_crcs(), self.chunk_size, self.file_size)
+            os.replace(self.part_path, self.file_path)
+            os.remove(self.state_path)
+        finally:
+            os.close(fd)
+        self.digest = format_digest(crc)
+        return True
+
+    def discard(self):
+        """Remove the part and state files."""
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,387 @@
+import os, struct, time, zlib, threading, hashlib
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from modules.fileDigest import format_digest
+
+# Files in these formats are already compressed so deflating them only burns cpu.
+STORED_EXTENSIONS = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'heif', 'avif', 'jxl',
+    'mp4', 'm4v', 'mkv', 'mov', 'avi', 'webm', 'wmv', 'flv',
+    'mp3', 'm4a', 'aac', 'ogg', 'oga', 'opus', 'flac', 'wma',
+    'zip', 'gz', 'tgz', 'bz2', 'xz', 'zst', 'lz4', '7z', 'rar', 'jar', 'apk', 'whl',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'epub', 'pdf',
+}
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+# Files this close to the zip64 limit when listed get zip64 headers in case they grow.
+ZIP64_MARGIN = 256*1024*1024
+READ_SIZE = 1024*1024
+# Output is buffered up to this size before being sent.
+FLUSH_SIZE = 256*1024
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool(threads):
+    """
+    The thread pool shared by every zip stream. It is created on first use so it
+    belongs to the worker process and not the gunicorn master.
+    """
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='zip')
+        return pool
+
+
+def should_compress(name):
+    """Check if a file should be deflated based on its extension."""
+    return name.rsplit('.', 1)[-1].lower() not in STORED_EXTENSIONS
+
+
+def dos_datetime(mtime):
+    """:return: A tuple of the (time, date) of a timestamp in the ms-dos format of zip."""
+    t = time.localtime(max(mtime, 315532800)) # zip can't store dates before 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def needs_zip64(size, method):
+    # deflate may grow incompressible data a little, give it the same margin as zipfile
+    return (size*1.05 if method == ZIP_DEFLATED else size) + ZIP64_MARGIN >= ZIP64_LIMIT
+
+
+def local_header(name, method, mtime, zip64, crc=0, compressed_size=0, size=0, descriptor=True):
+    """
+    Build the local file header of an entry.
+
+    :param name: The utf-8 encoded name in the archive.
+    :param method: ZIP_STORED or ZIP_DEFLATED.
+    :param mtime: The modification time of the file.
+    :param zip64: If true, the sizes are stored in a zip64 extra field.
+    :param descriptor: If true, the crc and sizes follow the data in a data descriptor.
+    :return: The header bytes.
+    """
+    dostime, dosdate = dos_datetime(mtime)
+    flags = FLAG_UTF8 | (FLAG_DATA_DESCRIPTOR if descriptor else 0)
+    extra = b''
+    if zip64:
+        extra = struct.pack('<HHQQ', 1, 16, size, compressed_size)
+        size = compressed_size = ZIP64_LIMIT
+    return LOCAL_HEADER.pack(0x04034b50, 45 if zip64 else 20, flags, method, dostime, dosdate,
+                             crc, compressed_size, size, len(name), len(extra)) + name + extra
+
+
+def data_descriptor(crc, compressed_size, size, zip64):
+    if zip64:
+        return struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size)
+    return struct.pack('<IIII', 0x08074b50, crc, compressed_size, size)
+
+
+def central_header(name, method, mtime, zip64, crc, compressed_size, size, offset, mode, descriptor=True):
+    """Build the central directory record of an entry."""
+    dostime, dosdate = dos_datetime(mtime)
+    flags = FLAG_UTF8 | (FLAG_DATA_DESCRIPTOR if descriptor else 0)
+    extra_fields = []
+    if size >= ZIP64_LIMIT or zip64:
+        extra_fields.append(size)
+        size = ZIP64_LIMIT
+    if compressed_size >= ZIP64_LIMIT or zip64:
+        extra_fields.append(compressed_size)
+        compressed_size = ZIP64_LIMIT
+    if offset >= ZIP64_LIMIT:
+        extra_fields.append(offset)
+        offset = ZIP64_LIMIT
+    extra = b''
+    if extra_fields:
+        extra = struct.pack(f'<HH{len(extra_fields)}Q', 1, 8*len(extra_fields), *extra_fields)
+    return CENTRAL_HEADER.pack(0x02014b50, (3 << 8) | 45, 45 if extra_fields else 20, flags, method,
+                               dostime, dosdate, crc, compressed_size, size, len(name), len(extra),
+                               0, 0, 0, (mode & 0xFFFF) << 16, offset) + name + extra
+
+
+def end_records(count, directory_offset, directory_size):
+    """Build the end of central directory records, with the zip64 ones when needed."""
+    data = b''
+    if count >= 0xFFFF or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+        zip64_offset = directory_offset + directory_size
+        data += ZIP64_END_RECORD.pack(0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count,
+                                      directory_size, directory_offset)
+        data += ZIP64_END_LOCATOR.pack(0x07064b50, 0, zip64_offset, 1)
+        count = min(count, 0xFFFF)
+        directory_offset = min(directory_offset, ZIP64_LIMIT)
+        directory_size = min(directory_size, ZIP64_LIMIT)
+    return data + END_RECORD.pack(0x06054b50, 0, 0, count, count, directory_size, directory_offset, 0)
+
+
+def compress_file(path, compresslevel, max_size):
+    """
+    Read and deflate a whole small file. Runs in the thread pool, zlib releases the
+    GIL so several files are compressed at once.
+
+    :param max_size: Files that grew past this size since they were listed aren't
+    read whole, they are streamed instead.
+    :return: A tuple of (crc, size, compressed data), None if the file can't be read
+    or False if it is larger than max_size.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(max_size + 1)
+    except OSError:
+        return None
+    if len(data) > max_size:
+        return False
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    return zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
+
+
+class ZipStream:
+    """
+    Stream a zip archive of files while they are still being listed.
+
+    Files with compressed formats are stored and the others deflated. Small files
+    ahead of the one being written are compressed in a thread pool so the cpu bound
+    deflate runs in parallel with sending. Large files are compressed while streaming
+    so memory stays bounded by ahead_limit.
+    """
+
+    def __init__(self, entries, compresslevel=6, threads=4, lookahead=8, parallel_limit=4*1024*1024,
+                 ahead_limit=8*1024*1024):
+        """
+        :param entries: An iterable of (path, name in archive, size, mtime). It may be
+        a generator still walking the directory.
+        :param compresslevel: The deflate level from 0 to 9, 0 stores every file.
+        :param threads: The number of threads of the compression pool.
+        :param lookahead: How many upcoming files may be compressed ahead.
+        :param parallel_limit: Only files up to this size are compressed ahead.
+        :param ahead_limit: The most bytes of the files compressed ahead at once.
+        """
+        self.entries = iter(entries)
+        self.compresslevel = compresslevel
+        self.threads = threads
+        self.lookahead = lookahead
+        self.parallel_limit = parallel_limit
+        self.ahead_limit = ahead_limit
+
+    def _method(self, name):
+        if self.compresslevel > 0 and should_compress(name):
+            return ZIP_DEFLATED
+        return ZIP_STORED
+
+    def _fill(self, pending):
+        """Take entries from the walk until the lookahead window is full."""
+        ahead = sum(entry[2] for entry in pending if entry[5] is not None)
+        while len(pending) < self.lookahead:
+            try:
+                path, name, size, mtime = next(self.entries)
+            except StopIteration:
+                return
+            method = self._method(name)
+            future = None
+            if method == ZIP_DEFLATED and size <= self.parallel_limit and ahead + size <= self.ahead_limit:
+                future = get_pool(self.threads).submit(compress_file, path, self.compresslevel, self.parallel_limit)
+                ahead += size
+            pending.append((path, name, size, mtime, method, future))
+
+    def generator(self):
+        """:return: A generator of the bytes of the archive."""
+        # small files make many small pieces, send them together
+        buffered = []
+        buffered_size = 0
+        archive = self._archive()
+        try:
+            for data in archive:
+                buffered.append(data)
+                buffered_size += len(data)
+                if buffered_size >= FLUSH_SIZE:
+                    yield b''.join(buffered) if len(buffered) > 1 else buffered[0]
+                    buffered = []
+                    buffered_size = 0
+        finally:
+            archive.close() # cancels the compression queued ahead
+        yield b''.join(buffered)
+
+    def _archive(self):
+        pending = deque()
+        directory = []
+        offset = 0
+        try:
+            self._fill(pending)
+            while pending:
+                path, name, size, mtime, method, future = pending.popleft()
+                self._fill(pending)
+                encoded_name = name.replace(os.sep, '/').encode('utf-8')
+
+                result = future.result() if future is not None else False
+                if result is None:
+                    continue # removed or unreadable
+                if result is not False:
+                    crc, size, compressed = result
+                    zip64 = needs_zip64(size, method)
+                    header = local_header(encoded_name, method, mtime, zip64)
+                    descriptor = data_descriptor(crc, len(compressed), size, zip64)
+                    yield header
+                    yield compressed
+                    yield descriptor
+                    directory.append(central_header(encoded_name, method, mtime, zip64, crc,
+                                                     len(compressed), size, offset, 0o100644))
+                    offset += len(header) + len(compressed) + len(descriptor)
+                    continue
+
+                try:
+                    f = open(path, 'rb')
+                except OSError:
+                    continue # removed or unreadable
+                with f:
+                    zip64 = needs_zip64(size, method)
+                    header = local_header(encoded_name, method, mtime, zip64)
+                    yield header
+                    compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15) if method == ZIP_DEFLATED else None
+                    crc = 0
+                    size = 0
+                    compressed_size = 0
+                    while data := f.read(READ_SIZE):
+                        crc = zlib.crc32(data, crc)
+                        size += len(data)
+                        if compressor is not None:
+                            data = compressor.compress(data)
+                        if data:
+                            compressed_size += len(data)
+                            yield data
+                    if compressor is not None:
+                        data = compressor.flush()
+                        compressed_size += len(data)
+                        yield data
+                    # a file that grew past the limit since it was listed still needs zip64
+                    # sizes, readers take them from the central directory
+                    zip64 = zip64 or size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT
+                    descriptor = data_descriptor(crc, compressed_size, size, zip64)
+                    yield descriptor
+                directory.append(central_header(encoded_name, method, mtime, zip64, crc,
+                                                 compressed_size, size, offset, 0o100644))
+                offset += len(header) + compressed_size + len(descriptor)
+
+            directory_data = b''.join(directory)
+            yield directory_data
+            yield end_records(len(directory), offset, len(directory_data))
+        finally:
+            # the client may disconnect in the middle, drop the work queued ahead
+            for entry in pending:
+                if entry[5] is not None:
+                    entry[5].cancel()
+
+
+class ZipLayout:
+    """
+    A store only zip archive whose layout is computed up front from the size of its
+    files, so its length is known and any byte range of it can be generated. This
+    makes interrupted zip downloads resumable.
+
+    The crc32 of a file is only known once it is read, so it is written in a data
+    descriptor after the file and in the central directory. Files read whole while
+    sending are hashed on the way, others get their crc32 from a DigestIndex which
+    caches it per (inode, size, mtime) for later requests.
+    """
+
+    def __init__(self, entries, digest_index):
+        """
+        :param entries: A list of (path, name in archive, os.stat_result).
+        :param digest_index: The DigestIndex used to look up and cache crc32.
+        """
+        self.digest_index = digest_index
+        self.entries = []
+        self.offsets = []
+        self.crcs = {}
+        offset = 0
+        directory_size = 0
+        etag = hashlib.blake2b(digest_size=16)
+        self.mtime = 0
+        for path, name, st in entries:
+            encoded_name = name.replace(os.sep, '/').encode('utf-8')
+            size = st.st_size
+            zip64 = size >= ZIP64_LIMIT
+            header = local_header(encoded_name, ZIP_STORED, st.st_mtime, zip64, compressed_size=size, size=size)
+            descriptor_size = 24 if zip64 else 16
+            self.offsets.append(offset)
+            self.entries.append((offset, header, path, st, encoded_name, zip64))
+            # the crc doesn't change the length of the record
+            directory_size += len(central_header(encoded_name, ZIP_STORED, st.st_mtime, zip64, 0, size, size, offset, st.st_mode))
+            offset += len(header) + size + descriptor_size
+            etag.update(f'{st.st_dev}:{st.st_ino}:{size}:{st.st_mtime_ns}:'.encode() + encoded_name + b'\0')
+            self.mtime = max(self.mtime, st.st_mtime)
+        self.directory_offset = offset
+        self.end = end_records(len(self.entries), offset, directory_size)
+        self.size = offset + directory_size + len(self.end)
+        self.etag = etag.hexdigest()
+
+    def _crc(self, index):
+        crc = self.crcs.get(index)
+        if crc is None:
+            _, _, path, st, _, _ = self.entries[index]
+            crc = self.crcs[index] = self.digest_index.crc32(path, st)
+        return crc
+
+    def _read_file(self, index, start, stop):
+        """Read part of a file, hashing it when it is read whole."""
+        _, _, path, st, _, _ = self.entries[index]
+        with open(path, 'rb') as f:
+            current = os.fstat(f.fileno())
+            if (current.st_size, current.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+                raise OSError(f'{path} changed while downloading')
+            whole = start == 0 and stop == st.st_size
+            crc = 0
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = f.read(min(READ_SIZE, remaining))
+                if not data:
+                    raise OSError(f'{path} changed while downloading')
+                if whole:
+                    crc = zlib.crc32(data, crc)
+                remaining -= len(data)
+                yield data
+        if whole and index not in self.crcs:
+            self.crcs[index] = crc
+            self.digest_index.set_key(path, st, format_digest(crc))
+
+    def read(self, start, stop):
+        """
+        :param start: The first byte to generate.
+        :param stop: The byte after the last one to generate.
+        :return: A generator of the bytes of the archive in the range.
+        """
+        index = max(0, bisect_right(self.offsets, start) - 1)
+        while index < len(self.entries) and self.offsets[index] < stop:
+            offset, header, path, st, encoded_name, zip64 = self.entries[index]
+            data_offset = offset + len(header)
+            descriptor_offset = data_offset + st.st_size
+            if start < data_offset:
+                yield header[max(start, offset) - offset:min(stop, data_offset) - offset]
+            if start < descriptor_offset and stop > data_offset:
+                yield from self._read_file(index, max(start, data_offset) - data_offset,
+                                           min(stop, descriptor_offset) - data_offset)
+            if stop > descriptor_offset:
+                descriptor = data_descriptor(self._crc(index), st.st_size, st.st_size, zip64)
+                if start < descriptor_offset + len(descriptor):
+                    yield descriptor[max(start, descriptor_offset) - descriptor_offset:stop - descriptor_offset]
+            index += 1
+
+        if stop > self.directory_offset:
+            directory = b''.join(
+                central_header(encoded_name, ZIP_STORED, st.st_mtime, zip64, self._crc(i),
+                               st.st_size, st.st_size, offset, st.st_mode)
+                for i, (offset, header, path, st, encoded_name, zip64) in enumerate(self.entries)
+            ) + self.end
+            yield directory[max(start - self.directory_offset, 0):stop - self.directory_offset]
@@ -37,6 +37,7 @@ def main():
     parser.add_argument('--readonly', '-r', action='store_true', help='Set read-only mode to disallow modifications.')
     parser.add_argument('--token', '-t', type=str, help='Enter custom token/password for authentication')
     parser.add_argument('--gunicorn-args', '-g', type=str, help='Enter custom gunicorn arguments')
+    parser.add_argument('--asgi', '-a', action='store_true', help='Serve with asyncio through uvicorn workers, needs the uvicorn and uvicorn-worker packages.')
 
     args = parser.parse_args()
 
@@ -75,7 +76,11 @@ def main():
         gunicorn_args = []
 
 
-    gunicorn_cmd = [gunicorn_path] + gunicorn_args + ["-c", "gunicornConfig.py", "app:app"]
+    if args.asgi:
+        # command line arguments take precedence over the worker_class of gunicornConfig.py
+        gunicorn_cmd = [gunicorn_path] + gunicorn_args + ["-c", "gunicornConfig.py", "-k", "uvicorn_worker.UvicornWorker", "app:asgi"]
+    else:
+        gunicorn_cmd = [gunicorn_path] + gunicorn_args + ["-c", "gunicornConfig.py", "app:app"]
     subprocess.run(gunicorn_cmd)
 
 if __name__ == "__main__":
@@ -2,11 +2,7 @@
 document.getElementById('selected-folder').addEventListener('change', updateUI);
 // Initially update the UI on start
 document.addEventListener('DOMContentLoaded', updateUI);
-
-const token = getTokenFromUrl();
-if (token) {
-    setCookie('token', token, 7);
-}
+document.addEventListener('DOMContentLoaded', listenToChanges);
 
 
 
@@ -20,10 +16,11 @@ function getTokenFromUrl() {
     return params.get('token'); // Returns the part of the url with the 'token' parameter
 }
 
-// Copy the token argument from the current URL to pass it on to other urls
+// Copy the token argument from the current URL to pass it on to other urls. Not
+// needed when cookies are enabled since the server sent a signed session cookie.
 function copyTokenQueryString() {
     const token = getTokenFromUrl();
-    if (token) {
+    if (token && !navigator.cookieEnabled) {
         return `token=${token}`;
     } else {
         return '';
@@ -45,11 +42,6 @@ function setProgressbar(percentComplete, filesLeft) {
 }
 
 
-function setCookie(name, value, days) {
-    const expires = new Date(Date.now() + days * 86400000).toUTCString();
-    document.cookie = name + '=' + encodeURIComponent(value) + '; expires=' + expires + '; path=/';
-}
-
 function dirname(filepath) {
     filepath = normalizePath(filepath)
 
@@ -69,6 +61,178 @@ function joinPaths(paths) {
     return normalizePath(joinedSegments.join('/'));
 }
 
+// Lookup table of crc32 (the same as zlib) for crc32()
+const CRC32_TABLE = (() => {
+    const table = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = (c & 1) ? (0xedb88320 ^ (c >>> 1)) : (c >>> 1);
+        }
+        table[n] = c >>> 0;
+    }
+    return table;
+})();
+
+/**
+ * Compute the crc32 of some data.
+ * @param {Uint8Array} data - The data to checksum.
+ * @param {number} crc - The crc32 of the previous data to continue from.
+ * @return {number} The crc32 as an unsigned number.
+ */
+function crc32(data, crc = 0) {
+    crc = crc ^ 0xffffffff;
+    for (let i = 0; i < data.length; i++) {
+        crc = CRC32_TABLE[(crc ^ data[i]) & 0xff] ^ (crc >>> 8);
+    }
+    return (crc ^ 0xffffffff) >>> 0;
+}
+
+// Format a crc32 the same way as the server
+function crc32Hex(crc) {
+    return crc.toString(16).padStart(8, '0');
+}
+
+// Round constants of sha256 for Sha256
+const SHA256_K = new Int32Array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+]);
+
+/**
+ * An incremental sha256. crypto.subtle can only hash a whole file at once and isn't
+ * available over plain http.
+ */
+class Sha256 {
+    constructor() {
+        // signed so every value stays a small integer for the js engine
+        this.state = new Int32Array([
+            0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+        this.buffer = new Uint8Array(64);
+        this.buffered = 0;
+        this.length = 0;
+        this.w = new Int32Array(64);
+    }
+
+    /**
+     * @param {Uint8Array} data - The next bytes to hash.
+     */
+    update(data) {
+        this.length += data.length;
+        let i = 0;
+        if (this.buffered > 0) {
+            i = Math.min(64 - this.buffered, data.length);
+            this.buffer.set(data.subarray(0, i), this.buffered);
+            this.buffered += i;
+            if (this.buffered < 64) {
+                return;
+            }
+            this.blocks(this.buffer, 0, 64);
+            this.buffered = 0;
+        }
+        const end = i + Math.floor((data.length - i) / 64) * 64;
+        this.blocks(data, i, end);
+        this.buffer.set(data.subarray(end), 0);
+        this.buffered = data.length - end;
+    }
+
+    // Hash the 64 byte blocks of data from offset to end.
+    blocks(data, offset, end) {
+        const w = this.w;
+        const state = this.state;
+        let a = state[0], b = state[1], c = state[2], d = state[3];
+        let e = state[4], f = state[5], g = state[6], h = state[7];
+        for (; offset < end; offset += 64) {
+            for (let t = 0; t < 16; t++) {
+                const j = offset + t * 4;
+                w[t] = (data[j] << 24) | (data[j + 1] << 16) | (data[j + 2] << 8) | data[j + 3];
+            }
+            for (let t = 16; t < 64; t++) {
+                const x = w[t - 15];
+                const y = w[t - 2];
+                const s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+                const s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+                w[t] = (((w[t - 16] + s0) | 0) + ((w[t - 7] + s1) | 0)) | 0;
+            }
+            let a1 = a, b1 = b, c1 = c, d1 = d, e1 = e, f1 = f, g1 = g, h1 = h;
+            for (let t = 0; t < 64; t++) {
+                // every addition is truncated to 32 bits so it never becomes a float
+                const s1 = ((e1 >>> 6) | (e1 << 26)) ^ ((e1 >>> 11) | (e1 << 21)) ^ ((e1 >>> 25) | (e1 << 7));
+                const t1 = (((h1 + s1) | 0) + ((((e1 & f1) ^ (~e1 & g1)) + ((SHA256_K[t] + w[t]) | 0)) | 0)) | 0;
+                const s0 = ((a1 >>> 2) | (a1 << 30)) ^ ((a1 >>> 13) | (a1 << 19)) ^ ((a1 >>> 22) | (a1 << 10));
+                const t2 = (s0 + ((a1 & b1) ^ (a1 & c1) ^ (b1 & c1))) | 0;
+                h1 = g1;
+                g1 = f1;
+                f1 = e1;
+                e1 = (d1 + t1) | 0;
+                d1 = c1;
+                c1 = b1;
+                b1 = a1;
+                a1 = (t1 + t2) | 0;
+            }
+            a = (a + a1) | 0;
+            b = (b + b1) | 0;
+            c = (c + c1) | 0;
+            d = (d + d1) | 0;
+            e = (e + e1) | 0;
+            f = (f + f1) | 0;
+            g = (g + g1) | 0;
+            h = (h + h1) | 0;
+        }
+        state[0] = a;
+        state[1] = b;
+        state[2] = c;
+        state[3] = d;
+        state[4] = e;
+        state[5] = f;
+        state[6] = g;
+        state[7] = h;
+    }
+
+    /**
+     * Finish hashing, no more data can be added.
+     * @return {string} The hex sha256.
+     */
+    hexdigest() {
+        const length = this.length;
+        const padding = new Uint8Array((this.buffered < 56 ? 64 : 128) - this.buffered);
+        const view = new DataView(padding.buffer);
+        padding[0] = 0x80;
+        // the length in bits as a 64 bit big endian integer
+        view.setUint32(padding.length - 8, Math.floor(length / 0x20000000));
+        view.setUint32(padding.length - 4, (length * 8) >>> 0);
+        this.update(padding);
+        return Array.from(this.state, v => (v >>> 0).toString(16).padStart(8, '0')).join('');
+    }
+}
+
+const SUBTLE_DIGEST_MAX_SIZE = 256 * 1024 * 1024;
+
+/**
+ * Compute the sha256 of a whole file, sent to the server to find the same content.
+ * @param {File} file - The file to read.
+ * @return {Promise} A promise of the content hash string like 'sha256:<hex>'.
+ */
+async function fileSha256(file) {
+    if (window.crypto && crypto.subtle && file.size <= SUBTLE_DIGEST_MAX_SIZE) {
+        // native and much faster, but only on https and for a file read at once
+        const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return 'sha256:' + Array.from(new Uint8Array(digest), v => v.toString(16).padStart(2, '0')).join('');
+    }
+    const readSize = 4 * 1024 * 1024;
+    const hasher = new Sha256();
+    for (let start = 0; start < file.size; start += readSize) {
+        hasher.update(new Uint8Array(await file.slice(start, start + readSize).arrayBuffer()));
+    }
+    return 'sha256:' + hasher.hexdigest();
+}
+
 function normalizePath(rawPath) {
     const segments = rawPath.split('/');
     const normalizedSegments = [];
@@ -94,19 +258,20 @@ function normalizePath(rawPath) {
 document.getElementById('uploadform').addEventListener('submit', (event) => {
     event.preventDefault(); // Prevent the default form submission
 
-    uploadFileRecursive(
+    uploadFiles(
         Array.from(document.getElementById('fileInput').files),
         document.getElementById('selected-folder').value,
-        document.getElementById('resume').checked
+        document.getElementById('resume').checked,
+        document.getElementById('dedup').checked
     );
 
 });
 
-function updateOptions(folderOptions, data) {
+function updateOptions(folderOptions, folders) {
     // update folder search options
-    // fetch and populate the folder dropdown
+    // populate the folder dropdown with the folders loaded so far
     folderOptions.innerHTML = ''; // clear previous list
-    data.folders.forEach(folder => {
+    folders.forEach(folder => {
         const option = document.createElement('option');
         option.value = folder;
         option.textContent = folder;
@@ -115,93 +280,648 @@ function updateOptions(folderOptions, data) {
 }
 
 
-// Recursively upload files
-function uploadFileRecursive(fileArray, folder, resume) {
-    if (fileArray.length == 0) {
-        alert("All uploads complete");
-        updateUI();
-        resetBar();
-        return;
+// The number of chunks of a file uploaded at the same time.
+const UPLOAD_CONCURRENCY = 4;
+// The chunk size is grown or shrunk so each request takes between these many milliseconds.
+const CHUNK_TARGET_MIN_MS = 1000;
+const CHUNK_TARGET_MAX_MS = 3000;
+// The bytes sent per request. Starts at the server default and adapts to the throughput.
+let uploadChunkSize = null;
+
+/**
+ * Adjust uploadChunkSize after a request.
+ * @param {number} elapsed - The milliseconds the request took.
+ * @param {Object} session - The upload session with the chunk sizes allowed by the server.
+ */
+function adaptChunkSize(elapsed, session) {
+    if (elapsed < CHUNK_TARGET_MIN_MS) {
+        uploadChunkSize = Math.min(uploadChunkSize * 2, session.maxChunkSize);
+    } else if (elapsed > CHUNK_TARGET_MAX_MS) {
+        uploadChunkSize = Math.max(Math.floor(uploadChunkSize / 2), session.minChunkSize);
     }
-    file = fileArray.pop();
-    const chunkSize = 1000 * 500;
-    const token = copyTokenQueryString();
-    const totalChunks = Math.ceil(file.size / chunkSize);
-    let currentChunk = 0;
-    
-    
-    //recursively upload file chunks
-    const uploadChunk = (start) => {
-        const end = Math.min(start + chunkSize, file.size);
-        const chunk = file.slice(start, end);
-        const formData = new FormData();
-        formData.append('file', chunk, file.name);
-        formData.append('folder', folder);
-        formData.append('chunk', currentChunk);
-        formData.append('fileSize', file.size);
-        formData.append('resume', resume);
-        
-        const xhr = new XMLHttpRequest();
-        xhr.open('POST', `/upload?${token}`, true);
+}
 
-        xhr.upload.addEventListener('progress', (e) => {
-            if (e.lengthComputable) {
-                setProgressbar(((currentChunk + 1) / totalChunks) * 100, fileArray.length);
-            }
-        });
+// Requests refused with a 503 while the server has too many transfers are sent again this many times.
+const BUSY_RETRIES = 10;
 
+/**
+ * Send a request with XMLHttpRequest and parse the json response. Requests the
+ * server is too busy for are sent again after its Retry-After delay.
+ * @param {string} method - The http method.
+ * @param {string} url - The url to send to.
+ * @param {FormData|Blob} body - The form or raw data to send.
+ * @param {Object} headers - Extra request headers.
+ * @param {number} retries - How many more times to send a request refused with a 503.
+ * @return {Promise} A promise of the json response. Rejects with a message on failure.
+ */
+function sendRequest(method, url, body, headers = {}, retries = BUSY_RETRIES) {
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhr.open(method, url, true);
+        Object.entries(headers).forEach(([name, value]) => xhr.setRequestHeader(name, value));
         xhr.onload = () => {
+            if (xhr.status === 503 && retries > 0) {
+                const delay = parseFloat(xhr.getResponseHeader('Retry-After')) || 1;
+                setTimeout(() => sendRequest(method, url, body, headers, retries - 1).then(resolve, reject),
+                           delay * 1000);
+                return;
+            }
             let response;
             try {
                 response = JSON.parse(xhr.responseText);
             } catch (e) {
-                alert(xhr.responseText); //something seriously gone wrong server side
+                reject(xhr.responseText); //something seriously gone wrong server side
                 return;
             }
             if (xhr.status === 200) {
-                if (response.code == "RESUME_UPLOAD") { //server asking to resume to specific index
-                    console.log(response.message);
-                    currentChunk = Number(response.resumeChunk);
-                    uploadChunk(currentChunk * chunkSize);
-                    return;
-                } else if (response.code == "FILE_ALREADY_UPLOADED") {
-                    console.log(response.message);
-                    uploadFileRecursive(fileArray, folder, resume);
-                    return;
-                }
-                currentChunk++;
-                console.log("Uploading chunk " + currentChunk);
-                if (currentChunk < totalChunks) {
-                    uploadChunk(start + chunkSize); // Upload the next chunk
-                } else {
-                    console.log('Upload successful!');
-                    uploadFileRecursive(fileArray, folder, resume);
-                }
+                resolve(response);
             } else {
-                alert('Upload failed: ' + response.message);
-                resetBar();
+                reject(response.message);
             }
         };
+        xhr.onerror = () => reject("Network error occurred during the upload.");
+        xhr.onabort = () => reject("Upload aborted.");
+        xhr.send(body);
+    });
+}
 
-        xhr.onerror = () => {
-            alert("Network error occurred during the upload.");
-            resetBar();
-        };
+let uploadConfig = null;
+
+/**
+ * @return {Promise} A promise of the json of /upload/config, fetched once.
+ */
+function getUploadConfig() {
+    if (uploadConfig === null) {
+        const token = copyTokenQueryString();
+        uploadConfig = fetch(`/upload/config?${token}`).then(response => response.json());
+    }
+    return uploadConfig;
+}
+
+/**
+ * Start an upload session. With dedup, large files send their sha256 so the server
+ * can create them from the same content without an upload. When the server already has a file
+ * of the same size, its sha256 is compared with the sha256 of the local file first.
+ * @param {File} file - The file to upload.
+ * @param {string} folder - The folder to upload to.
+ * @param {boolean} resume - Whether to resume an earlier upload.
+ * @param {boolean} dedup - Whether to send the sha256 of large files.
+ * @return {Promise} A promise of the json response of /upload/session.
+ */
+function createUploadSession(file, folder, resume, dedup) {
+    const token = copyTokenQueryString();
+    const sessionForm = new FormData();
+    sessionForm.append('folder', folder);
+    sessionForm.append('filename', file.name);
+    sessionForm.append('fileSize', file.size);
+    sessionForm.append('resume', resume);
+
+    return getUploadConfig()
+        .then(config => {
+            // large files are hashed first so the server can skip content it already has
+            if (!dedup || config.dedupMinSize === null || file.size < config.dedupMinSize) {
+                return null;
+            }
+            document.getElementById('progress-container').style.display = 'block';
+            document.getElementById('progress-text').innerText = `Looking for ${file.name} on the server`;
+            return fileSha256(file);
+        })
+        .then(contentHash => {
+            if (contentHash !== null) {
+                sessionForm.append('contentHash', contentHash);
+            }
+            return sendRequest('POST', `/upload/session?${token}`, sessionForm);
+        })
+        .then(session => {
+            if (session.code !== "DIGEST_REQUIRED") {
+                return session;
+            }
+            return fileSha256(file).then(contentHash => {
+                if (contentHash === session.contentHash) {
+                    return {code: 'FILE_ALREADY_UPLOADED', message: 'File already uploaded'};
+                }
+                sessionForm.append('contentHash', contentHash);
+                return sendRequest('POST', `/upload/session?${token}`, sessionForm);
+            });
+        });
+}
+
+// Small files are packed into tar archives of at most this many files, each sent in one request.
+const BATCH_MAX_FILES = 1000;
+const TAR_BLOCK_SIZE = 512;
+const textEncoder = new TextEncoder();
+
+/**
+ * Write an ascii string into a tar header.
+ * @param {Uint8Array} block - The header block.
+ * @param {number} offset - The offset of the field.
+ * @param {string} value - The value of the field.
+ */
+function setTarField(block, offset, value) {
+    block.set(textEncoder.encode(value), offset);
+}
+
+/**
+ * Build a ustar header block.
+ * @param {Uint8Array} name - The utf-8 name, at most 100 bytes.
+ * @param {number} size - The size of the entry.
+ * @param {number} mtime - The modification time in seconds.
+ * @param {string} type - The type flag, '0' for a file or 'x' for a pax header.
+ * @return {Uint8Array} The header block.
+ */
+function ustarHeader(name, size, mtime, type) {
+    const block = new Uint8Array(TAR_BLOCK_SIZE);
+    block.set(name, 0);
+    setTarField(block, 100, '0000644\0');
+    setTarField(block, 108, '0000000\0');
+    setTarField(block, 116, '0000000\0');
+    setTarField(block, 124, size.toString(8).padStart(11, '0') + '\0');
+    setTarField(block, 136, mtime.toString(8).padStart(11, '0') + '\0');
+    setTarField(block, 148, '        '); // the checksum is computed with spaces in its field
+    setTarField(block, 156, type);
+    setTarField(block, 257, 'ustar\0' + '00');
+    const checksum = block.reduce((sum, value) => sum + value, 0);
+    setTarField(block, 148, checksum.toString(8).padStart(6, '0') + '\0 ');
+    return block;
+}
+
+/**
+ * Build the header blocks of a file in a tar archive. Names that don't fit in
+ * ustar are sent in a pax header before it.
+ * @param {string} name - The path of the file in the archive.
+ * @param {number} size - The size of the file.
+ * @param {number} mtime - The modification time in seconds.
+ * @return {Array} The header blocks as Uint8Arrays.
+ */
+function tarHeaders(name, size, mtime) {
+    const encodedName = textEncoder.encode(name);
+    if (encodedName.length <= 100 && encodedName.every(value => value < 128)) {
+        return [ustarHeader(encodedName, size, mtime, '0')];
+    }
+    // a pax record is "<length> path=<name>\n" where the length counts its own digits
+    const record = ` path=${name}\n`;
+    const recordLength = textEncoder.encode(record).length;
+    let length = recordLength;
+    while (String(length).length + recordLength !== length) {
+        length = String(length).length + recordLength;
+    }
+    const pax = new Uint8Array(Math.ceil(length / TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE);
+    pax.set(textEncoder.encode(length + record));
+    const asciiName = textEncoder.encode(name.replace(/[^\x20-\x7e]/g, '_').slice(-100));
+    return [ustarHeader(textEncoder.encode('PaxHeader'), length, mtime, 'x'), pax,
+            ustarHeader(asciiName, size, mtime, '0')];
+}
+
+/**
+ * Pack files into a tar archive.
+ * @param {Array} files - The files to pack.
+ * @return {Promise} A promise of {body, checksum} where body is a Blob and checksum
+ * the crc32 of the whole archive in the format of /upload/batch.
+ */
+async function tarFiles(files) {
+    const parts = [];
+    let crc = 0;
+    const add = part => {
+        parts.push(part);
+        crc = crc32(part, crc);
+    };
+    for (const file of files) {
+        tarHeaders(file.name, file.size, Math.floor(file.lastModified / 1000)).forEach(add);
+        add(new Uint8Array(await file.arrayBuffer()));
+        if (file.size % TAR_BLOCK_SIZE) {
+            add(new Uint8Array(TAR_BLOCK_SIZE - file.size % TAR_BLOCK_SIZE));
+        }
+    }
+    add(new Uint8Array(2 * TAR_BLOCK_SIZE)); // the end of the archive
+    return {body: new Blob(parts, {type: 'application/x-tar'}), checksum: 'crc32=' + crc32Hex(crc)};
+}
+
+/**
+ * Group small files into batches whose tar archive fits in one request.
+ * @param {Array} files - Files smaller than the batchMaxFileSize of the server.
+ * @param {number} maxSize - The maximum size of a request.
+ * @return {Array} The batches as arrays of files.
+ */
+function groupBatches(files, maxSize) {
+    const batches = [];
+    let batch = [];
+    let size = 2 * TAR_BLOCK_SIZE;
+    files.forEach(file => {
+        // the worst case with a pax header
+        const entrySize = 3 * TAR_BLOCK_SIZE + Math.ceil(file.size / TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE;
+        if (batch.length > 0 && (batch.length === BATCH_MAX_FILES || size + entrySize > maxSize)) {
+            batches.push(batch);
+            batch = [];
+            size = 2 * TAR_BLOCK_SIZE;
+        }
+        batch.push(file);
+        size += entrySize;
+    });
+    if (batch.length > 0) {
+        batches.push(batch);
+    }
+    return batches;
+}
+
+/**
+ * Upload small files in batches sent in parallel, then the other files one by one.
+ * @param {Array} files - The files to upload.
+ * @param {string} folder - The folder to upload to.
+ * @param {boolean} resume - Whether to resume earlier uploads.
+ * @param {boolean} dedup - Whether to send the sha256 of large files.
+ */
+function uploadFiles(files, folder, resume, dedup) {
+    const token = copyTokenQueryString();
+    getUploadConfig()
+        .then(config => {
+            const small = [];
+            const large = [];
+            files.forEach(file => {
+                (config.batchMaxFileSize && file.size < config.batchMaxFileSize ? small : large).push(file);
+            });
+            const batches = groupBatches(small, config.maxChunkSize);
+            const url = `/upload/batch?${token}&folder=${encodeURIComponent(folder)}&resume=${resume}`;
+            let doneFiles = 0;
+            let failed = false;
+            const errors = [];
+
+            // like the chunks of a file, each worker sends batches one after another
+            const worker = () => {
+                if (failed || batches.length === 0) {
+                    return Promise.resolve();
+                }
+                const batch = batches.shift();
+                return tarFiles(batch)
+                    .then(tar => sendRequest('PUT', `${url}&checksum=${tar.checksum}`, tar.body,
+                                             {'Content-Type': 'application/x-tar'}))
+                    .then(result => {
+                        errors.push(...(result.errors || []));
+                        doneFiles += batch.length;
+                        setProgressbar((doneFiles / small.length) * 100, files.length - doneFiles);
+                        return worker();
+                    }, message => {
+                        failed = true;
+                        throw message;
+                    });
+            };
 
-        xhr.onabort = () => {
-            alert("Upload aborted.");
+            const workers = [];
+            for (let i = 0; i < UPLOAD_CONCURRENCY; i++) {
+                workers.push(worker());
+            }
+            return Promise.all(workers).then(() => {
+                if (errors.length) {
+                    alert('Some files could not be written: ' + errors.map(error => `${error.name}: ${error.message}`).join('\n'));
+                }
+                return uploadFileRecursive(large, folder, resume, dedup);
+            });
+        })
+        .catch(message => {
+            alert('Upload failed: ' + message);
             resetBar();
-        };
+        });
+}
 
-        xhr.send(formData);
+// The modulus of adler32, the rolling checksum matched against the blocks of a delta upload.
+const ADLER_MOD = 65521;
+// Instruction types of /upload/delta.
+const DELTA_COPY = 0;
+const DELTA_DATA = 1;
+// Changed data is sent in instructions of at most this many bytes.
+const DELTA_DATA_MAX = 1024 * 1024;
+// The file is read and matched in segments of this many bytes.
+const DELTA_READ_SIZE = 16 * 1024 * 1024;
+
+/**
+ * Upload a new version of a file already on the server by sending only what changed.
+ * The adler32 of the block at every offset of the file is computed with a rolling sum
+ * and looked up in the signatures of the server, a crc32 confirms each match. Matched
+ * blocks are sent as copy instructions and the bytes in between as data.
+ * @param {File} file - The file to upload.
+ * @param {string} folder - The folder to upload to.
+ * @param {Object} config - The json of /upload/config.
+ * @param {number} filesLeft - The number of files left, for the progress bar.
+ * @return {Promise} A promise of whether the file was uploaded, if not it should be
+ * uploaded normally.
+ */
+async function deltaUpload(file, folder, config, filesLeft) {
+    const token = copyTokenQueryString();
+    const form = new FormData();
+    form.append('folder', folder);
+    form.append('filename', file.name);
+    let delta;
+    try {
+        delta = await sendRequest('POST', `/upload/delta?${token}`, form);
+    } catch (message) {
+        return false; // not on the server yet
+    }
+    const blockSize = delta.blockSize;
+    const signatures = Uint8Array.from(atob(delta.signatures), c => c.charCodeAt(0));
+    const view = new DataView(signatures.buffer);
+    const blocks = signatures.length / 8;
+    if (blocks === 0) {
+        return false;
+    }
+    // a bitmap of 16 bits of the adler32 of every block rules out most offsets
+    // before the map is looked up
+    const filter = new Uint8Array(65536);
+    const blocksByWeak = new Map();
+    const strong = new Uint32Array(blocks);
+    for (let i = 0; i < blocks; i++) {
+        const weak = view.getUint32(i * 8, true);
+        strong[i] = view.getUint32(i * 8 + 4, true);
+        filter[(weak ^ (weak >>> 16)) & 0xffff] = 1;
+        if (!blocksByWeak.has(weak)) {
+            blocksByWeak.set(weak, []);
+        }
+        blocksByWeak.get(weak).push(i);
+    }
+
+    const params = `${token}&folder=${encodeURIComponent(folder)}&filename=${encodeURIComponent(file.name)}` +
+        `&upload=${delta.upload}&basis=${delta.basis}&fileSize=${file.size}`;
+    // instructions are sent in requests of up to maxChunkSize bytes, each starting
+    // at its offset in the new file so they can be sent in parallel
+    let parts = [];
+    let partsSize = 0;
+    let partsOffset = 0;
+    let outputOffset = 0;
+    let sentBytes = 0;
+    let pending = [];
+    let failure = null;
+    const send = async () => {
+        const body = new Blob(parts);
+        sentBytes += body.size;
+        const url = `/upload/delta?${params}&offset=${partsOffset}`;
+        parts = [];
+        partsSize = 0;
+        partsOffset = outputOffset;
+        pending.push(sendRequest('PUT', url, body, {'Content-Type': 'application/octet-stream'})
+            .catch(message => { failure = message; }));
+        if (pending.length >= UPLOAD_CONCURRENCY) {
+            await pending.shift();
+        }
+    };
+    const emit = async (instruction, length) => {
+        if (partsSize + instruction.length > config.maxChunkSize && parts.length > 0) {
+            await send();
+        }
+        parts.push(instruction);
+        partsSize += instruction.length;
+        outputOffset += length;
     };
+    // consecutive matched blocks are sent as one copy
+    let copyIndex = -1;
+    let copyCount = 0;
+    const emitCopy = async () => {
+        if (copyCount > 0) {
+            const instruction = new Uint8Array(9);
+            const args = new DataView(instruction.buffer);
+            instruction[0] = DELTA_COPY;
+            args.setUint32(1, copyIndex, true);
+            args.setUint32(5, copyCount, true);
+            const length = copyCount * blockSize;
+            copyCount = 0;
+            await emit(instruction, length);
+        }
+    };
+
+    // buffer holds the file from the start of the data not sent yet
+    let buffer = new Uint8Array(0);
+    let position = 0;
+    let dataStart = 0;
+    let loaded = 0;
+    const hasher = new Sha256();
+    const emitData = async end => {
+        if (end > dataStart) {
+            await emitCopy();
+            const instruction = new Uint8Array(5 + end - dataStart);
+            instruction[0] = DELTA_DATA;
+            new DataView(instruction.buffer).setUint32(1, end - dataStart, true);
+            instruction.set(buffer.subarray(dataStart, end), 5);
+            dataStart = end;
+            await emit(instruction, instruction.length - 5);
+        }
+    };
+    const load = async () => {
+        const data = new Uint8Array(await file.slice(loaded, loaded + DELTA_READ_SIZE).arrayBuffer());
+        loaded += data.length;
+        hasher.update(data);
+        const merged = new Uint8Array(buffer.length - dataStart + data.length);
+        merged.set(buffer.subarray(dataStart));
+        merged.set(data, buffer.length - dataStart);
+        position -= dataStart;
+        dataStart = 0;
+        buffer = merged;
+        setProgressbar((loaded / file.size) * 100, filesLeft);
+    };
+
+    let a = 0;
+    let b = 0;
+    let rolling = false;
+    while (failure === null) {
+        if (position + blockSize > buffer.length) {
+            if (loaded >= file.size) {
+                break;
+            }
+            await load();
+            continue;
+        }
+        if (!rolling) {
+            a = 1;
+            b = 0;
+            for (let i = position; i < position + blockSize; i++) {
+                a += buffer[i];
+                b += a;
+            }
+            a %= ADLER_MOD;
+            b %= ADLER_MOD;
+            rolling = true;
+        }
+        const weak = ((b << 16) | a) >>> 0;
+        let match = -1;
+        if (filter[(weak ^ (weak >>> 16)) & 0xffff] && blocksByWeak.has(weak)) {
+            const checksum = crc32(buffer.subarray(position, position + blockSize));
+            match = blocksByWeak.get(weak).find(i => strong[i] === checksum) ?? -1;
+        }
+        if (match >= 0) {
+            await emitData(position);
+            if (copyCount > 0 && copyIndex + copyCount === match) {
+                copyCount++;
+            } else {
+                await emitCopy();
+                copyIndex = match;
+                copyCount = 1;
+            }
+            position += blockSize;
+            dataStart = position;
+            rolling = false;
+        } else {
+            if (position + blockSize < buffer.length) {
+                const out = buffer[position];
+                a = (a - out + buffer[position + blockSize] + ADLER_MOD) % ADLER_MOD;
+                b = ((b - blockSize * out + a - 1) % ADLER_MOD + ADLER_MOD) % ADLER_MOD;
+            } else {
+                rolling = false;
+            }
+            position++;
+            if (position - dataStart >= DELTA_DATA_MAX) {
+                await emitData(position);
+            }
+        }
+    }
+    await emitData(buffer.length);
+    await emitCopy();
+    if (parts.length > 0) {
+        await send();
+    }
+    await Promise.all(pending);
+    if (failure !== null) {
+        console.log('Delta upload failed: ' + failure);
+        return false;
+    }
 
-    uploadChunk(0); // Start uploading the first chunk
+    const commitForm = new FormData();
+    commitForm.append('folder', folder);
+    commitForm.append('filename', file.name);
+    commitForm.append('upload', delta.upload);
+    commitForm.append('basis', delta.basis);
+    commitForm.append('fileSize', file.size);
+    commitForm.append('checksum', 'sha256=' + hasher.hexdigest());
+    try {
+        await sendRequest('POST', `/upload/delta/commit?${token}`, commitForm);
+    } catch (message) {
+        console.log('Delta upload failed: ' + message);
+        return false;
+    }
+    console.log(`Sent the changes of ${file.name} in ${sentBytes} bytes`);
+    return true;
+}
+
+// Recursively upload files
+function uploadFileRecursive(fileArray, folder, resume, dedup) {
+    if (fileArray.length == 0) {
+        alert("All uploads complete");
+        refreshTree();
+        resetBar();
+        return;
+    }
+    const file = fileArray.pop();
+    const token = copyTokenQueryString();
+
+    getUploadConfig()
+        .then(config => {
+            if (config.deltaMinSize === null || file.size < config.deltaMinSize) {
+                return false;
+            }
+            return deltaUpload(file, folder, config, fileArray.length);
+        })
+        .then(uploaded => {
+            if (uploaded) {
+                return {code: 'DELTA_UPLOADED', message: 'Uploaded the changes of the file'};
+            }
+            return createUploadSession(file, folder, resume, dedup);
+        })
+        .then(session => {
+            if (session.code === "DEDUPLICATED" && session.job) {
+                followJob(session.job, `Copying ${file.name} on the server`);
+                return;
+            }
+            if (session.code !== "SESSION_CREATED") { // already uploaded or empty
+                console.log(session.message);
+                return;
+            }
+            const chunkSize = session.chunkSize;
+            const totalChunks = Math.ceil(file.size / chunkSize);
+            const queue = session.missing.slice();
+            let doneChunks = totalChunks - queue.length;
+            let failed = false;
+            if (uploadChunkSize === null) {
+                uploadChunkSize = session.defaultChunkSize;
+            }
+
+            // each worker uploads chunks from the queue one after another
+            const worker = () => {
+                if (failed || queue.length === 0) {
+                    return Promise.resolve();
+                }
+                // send as many consecutive missing chunks as fit in uploadChunkSize
+                const chunkIndex = queue.shift();
+                const maxCount = Math.max(1, Math.floor(uploadChunkSize / chunkSize));
+                let count = 1;
+                while (count < maxCount && queue.length > 0 && queue[0] === chunkIndex + count) {
+                    queue.shift();
+                    count++;
+                }
+                const start = chunkIndex * chunkSize;
+                const startTime = performance.now();
+                return file.slice(start, Math.min(start + count * chunkSize, file.size)).arrayBuffer()
+                    .then(buffer => {
+                        const chunk = new Uint8Array(buffer);
+                        const headers = {
+                            'Content-Type': 'application/octet-stream',
+                            'X-Upload-Session': session.session,
+                            'X-Upload-Chunk': chunkIndex,
+                            'X-Upload-Count': count,
+                            'X-Chunk-Checksum': 'crc32=' + crc32Hex(crc32(chunk)),
+                        };
+                        return sendRequest('PUT', `/upload/chunk?${token}`, chunk, headers);
+                    })
+                    .then(() => {
+                        adaptChunkSize(performance.now() - startTime, session);
+                        doneChunks += count;
+                        setProgressbar((doneChunks / totalChunks) * 100, fileArray.length);
+                        return worker();
+                    }, message => {
+                        failed = true; // stop the other workers
+                        throw message;
+                    });
+            };
+
+            const workers = [];
+            for (let i = 0; i < UPLOAD_CONCURRENCY; i++) {
+                workers.push(worker());
+            }
+            return Promise.all(workers).then(() => console.log('Upload successful!'));
+        })
+        .then(() => uploadFileRecursive(fileArray, folder, resume, dedup))
+        .catch(message => {
+            alert('Upload failed: ' + message);
+            resetBar();
+        });
 }
 
 
 
 ////////////////////////////////Handling directory tree////////////////////////////////////
+// Every folder path (relative to the upload folder) loaded so far. Used for folder suggestions.
+const knownFolders = new Set(['']);
+
+/**
+ * Fetch one page of a directory listing.
+ * @param {string} folder - A folder path relative to the upload folder.
+ * @param {string} cursor - The cursor of the previous page or null for the first page.
+ * @return {Promise} A promise of the json with keys 'entries' and 'cursor'.
+ */
+function fetchListing(folder, cursor) {
+    const token = copyTokenQueryString();
+    let url = `/files?${token}&lazy=true&folder=${encodeURIComponent(folder)}`;
+    if (cursor) {
+        url += `&cursor=${encodeURIComponent(cursor)}`;
+    }
+    return fetch(url).then(response => response.json());
+}
+
+// Format a size in bytes to be human readable
+function formatSize(size) {
+    const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+    let i = 0;
+    while (size >= 1000 && i < units.length - 1) {
+        size /= 1000;
+        i++;
+    }
+    return (i === 0 ? size : size.toFixed(1)) + ' ' + units[i];
+}
+
 /**
  * Update the directory tree and folder dropdown listings
  */
@@ -209,239 +929,547 @@ function updateUI() {
     const token = copyTokenQueryString();
     const selectedFolder = document.getElementById('selected-folder').value;
     const fileListContainer = document.getElementById('file-list');
-    const folderOptions = document.getElementById('folderlist');
     fileListContainer.innerHTML = '';
     
     
     //update the zip download directory
     document.getElementById('zip').href = `/zip/${selectedFolder}?${token}`;
 
+    // only the selected folder is fetched, subfolders are fetched when they are opened.
+    knownFolders.clear();
+    knownFolders.add('');
+    loadedFolders.clear();
+    treeElements.clear();
+    selectedPaths.clear();
+    updateSelection();
+    const root = {name: '', path: selectedFolder};
+    const rootElement = renderNode(root, root);
+    fileListContainer.appendChild(rootElement);
+    rootElement.open = true;
+}
 
-    // fetches the files data to build and render the file tree. Also update folder options
-    fetch(`/files?${token}&folder=${encodeURIComponent(selectedFolder)}`)
-        .then(response => response.json())
+/**
+ * Fetch the entries of a folder and add them to its element. When the listing has more
+ * pages, a button is added at the end to load the next page.
+ * @param {HTMLElement} details - The element of the folder.
+ * @param {Object} node - The {name, path} of the folder.
+ * @param {string} cursor - The cursor of the page to load or null for the first page.
+ */
+function loadFolder(details, node, cursor) {
+    const folderPath = joinPaths([node.path, node.name]);
+    fetchListing(folderPath, cursor)
         .then(data => {
-            const folders = data.folders; // e.g. ['', 'a', 'a/b', ...]
-            const files = data.files; // e.g. ['a/b/foo.txt', 'a/bar.txt', ...]
-            const root = buildTree(folders, files);
-            renderTree(root, fileListContainer);
-            
-            updateOptions(folderOptions, data);
-        });
-
-    /**
-     * Build a nested tree structure based on an array of folderPaths and filePaths
-     * @param {string[]} folderPaths - An array of folder path strings from some directory.
-     * @param {string[]} filePaths - An array of file path strings from some directory
-     * @return {Node} The root node object of this tree.
-     */
-    function buildTree(folderPaths, filePaths) {
-        function Node(name, path) {
-            this.name = name; // folder name of this node
-            this.path = path; // folder path to this node.
-            this.folders = {}; // the nested folder nodes in this folder node
-            this.files = []; // array of {file_name:path} in this folder node
-        }
-
-        const root = new Node('', selectedFolder); // root node represents UPLOAD_FOLDER
-
-        // populate nodes for each folder
-        folderPaths.forEach(path => {
-            //split and remove empty paths so "folder1/folder2" -> ["folder1", "folder2"]
-            const parts = path.split('/').filter(p => p.length);
-            let current = root;
-            let currentPath = root.path;
-            parts.forEach(part => { // ["folder1", "folder2"] -> folder1 -> folder2 -> folder3
-                if (!current.folders[part]) {
-                    current.folders[part] = new Node(part, currentPath);
-                }
-                currentPath = joinPaths([currentPath,part]);
-                current = current.folders[part]; //kinda cd into next level
-            });
-        });
-
-        // populate files
-        filePaths.forEach(path => {
-            const parts = path.split('/').filter(p => p.length);
-            const fileName = parts.pop();
-            let current = root;
-            let currentPath = root.path;
-            parts.forEach(part => { //traverse through folder nodes
-                if (!current.folders[part]) {
-                    // in case folder wasn't in the folders list, create it anyway
-                    current.folders[part] = new Node(part, currentPath);
+            if (data.entries === undefined) {
+                alert(data.message);
+                return;
+            }
+            if (!cursor) {
+                loadedFolders.set(folderPath, {details, node});
+                if (data.entries.some(entry => entry.thumbnail)) {
+                    warmThumbnails(folderPath);
                 }
-                currentPath = joinPaths([currentPath,part]);
-                current = current.folders[part];
+            }
+            data.entries.forEach(entry => {
+                details.appendChild(renderEntry(node, entry));
             });
-            // add the file
-            current.files.push({name: fileName, path});
+            updateOptions(document.getElementById('folderlist'), Array.from(knownFolders));
+
+            if (data.cursor) {
+                const moreBtn = document.createElement('button');
+                moreBtn.textContent = 'Load more';
+                moreBtn.classList.add('file-container');
+                moreBtn.classList.add('border');
+                moreBtn.onclick = () => {
+                    details.removeChild(moreBtn);
+                    loadFolder(details, node, data.cursor);
+                };
+                details.appendChild(moreBtn);
+            }
         });
+}
 
-        return root;
+/**
+ * Build the element of an entry of a folder and remember it to patch it later.
+ * @param {Object} node - The {name, path} of the folder.
+ * @param {Object} entry - The listing entry.
+ * @return {HTMLElement} The element.
+ */
+function renderEntry(node, entry) {
+    const folderPath = joinPaths([node.path, node.name]);
+    const path = joinPaths([folderPath, entry.name]);
+    let element;
+    if (entry.type === 'folder') {
+        knownFolders.add(path);
+        element = renderNode({name: entry.name, path: folderPath});
+    } else {
+        element = renderFile(node, entry);
     }
+    element.dataset.name = entry.name;
+    treeElements.set(path, element);
+    return element;
+}
 
-    /**
-     * Build the html elements based on the rootNode from buildTree()
-     * @param {Node} rootNode - The root node object of a tree.
-     * @param {HTMLElement} container - The element that will contained the rendered tree.
-     */
-    function renderTree(rootNode, container) {
-        rootElement = renderNode(rootNode,rootNode);
-        rootElement.open = true;
-        container.appendChild(rootElement,rootElement);
-        rootElement.querySelector('summary').nodeValue = selectedFolder;
-    }
+// The thumbnails are 128 pixels and loaded at most this many more times while they are made.
+const THUMBNAIL_SIZE = 128;
+const THUMBNAIL_RETRIES = 20;
+const THUMBNAIL_RETRY_MAX_DELAY = 5000;
 
-    /**
-     * Helper function of renderTree to build the html elements.
-     * @param {Node} node - The current node object of a tree.
-     */
-    function renderNode(node, rootNode) {
-        const details = document.createElement('details');
-        const summary = document.createElement('summary');
-        const deleteBtn = document.createElement('button');
-        const renameBtn = document.createElement('button');
-        const newFileBtn = document.createElement('button');
-        const newFolderBtn = document.createElement('button');
-        const moveBtn = document.createElement('button');
-        if (rootNode == node) {
-            // while the root node technically and shouldn't have a name,
-            // I will give it this relative path to make it useful.
-            summary.textContent = rootNode.path
+/**
+ * Build the preview of an image or video. The server answers 202 while it makes the
+ * thumbnail, or 503 while it is busy making others, in which case it is loaded
+ * again a bit later.
+ * @param {string} filePath - The path of the file.
+ * @param {Object} entry - The listing entry of the file.
+ * @param {string} token - The token query string.
+ */
+function renderThumbnail(filePath, entry, token) {
+    const img = document.createElement('img');
+    // the mtime in the url lets the browser cache the thumbnail until the file changes
+    const src = `${joinPaths(['thumb', filePath])}?${token}&size=${THUMBNAIL_SIZE}&v=${entry.mtime}`;
+    let retries = 0;
+    img.loading = 'lazy';
+    img.alt = '';
+    img.classList.add('thumbnail');
+    img.onerror = () => {
+        if (retries++ < THUMBNAIL_RETRIES) {
+            setTimeout(() => { img.src = `${src}&retry=${retries}`; }, Math.min(500 * retries, THUMBNAIL_RETRY_MAX_DELAY));
         } else {
-            summary.textContent = node.name;
+            img.remove();
         }
-        
-        deleteBtn.textContent = 'Delete';
-        deleteBtn.onclick = () => {
-            deletePath(node.path, node.name);
+    };
+    img.src = src;
+    return img;
+}
+
+/**
+ * Ask the server to make the thumbnails of a folder in the background.
+ * @param {string} folderPath - The path of the folder.
+ */
+function warmThumbnails(folderPath) {
+    const formData = new FormData();
+    formData.append('folder', folderPath);
+    formData.append('size', THUMBNAIL_SIZE);
+    fetch(`/thumb?${copyTokenQueryString()}`, {method: 'POST', body: formData});
+}
+
+/**
+ * Build the html element of a folder. Its content is fetched the first time it is opened.
+ * @param {Object} node - The {name, path} of the folder where path is the parent folder.
+ * @param {Object} rootNode - The node of the selected folder.
+ */
+function renderNode(node, rootNode) {
+    const details = document.createElement('details');
+    const summary = document.createElement('summary');
+    const deleteBtn = document.createElement('button');
+    const renameBtn = document.createElement('button');
+    const newFileBtn = document.createElement('button');
+    const newFolderBtn = document.createElement('button');
+    const moveBtn = document.createElement('button');
+    const copyBtn = document.createElement('button');
+    if (rootNode == node) {
+        // while the root node technically and shouldn't have a name,
+        // I will give it this relative path to make it useful.
+        summary.textContent = rootNode.path
+    } else {
+        summary.textContent = node.name;
+        summary.prepend(renderSelectBox(joinPaths([node.path, node.name])));
+    }
+    
+    deleteBtn.textContent = 'Delete';
+    deleteBtn.onclick = () => {
+        deletePath(node.path, node.name);
+    }
+
+    renameBtn.textContent = 'Rename';
+    renameBtn.onclick = () => {
+        movePathUI(node.path, node.name, node.path, node.name);
+    };
+
+    moveBtn.textContent = 'Move';
+    moveBtn.onclick = () => {
+        movePathUI(node.path, node.name, '',joinPaths([node.path, node.name]));
+    };
+
+    copyBtn.textContent = 'Copy';
+    copyBtn.onclick = () => {
+        transferPathsUI('copy', [joinPaths([node.path, node.name])], '', joinPaths([node.path, node.name]));
+    };
+
+    
+    newFileBtn.textContent = 'New File';
+    newFileBtn.onclick = () => {
+        newItemUI(joinPaths([node.path, node.name]),'File')
+    };
+
+
+    newFolderBtn.textContent = 'New Folder';
+    newFolderBtn.onclick = () => {
+        newItemUI(joinPaths([node.path, node.name]),'Folder')
+    };
+
+
+
+    // classes
+    deleteBtn.classList.add('folder-container');
+    deleteBtn.classList.add('border');
+
+    renameBtn.classList.add('folder-container');
+    renameBtn.classList.add('border');
+
+    moveBtn.classList.add('folder-container');
+    moveBtn.classList.add('border');  
+
+    copyBtn.classList.add('folder-container');
+    copyBtn.classList.add('border');
+    
+    newFileBtn.classList.add('folder-container');
+    newFileBtn.classList.add('border');
+
+    newFolderBtn.classList.add('folder-container');
+    newFolderBtn.classList.add('border');
+
+    summary.classList.add('folder-container');
+    summary.classList.add('border');
+
+    details.classList.add('folder-container');
+    details.classList.add('border');
+
+
+    summary.appendChild(deleteBtn);
+    summary.appendChild(renameBtn);
+    summary.appendChild(moveBtn);
+    summary.appendChild(copyBtn);
+    summary.appendChild(newFileBtn);
+    summary.appendChild(newFolderBtn);
+    details.appendChild(summary);
+
+    // fetch the folder content on demand
+    let loaded = false;
+    details.addEventListener('toggle', () => {
+        if (details.open && !loaded) {
+            loaded = true;
+            loadFolder(details, node, null);
         }
+    });
 
-        renameBtn.textContent = 'Rename';
-        renameBtn.onclick = () => {
-            movePathUI(node.path, node.name, node.path, node.name);
-        };
+    return details;
+}
 
-        moveBtn.textContent = 'Move';
-        moveBtn.onclick = () => {
-            movePathUI(node.path, node.name, '',joinPaths([node.path, node.name]));
-        };
+/**
+ * Build the html element of a file.
+ * @param {Object} node - The {name, path} of the folder containing the file.
+ * @param {Object} entry - The listing entry of the file.
+ */
+function renderFile(node, entry) {
+    const token = copyTokenQueryString();
+    const folderPath = joinPaths([node.path, node.name]);
+    const filePath = joinPaths([folderPath, entry.name]);
+    const fileDiv = document.createElement('div');
+    const a = document.createElement('a');
+    const size = document.createElement('span');
+    const editBtn = document.createElement('button');
+    const deleteBtn = document.createElement('button');
+    const renameBtn = document.createElement('button');
+    const moveBtn = document.createElement('button');
+    const copyBtn = document.createElement('button');
+    a.textContent = entry.name;
+    a.href = `${joinPaths(['download',filePath])}?${token}`;
+    a.title = 'Modified ' + new Date(entry.mtime * 1000).toLocaleString();
+    size.textContent = formatSize(entry.size);
+
+    deleteBtn.textContent = 'Delete';
+    deleteBtn.onclick = () => {
+        deletePath(folderPath, entry.name);
+    }
 
-        
-        newFileBtn.textContent = 'New File';
-        newFileBtn.onclick = () => {
-            newItemUI(joinPaths([node.path, node.name]),'File')
-        };
+    editBtn.textContent = 'Edit';
+    editBtn.onclick = () => {
+        editFile(folderPath, entry.name, entry.name);
+    };
+    
+    renameBtn.textContent = 'Rename';
+    renameBtn.onclick = () => {
+        movePathUI(folderPath, entry.name, folderPath, entry.name);
+    };
 
+    moveBtn.textContent = 'Move';
+    moveBtn.onclick = () => {
+        movePathUI(folderPath, entry.name, '', filePath);
+    };
 
-        newFolderBtn.textContent = 'New Folder';
-        newFolderBtn.onclick = () => {
-            newItemUI(joinPaths([node.path, node.name]),'Folder')
-        };
+    copyBtn.textContent = 'Copy';
+    copyBtn.onclick = () => {
+        transferPathsUI('copy', [filePath], '', filePath);
+    };
+    
 
 
+    // classes
+    a.classList.add('file-container');
 
-        // classes
-        deleteBtn.classList.add('folder-container');
-        deleteBtn.classList.add('border');
+    size.classList.add('file-container');
 
-        renameBtn.classList.add('folder-container');
-        renameBtn.classList.add('border');
+    deleteBtn.classList.add('file-container');
+    deleteBtn.classList.add('border');
 
-        moveBtn.classList.add('folder-container');
-        moveBtn.classList.add('border');  
-        
-        newFileBtn.classList.add('folder-container');
-        newFileBtn.classList.add('border');
+    editBtn.classList.add('file-container');
+    editBtn.classList.add('border');
 
-        newFolderBtn.classList.add('folder-container');
-        newFolderBtn.classList.add('border');
+    renameBtn.classList.add('file-container');
+    renameBtn.classList.add('border');
 
-        summary.classList.add('folder-container');
-        summary.classList.add('border');
+    moveBtn.classList.add('file-container');
+    moveBtn.classList.add('border');
 
-        details.classList.add('folder-container');
-        details.classList.add('border');
+    copyBtn.classList.add('file-container');
+    copyBtn.classList.add('border');
 
+    fileDiv.classList.add('file-container');
+    fileDiv.classList.add('file-tree');
+    fileDiv.classList.add('border');
 
-        summary.appendChild(deleteBtn);
-        summary.appendChild(renameBtn);
-        summary.appendChild(moveBtn);
-        summary.appendChild(newFileBtn);
-        summary.appendChild(newFolderBtn);
-        details.appendChild(summary);
 
-        // recurse into subfolders
-        Object.values(node.folders).forEach(folderNode => {
-            details.appendChild(renderNode(folderNode,rootNode));
-        });
+    fileDiv.appendChild(renderSelectBox(filePath));
+    if (entry.thumbnail) {
+        fileDiv.appendChild(renderThumbnail(filePath, entry, token));
+    }
+    fileDiv.appendChild(a);
+    fileDiv.appendChild(size);
+    fileDiv.appendChild(deleteBtn)
+    fileDiv.appendChild(editBtn);
+    fileDiv.appendChild(renameBtn);
+    fileDiv.appendChild(moveBtn);
+    fileDiv.appendChild(copyBtn);
+    return fileDiv;
+}
 
-        // render files in this folder
-        node.files.forEach(file => {
-            const fileDiv = document.createElement('div');
-            const a = document.createElement('a');
-            const editBtn = document.createElement('button');
-            const deleteBtn = document.createElement('button');
-            const renameBtn = document.createElement('button');
-            const moveBtn = document.createElement('button');
-            a.textContent = file.name;
-            a.href = `${joinPaths(['download',selectedFolder,file.path])}?${token}`;
-
-            deleteBtn.textContent = 'Delete';
-            deleteBtn.onclick = () => {
-                deletePath(selectedFolder, file.path);
-            }
 
-            editBtn.textContent = 'Edit';
-            editBtn.onclick = () => {
-                editFile(selectedFolder, file.path, file.name);
-            };
-            
-            renameBtn.textContent = 'Rename';
-            renameBtn.onclick = () => {
-                movePathUI(selectedFolder, file.path, joinPaths([node.path,node.name]), file.name);
-            };
 
-            moveBtn.textContent = 'Move';
-            moveBtn.onclick = () => {
-                movePathUI(selectedFolder, file.path, '', joinPaths([node.path,node.name,file.name]));
-            };
-            
 
+////////////////////////////////Selection////////////////////////////////////
+// The paths checked in the tree, deleted, moved or copied together in one request.
+const selectedPaths = new Set();
 
-            // classes
-            a.classList.add('file-container');
+/**
+ * Build the checkbox selecting a path.
+ * @param {string} path - The path of the file or folder.
+ */
+function renderSelectBox(path) {
+    const checkbox = document.createElement('input');
+    checkbox.type = 'checkbox';
+    checkbox.checked = selectedPaths.has(path);
+    checkbox.onchange = () => {
+        if (checkbox.checked) {
+            selectedPaths.add(path);
+        } else {
+            selectedPaths.delete(path);
+        }
+        updateSelection();
+    };
+    return checkbox;
+}
 
-            deleteBtn.classList.add('file-container');
-            deleteBtn.classList.add('border');
+// Show the operations on the selection when something is selected.
+function updateSelection() {
+    document.getElementById('selection').style.display = selectedPaths.size ? 'block' : 'none';
+    document.getElementById('selection-count').textContent = `${selectedPaths.size} selected`;
+}
 
-            editBtn.classList.add('file-container');
-            editBtn.classList.add('border');
+function deleteSelected() {
+    deletePaths(Array.from(selectedPaths));
+}
 
-            renameBtn.classList.add('file-container');
-            renameBtn.classList.add('border');
+/**
+ * Move or copy the selection into a folder.
+ * @param {string} operation - 'move' or 'copy'.
+ */
+function transferSelectedUI(operation) {
+    transferPathsUI(operation, Array.from(selectedPaths), '', document.getElementById('selected-folder').value);
+}
 
-            moveBtn.classList.add('file-container');
-            moveBtn.classList.add('border');
 
-            fileDiv.classList.add('file-container');
-            fileDiv.classList.add('file-tree');
-            fileDiv.classList.add('border');
 
+////////////////////////////////Live updates////////////////////////////////////
+// The folders whose content is shown by path, with their element and node, and the
+// element of every entry shown, to patch the tree with the changes from /events.
+const loadedFolders = new Map();
+const treeElements = new Map();
+let changeFeed = null;
 
-            fileDiv.appendChild(a);
-            fileDiv.appendChild(deleteBtn)
-            fileDiv.appendChild(editBtn);
-            fileDiv.appendChild(renameBtn);
-            fileDiv.appendChild(moveBtn);
-            details.appendChild(fileDiv);
-        });
+/**
+ * Listen to the changes of the files and patch the tree with them. EventSource
+ * reconnects by itself and the server continues after the last change received.
+ */
+function listenToChanges() {
+    if (typeof EventSource === 'undefined') {
+        return;
+    }
+    changeFeed = new EventSource(`/events?${copyTokenQueryString()}`);
+    changeFeed.addEventListener('change', event => JSON.parse(event.data).forEach(applyChange));
+    changeFeed.addEventListener('reset', updateUI);
+}
 
-        return details;
+// Reload the tree after a change, unless the change will arrive from /events.
+function refreshTree() {
+    if (changeFeed === null || changeFeed.readyState !== EventSource.OPEN) {
+        updateUI();
     }
 }
 
+/**
+ * Patch the tree with a change record of /events.
+ * @param {Object} record - The record with its 'type', 'path' and 'entry' or 'from'.
+ */
+function applyChange(record) {
+    if (record.type === 'reset') {
+        updateUI();
+        return;
+    }
+    if (record.type === 'deleted' || record.type === 'moved') {
+        removeFromTree(record.type === 'moved' ? record.from : record.path);
+    }
+    if (record.type === 'changed' || record.type === 'moved') {
+        addToTree(record.path, record.entry);
+    }
+}
+
+/**
+ * Remove a path and everything under it from the tree.
+ * @param {string} path - The path relative to the upload folder.
+ */
+function removeFromTree(path) {
+    const isRemoved = other => other === path || other.startsWith(path + '/');
+    treeElements.forEach((element, other) => {
+        if (isRemoved(other)) {
+            element.remove();
+            treeElements.delete(other);
+        }
+    });
+    loadedFolders.forEach((folder, other) => {
+        if (isRemoved(other)) {
+            loadedFolders.delete(other);
+        }
+    });
+    knownFolders.forEach(other => {
+        if (isRemoved(other)) {
+            knownFolders.delete(other);
+        }
+    });
+    selectedPaths.forEach(other => {
+        if (isRemoved(other)) {
+            selectedPaths.delete(other);
+        }
+    });
+    updateSelection();
+    updateOptions(document.getElementById('folderlist'), Array.from(knownFolders));
+}
+
+/**
+ * Add or update a path in the tree if its folder is shown. When only a parent
+ * of its folder is shown, like for a new folder with files in it, the missing
+ * folder is added instead.
+ * @param {string} path - The path relative to the upload folder.
+ * @param {Object} entry - Its listing entry.
+ */
+function addToTree(path, entry) {
+    let folderPath = dirname(path);
+    while (!loadedFolders.has(folderPath)) {
+        if (folderPath === '') {
+            return;
+        }
+        entry = {name: folderPath.substring(folderPath.lastIndexOf('/') + 1), type: 'folder'};
+        folderPath = dirname(folderPath);
+    }
+    path = joinPaths([folderPath, entry.name]);
+    const {details, node} = loadedFolders.get(folderPath);
+    const existing = treeElements.get(path);
+    if (existing !== undefined) {
+        if (entry.type === 'folder' && existing.tagName === 'DETAILS') {
+            return; // keep it open with its content
+        }
+        removeFromTree(path);
+    }
+
+    // the entries are sorted by name, later ones come with the next page if there is one
+    let next = null;
+    for (const child of details.children) {
+        if (child.dataset.name !== undefined && child.dataset.name > entry.name) {
+            next = child;
+            break;
+        }
+    }
+    const moreBtn = details.lastElementChild.tagName === 'BUTTON' ? details.lastElementChild : null;
+    if (next === null && moreBtn !== null) {
+        return;
+    }
+    details.insertBefore(renderEntry(node, entry), next);
+    updateOptions(document.getElementById('folderlist'), Array.from(knownFolders));
+}
+
+
+
+////////////////////////////////Searching files////////////////////////////////////
+const SEARCH_DELAY_MS = 300;
+let searchTimer = null;
+
+/**
+ * Search the names under the selected folder and show the results above the tree.
+ * A query with * ? or [ is searched as a glob of the whole name.
+ * @param {string} cursor - The cursor of the page to load or null for the first page.
+ */
+function searchFiles(cursor) {
+    const token = copyTokenQueryString();
+    const query = document.getElementById('search').value;
+    const results = document.getElementById('search-results');
+    if (!cursor) {
+        results.innerHTML = '';
+    }
+    if (!query) {
+        return;
+    }
+    const key = /[*?[]/.test(query) ? 'glob' : 'q';
+    const selectedFolder = document.getElementById('selected-folder').value;
+    let url = `/search?${token}&${key}=${encodeURIComponent(query)}&folder=${encodeURIComponent(selectedFolder)}`;
+    if (cursor) {
+        url += `&cursor=${encodeURIComponent(cursor)}`;
+    }
+    fetch(url)
+        .then(response => response.json())
+        .then(data => {
+            if (data.entries === undefined) {
+                alert(data.message);
+                return;
+            }
+            if (query !== document.getElementById('search').value) {
+                return; // a newer search is running
+            }
+            data.entries.forEach(entry => {
+                const node = {name: '', path: dirname(entry.path)};
+                if (entry.type === 'folder') {
+                    results.appendChild(renderNode({name: entry.name, path: node.path}));
+                } else {
+                    results.appendChild(renderFile(node, entry));
+                }
+            });
+            if (data.cursor) {
+                const moreBtn = document.createElement('button');
+                moreBtn.textContent = 'More results';
+                moreBtn.classList.add('file-container');
+                moreBtn.classList.add('border');
+                moreBtn.onclick = () => {
+                    results.removeChild(moreBtn);
+                    searchFiles(data.cursor);
+                };
+                results.appendChild(moreBtn);
+            }
+        });
+}
+
+document.getElementById('search').addEventListener('input', () => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => searchFiles(null), SEARCH_DELAY_MS);
+});
+
 
 
 
@@ -490,43 +1518,19 @@ function editFile(selectedFolder, filepath, filename) {
  * @param {string} filename - The name of the file/directory to be deleted.
  */
 function deletePath(directory, filename) {
-    const token = copyTokenQueryString();
-    const url = `/delete?${token}`;
-    const path = joinPaths([directory,filename]);
+    deletePaths([joinPaths([directory,filename])]);
+}
 
+/**
+ * Send one request to delete several files/directories.
+ * @param {string[]} paths - The paths of the files/directories to be deleted.
+ */
+function deletePaths(paths) {
     const formData = new FormData();
-    formData.append('path', path);
-    
-    const xhr = new XMLHttpRequest();
-    xhr.open('POST', url, true);
-    xhr.onload = () => {
-        let response;
-        try {
-            response = JSON.parse(xhr.responseText);
-        } catch (e) {
-            alert(xhr.responseText);
-            return;
-        }
-        if (xhr.status === 200) {
-            alert(response.message);
-            updateUI();
-        } else {
-            alert('Delete failed: ' + response.message);
-        }
-    }
-    xhr.onerror = () => {
-        alert("Network error occurred while trying to deleting.");
-    };
-
-    xhr.onabort = () => {
-        alert("Delete aborted.");
-    };
-
-    xhr.send(formData);
+    paths.forEach(path => formData.append('path', path));
+    sendFileOperation('/delete', formData, 'Delete');
 }
 
-
-
 /**
  * Send a request to move a file/directory.
  * @param {string} sourceDirectory - The source base directory of the filename/directoryname to be moved.
@@ -535,17 +1539,32 @@ function deletePath(directory, filename) {
  * @param {string} destinationFilename - The destination name of the file/directory to be moved.
  */
 function movePath(sourceDirectory, sourceFilename, destinationDirectory, destinationFilename) {
-    const token = copyTokenQueryString();
-    const url = `/move?${token}`;
-    const sourcePath = joinPaths([sourceDirectory,sourceFilename]);
-    const destinationPath = joinPaths([destinationDirectory,destinationFilename]);
+    transferPaths('move', [joinPaths([sourceDirectory,sourceFilename])], joinPaths([destinationDirectory,destinationFilename]));
+}
 
+/**
+ * Send one request to move or copy several files/directories.
+ * @param {string} operation - 'move' or 'copy'.
+ * @param {string[]} sourcePaths - The paths of the files/directories.
+ * @param {string} destinationPath - The new path of a single source, or the folder to put them in.
+ */
+function transferPaths(operation, sourcePaths, destinationPath) {
     const formData = new FormData();
-    formData.append('sourcePath', sourcePath);
+    sourcePaths.forEach(path => formData.append('sourcePath', path));
     formData.append('destinationPath', destinationPath);
-    
+    sendFileOperation(`/${operation}`, formData, operation === 'copy' ? 'Copy' : 'Move');
+}
+
+/**
+ * Send a delete, move or copy. The server answers 202 with a job when it takes more
+ * than a moment, whose progress is then shown until it finishes.
+ * @param {string} path - The url path of the operation.
+ * @param {FormData} formData - The form of the request.
+ * @param {string} action - The name of the operation shown to the user.
+ */
+function sendFileOperation(path, formData, action) {
     const xhr = new XMLHttpRequest();
-    xhr.open('POST', url, true);
+    xhr.open('POST', `${path}?${copyTokenQueryString()}`, true);
     xhr.onload = () => {
         let response;
         try {
@@ -556,22 +1575,72 @@ function movePath(sourceDirectory, sourceFilename, destinationDirectory, destina
         }
         if (xhr.status === 200) {
             alert(response.message);
-            updateUI();
+            refreshTree();
+        } else if (xhr.status === 202) {
+            followJob(response.job, action);
         } else {
-            alert('Move failed: ' + response.message);
+            alert(`${action} failed: ` + response.message);
         }
     }
     xhr.onerror = () => {
-        alert("Network error occurred while trying to move.");
+        alert(`Network error occurred while trying to ${action.toLowerCase()}.`);
     };
 
     xhr.onabort = () => {
-        alert("Move aborted.");
+        alert(`${action} aborted.`);
     };
 
     xhr.send(formData);
 }
 
+// Milliseconds between two requests for the progress of a job.
+const JOB_POLL_INTERVAL = 1000;
+
+/**
+ * Show the progress of a job with a button to cancel it until it finishes.
+ * @param {Object} job - The job from /jobs/<id>.
+ * @param {string} action - The name of the operation shown to the user.
+ */
+function followJob(job, action) {
+    const token = copyTokenQueryString();
+    const jobDiv = document.createElement('div');
+    const bar = document.createElement('progress');
+    const text = document.createElement('span');
+    const cancelBtn = document.createElement('button');
+    bar.max = 100;
+    cancelBtn.textContent = 'Cancel';
+    cancelBtn.onclick = () => {
+        cancelBtn.disabled = true;
+        fetch(`/jobs/${job.id}/cancel?${token}`, {method: 'POST'});
+    };
+    jobDiv.classList.add('file-container');
+    jobDiv.classList.add('border');
+    jobDiv.appendChild(bar);
+    jobDiv.appendChild(text);
+    jobDiv.appendChild(cancelBtn);
+    document.getElementById('jobs').appendChild(jobDiv);
+
+    const update = job => {
+        // copies count bytes, deletes and renames only count files
+        bar.value = job.bytes ? (job.bytesDone / job.bytes) * 100 : job.files ? (job.filesDone / job.files) * 100 : 0;
+        text.textContent = `${action}: ${job.filesDone} of ${job.files} files, ` +
+            `${formatSize(job.bytesDone)} of ${formatSize(job.bytes)} ${job.current || ''}`;
+        if (job.state === 'queued' || job.state === 'running') {
+            setTimeout(() => fetch(`/jobs/${job.id}?${token}`).then(response => response.json()).then(update),
+                JOB_POLL_INTERVAL);
+            return;
+        }
+        jobDiv.remove();
+        refreshTree();
+        if (job.errors.length) {
+            alert(`${action} failed: ` + job.errors.map(error => `${error.path}: ${error.message}`).join('\n'));
+        } else {
+            alert(job.state === 'done' ? `${action} finished` : `${action} ${job.state}`);
+        }
+    };
+    update(job);
+}
+
 
 /**
  * Send a request to create a new file.
@@ -597,7 +1666,7 @@ function newFile(directory, filename) {
         }
         if (xhr.status === 200) {
             alert(response.message);
-            updateUI();
+            refreshTree();
         } else {
             alert('Creating new file failed: ' + response.message);
         }
@@ -639,7 +1708,7 @@ function newFolder(directory, foldername) {
         }
         if (xhr.status === 200) {
             alert(response.message);
-            updateUI();
+            refreshTree();
         } else {
             alert('Creating new file failed: ' + response.message);
         }
@@ -720,6 +1789,17 @@ function editFileUI(selectedFolder, filepath, filename, data) {
  * @param {string} destinationFilename - The destination name of the file/directory to be moved.
  */
 function movePathUI(sourceDirectory, sourceFilename, destinationPath, destinationFilename) {
+    transferPathsUI('move', [joinPaths([sourceDirectory,sourceFilename])], destinationPath, destinationFilename);
+}
+
+/**
+ * Generates the html overlay to move or copy files/directories.
+ * @param {string} operation - 'move' or 'copy'.
+ * @param {string[]} sourcePaths - The paths of the files/directories.
+ * @param {string} destinationPath - The base directory of the destination typed by the user.
+ * @param {string} destinationFilename - The initial destination.
+ */
+function transferPathsUI(operation, sourcePaths, destinationPath, destinationFilename) {
     const overlay = document.createElement('div');
     const moveContainer = document.createElement('div');
     const header = document.createElement('h2');
@@ -728,27 +1808,24 @@ function movePathUI(sourceDirectory, sourceFilename, destinationPath, destinatio
     const datalist = document.createElement('datalist');
     const submitBtn = document.createElement('button');
     const exitBtn = document.createElement('button');
+    const action = operation === 'copy' ? 'Copy' : 'Move';
     destinationPathInput.type = 'text';
     
-    header.textContent = 'Move/Rename Files or Directories';
+    header.textContent = operation === 'copy' ? 'Copy Files or Directories' : 'Move/Rename Files or Directories';
     
-    destinationPathInputLabel.textContent = `Move ${joinPaths([sourceDirectory,sourceFilename])} to ${destinationPath}`;
+    destinationPathInputLabel.textContent = `${action} ${sourcePaths.join(', ')} to ${destinationPath}`;
     destinationPathInput.placeholder = '/path/to/directory or /path/to/directory/newname';
     destinationPathInput.value = destinationFilename.replace(/\/+/g, '/');
     destinationPathInput.classList.add('UI-input');
     destinationPathInput.setAttribute('list', 'movePath-datalist');
     datalist.setAttribute('id', 'movePath-datalist');
 
-    fetch(`/files?${token}&folder=${encodeURIComponent('/')}`)
-        .then(response => response.json())
-        .then(data => {
-            updateOptions(datalist, data);
-        });
+    updateOptions(datalist, Array.from(knownFolders));
 
     submitBtn.classList.add('UI-button');
     submitBtn.textContent = 'Submit';
     submitBtn.onclick = () => {
-        movePath(sourceDirectory, sourceFilename, destinationPath, destinationPathInput.value);
+        transferPaths(operation, sourcePaths, joinPaths([destinationPath, destinationPathInput.value]));
         document.body.removeChild(overlay);
     };
 
@@ -806,11 +1883,7 @@ function newItemUI(directory,type) {
     path.setAttribute('list', 'newItem-datalist');
     datalist.setAttribute('id', 'newItem-datalist');
 
-    fetch(`/files?${token}&folder=${encodeURIComponent('/')}`)
-        .then(response => response.json())
-        .then(data => {
-            updateOptions(datalist, data);
-        });
+    updateOptions(datalist, Array.from(knownFolders));
 
     submitBtn.classList.add('UI-button');
     submitBtn.textContent = 'Submit';
@@ -0,0 +1,125 @@
+import asyncio, base64, importlib.util, json, os, sys, tempfile, time
+from importlib.machinery import SourceFileLoader
+import pytest
+from werkzeug.datastructures import Headers
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = 'test-token'
+SERVED = tempfile.mkdtemp(prefix='qrFileServer-served-')
+
+# app.py reads its config and the served paths when it is imported
+os.environ.update({
+    'QR_FILE_SERVER_INPUT': base64.b64encode(SERVED.encode()).decode(),
+    'QR_FILE_SERVER_STATE': tempfile.mkdtemp(prefix='qrFileServer-state-'),
+    'QR_FILE_SERVER_TOKEN': TOKEN,
+    'QR_FILE_SERVER_BIND': '127.0.0.1:8000',
+    'QR_FILE_SERVER_READONLY': 'false',
+    'QR_FILE_SERVER_SECURE': 'false',
+})
+sys.path.insert(0, ROOT)
+if 'qrFileServerConfig' not in sys.modules:
+    loader = SourceFileLoader('qrFileServerConfig', os.path.join(ROOT, 'qrFileServerConfig.py.example'))
+    config = importlib.util.module_from_spec(importlib.util.spec_from_loader('qrFileServerConfig', loader))
+    loader.exec_module(config)
+    sys.modules['qrFileServerConfig'] = config
+
+import app as server
+
+
+class Response:
+    """The status, headers and body of a response, whichever way it was served."""
+
+    def __init__(self, status, headers, body):
+        self.status_code = status
+        self.headers = Headers(headers)
+        self.data = body
+
+    def get_json(self):
+        return json.loads(self.data)
+
+
+class WsgiClient:
+    """Call the flask app directly, like gunicorn does."""
+
+    mode = 'wsgi'
+
+    def __init__(self):
+        self.client = server.app.test_client(use_cookies=False)
+
+    def request(self, method, path, headers=None, body=b'', disconnect_after=None):
+        """
+        :param disconnect_after: The seconds after which the client stops reading a
+        long lived response like /events, it is read whole by default.
+        """
+        if disconnect_after is None:
+            response = self.client.open(path, method=method, headers=headers or {}, data=body, buffered=True)
+            return Response(response.status_code, response.headers.to_wsgi_list(), response.get_data())
+        response = self.client.open(path, method=method, headers=headers or {}, data=body)
+        deadline = time.monotonic() + disconnect_after
+        data = b''
+        try:
+            for chunk in response.response:
+                data += chunk
+                if time.monotonic() >= deadline:
+                    break
+        finally:
+            response.close()
+        return Response(response.status_code, response.headers.to_wsgi_list(), data)
+
+
+class AsgiClient:
+    """Call the flask app through AsgiBridge, like uvicorn does."""
+
+    mode = 'asgi'
+
+    def request(self, method, path, headers=None, body=b'', disconnect_after=None):
+        return asyncio.run(self._request(method, path, headers or {}, body, disconnect_after))
+
+    async def _request(self, method, path, headers, body, disconnect_after):
+        path, _, query = path.partition('?')
+        headers = list(headers.items() if isinstance(headers, dict) else headers)
+        if body:
+            headers.append(('Content-Length', str(len(body))))
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+            'client': ('127.0.0.1', 50000), 'server': ('127.0.0.1', 8000),
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            if disconnect_after is None:
+                await asyncio.Event().wait() # the client stays connected
+            await asyncio.sleep(disconnect_after)
+            return {'type': 'http.disconnect'}
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        await server.asgi(scope, receive, send)
+        start = sent[0]
+        assert start['type'] == 'http.response.start'
+        assert disconnect_after is not None or sent[-1]['more_body'] is False
+        headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in start['headers']]
+        return Response(start['status'], headers, b''.join(m['body'] for m in sent[1:]))
+
+
+@pytest.fixture(params=['wsgi', 'asgi'])
+def client(request):
+    return WsgiClient() if request.param == 'wsgi' else AsgiClient()
+
+
+@pytest.fixture
+def root():
+    """The folder served by the app."""
+    return server.UPLOAD_FOLDER
+
+
+@pytest.fixture
+def token():
+    return TOKEN
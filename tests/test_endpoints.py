@@ -0,0 +1,651 @@
+import base64, gzip, hashlib, io, json, os, struct, tarfile, time, uuid, zipfile, zlib
+from urllib.parse import urlencode
+import pytest
+from conftest import server
+from modules.sessionStore import SessionStore
+
+
+def url(path, **args):
+    return f"{path}?{urlencode({'token': server.TOKEN, **args})}"
+
+
+@pytest.fixture
+def folder(root, client):
+    """A folder of the served root with a few files, unique to the test."""
+    name = f'{client.mode}-{uuid.uuid4().hex[:8]}'
+    path = os.path.join(root, name)
+    os.makedirs(os.path.join(path, 'sub'))
+    files = {
+        'a.txt': b'hello world\n',
+        'data.bin': os.urandom(300*1024),
+        'sub/b.txt': b'b'*5000,
+        'sub/empty': b'',
+    }
+    for relative_path, data in files.items():
+        with open(os.path.join(path, relative_path), 'wb') as f:
+            f.write(data)
+    return name, files
+
+
+def test_requires_token(client):
+    assert client.request('GET', '/files').status_code == 401
+    assert client.request('GET', url('/files')).status_code == 200
+
+
+def test_token_cookie(client):
+    if client.mode == 'asgi':
+        # http/2 servers send each cookie in its own header
+        headers = [('Cookie', 'theme=dark'), ('Cookie', f'token={server.TOKEN}')]
+    else:
+        headers = [('Cookie', f'theme=dark; token={server.TOKEN}')]
+    assert client.request('GET', '/files', headers).status_code == 200
+
+
+def test_session_cookie(client):
+    response = client.request('GET', url('/upload/config'))
+    assert response.status_code == 200
+    cookie = response.headers['Set-Cookie'].split(';', 1)[0]
+    assert cookie.startswith(f'{server.SESSION_COOKIE}=')
+    assert client.request('GET', '/upload/config', {'Cookie': cookie}).status_code == 200
+    # a session isn't renewed on every request
+    assert 'Set-Cookie' not in client.request('GET', '/upload/config', {'Cookie': cookie}).headers
+    forged = cookie[:-1] + ('A' if cookie[-1] != 'A' else 'B')
+    assert client.request('GET', '/upload/config', {'Cookie': forged}).status_code == 401
+    assert client.request('GET', '/upload/config?token=wrong').status_code == 401
+
+
+def test_asgi_joins_cookies():
+    scope = {'method': 'GET', 'path': '/', 'query_string': b'', 'http_version': '2',
+             'headers': [(b'cookie', b'a=1'), (b'cookie', b'b=2'), (b'accept', b'text/html'), (b'accept', b'*/*')]}
+    environ = server.asgi.environ(scope, None)
+    assert environ['HTTP_COOKIE'] == 'a=1; b=2'
+    assert environ['HTTP_ACCEPT'] == 'text/html,*/*'
+
+
+def test_upload_config(client):
+    config = client.request('GET', url('/upload/config')).get_json()
+    assert config['minChunkSize'] == server.UPLOAD_MIN_CHUNK_SIZE
+    assert config['maxChunkSize'] == server.UPLOAD_MAX_CHUNK_SIZE
+
+
+def test_listing(client, folder):
+    name, files = folder
+    listing = client.request('GET', url('/files', folder=name)).get_json()
+    assert sorted(listing['files']) == sorted(files)
+    assert listing['folders'] == ['sub']
+
+
+def test_lazy_listing(client, folder):
+    name, files = folder
+    entries = []
+    cursor = None
+    while True:
+        args = {'lazy': 'true', 'folder': name, 'depth': 2, 'limit': 2}
+        if cursor is not None:
+            args['cursor'] = cursor
+        page = client.request('GET', url('/files', **args)).get_json()
+        entries += page['entries']
+        cursor = page['cursor']
+        if cursor is None:
+            break
+    sizes = {entry['path']: entry['size'] for entry in entries if entry['type'] == 'file'}
+    assert sizes == {path: len(data) for path, data in files.items()}
+    assert [entry['path'] for entry in entries if entry['type'] == 'folder'] == ['sub']
+
+
+def test_download(client, folder):
+    name, files = folder
+    response = client.request('GET', url(f'/download/{name}/data.bin'))
+    assert response.status_code == 200
+    assert response.data == files['data.bin']
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+    response = client.request('HEAD', url(f'/download/{name}/data.bin'))
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == str(len(files['data.bin']))
+    assert response.data == b''
+
+    etag = response.headers['ETag']
+    response = client.request('GET', url(f'/download/{name}/data.bin'), {'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_download_ranges(client, folder):
+    name, files = folder
+    data = files['data.bin']
+    response = client.request('GET', url(f'/download/{name}/data.bin'), {'Range': 'bytes=1000-1999'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-1999/{len(data)}'
+    assert response.data == data[1000:2000]
+
+    response = client.request('GET', url(f'/download/{name}/data.bin'), {'Range': 'bytes=-100'})
+    assert response.status_code == 206
+    assert response.data == data[-100:]
+
+    response = client.request('GET', url(f'/download/{name}/data.bin'), {'Range': 'bytes=0-9,200000-200009'})
+    assert response.status_code == 206
+    assert response.headers['Content-Type'].startswith('multipart/byteranges')
+    assert data[0:10] in response.data and data[200000:200010] in response.data
+
+    response = client.request('GET', url(f'/download/{name}/data.bin'), {'Range': f'bytes={len(data)}-'})
+    assert response.status_code == 416
+
+
+def test_download_missing(client, folder):
+    name, _ = folder
+    assert client.request('GET', url(f'/download/{name}/missing')).status_code == 404
+
+
+def test_zip(client, folder):
+    name, files = folder
+    response = client.request('GET', url(f'/zip/{name}'))
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert {path: archive.read(path) for path in archive.namelist()} == files
+
+
+def test_zip_store(client, folder):
+    name, files = folder
+    response = client.request('GET', url(f'/zip/{name}', store='true'))
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == str(len(response.data))
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert {path: archive.read(path) for path in archive.namelist()} == files
+
+    size = len(response.data)
+    resumed = client.request('GET', url(f'/zip/{name}', store='true'), {'Range': f'bytes={size//2}-'})
+    assert resumed.status_code == 206
+    assert resumed.headers['Content-Range'] == f'bytes {size//2}-{size - 1}/{size}'
+    assert resumed.data == response.data[size//2:]
+
+
+def test_zip_store_resume(client, folder):
+    name, _ = folder
+    archive = client.request('GET', url(f'/zip/{name}', store='true')).data
+    with zipfile.ZipFile(io.BytesIO(archive)) as z:
+        boundaries = {z.start_dir}
+        for info in z.infolist():
+            name_length, extra_length = struct.unpack('<HH', archive[info.header_offset + 26:info.header_offset + 30])
+            data_offset = info.header_offset + 30 + name_length + extra_length
+            # the local header, the file data and its data descriptor
+            boundaries.update((info.header_offset, data_offset, data_offset + info.compress_size))
+    for boundary in sorted(boundaries):
+        for start in range(max(boundary - 1, 0), boundary + 2):
+            resumed = client.request('GET', url(f'/zip/{name}', store='true'), {'Range': f'bytes={start}-'})
+            assert resumed.status_code == 206
+            assert resumed.data == archive[start:], f'resumed at {start}'
+
+
+@pytest.mark.parametrize('compression', ['', 'gzip'])
+def test_tar(client, folder, compression):
+    name, files = folder
+    response = client.request('GET', url(f'/tar/{name}', compression=compression))
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        contents = {member.name: archive.extractfile(member).read() for member in archive if member.isfile()}
+    assert contents == files
+
+
+def multipart(fields, file):
+    """:return: A multipart/form-data body of form fields and a (filename, data) file, and its boundary."""
+    boundary = uuid.uuid4().hex
+    body = b''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode()
+                    for k, v in fields.items())
+    body += (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file[0]}"\r\n'
+             f'Content-Type: application/octet-stream\r\n\r\n').encode() + file[1] + f'\r\n--{boundary}--\r\n'.encode()
+    return body, boundary
+
+
+def create_session(client, folder, filename, size, **fields):
+    form = urlencode({'folder': folder, 'filename': filename, 'fileSize': size, **fields}).encode()
+    return client.request('POST', url('/upload/session'),
+                          {'Content-Type': 'application/x-www-form-urlencoded'}, form).get_json()
+
+
+def send_chunks(client, session, index, data, checksum=None):
+    headers = {'X-Upload-Session': session['session'], 'X-Upload-Chunk': str(index),
+               'X-Upload-Count': str(-(-len(data)//session['chunkSize'])),
+               'X-Chunk-Checksum': checksum or f'crc32={zlib.crc32(data):08x}',
+               'Content-Type': 'application/octet-stream'}
+    return client.request('PUT', url('/upload/chunk'), headers, data)
+
+
+def test_upload_chunk(client, folder, root):
+    name, _ = folder
+    data = os.urandom(10000)
+    session = create_session(client, name, 'up.bin', len(data))
+    assert session['code'] == 'SESSION_CREATED'
+    assert session['missing'] == [0]
+    assert send_chunks(client, session, 0, data).get_json()['code'] == 'SUCCESS'
+    with open(os.path.join(root, name, 'up.bin'), 'rb') as f:
+        assert f.read() == data
+
+
+def test_upload_resume(client, folder, root):
+    name, _ = folder
+    data = os.urandom(server.UPLOAD_MIN_CHUNK_SIZE*2 + 1000)
+    session = create_session(client, name, 'resumed.bin', len(data))
+    assert session['missing'] == [0, 1, 2]
+    chunk_size = session['chunkSize']
+    # chunks arrive out of order, then the upload is interrupted
+    assert send_chunks(client, session, 1, data[chunk_size:]).get_json()['code'] == 'CONTINUE'
+
+    resumed = create_session(client, name, 'resumed.bin', len(data), resume='true')
+    assert resumed['missing'] == [0]
+    assert send_chunks(client, resumed, 0, data[:chunk_size]).get_json()['code'] == 'SUCCESS'
+    with open(os.path.join(root, name, 'resumed.bin'), 'rb') as f:
+        assert f.read() == data
+
+    # resuming an upload that is already done compares the sha256
+    existing = create_session(client, name, 'resumed.bin', len(data), resume='true')
+    assert existing['code'] == 'DIGEST_REQUIRED'
+    assert existing['contentHash'] == f'sha256:{hashlib.sha256(data).hexdigest()}'
+    done = create_session(client, name, 'resumed.bin', len(data), resume='true', contentHash=existing['contentHash'])
+    assert done['code'] == 'FILE_ALREADY_UPLOADED'
+    other = f'sha256:{hashlib.sha256(data[::-1]).hexdigest()}'
+    changed = create_session(client, name, 'resumed.bin', len(data), resume='true', contentHash=other)
+    assert changed['code'] == 'SESSION_CREATED'
+
+
+def test_upload_chunk_checksum(client, folder, root):
+    name, _ = folder
+    data = os.urandom(10000)
+    session = create_session(client, name, 'checked.bin', len(data))
+    response = send_chunks(client, session, 0, data, f'crc32={zlib.crc32(data) ^ 1:08x}')
+    assert response.status_code == 400
+    assert response.get_json()['code'] == 'CORRUPTED'
+    # the corrupted chunk stays missing
+    assert create_session(client, name, 'checked.bin', len(data), resume='true')['missing'] == [0]
+    assert send_chunks(client, session, 0, data, 'md4=00').status_code == 400
+    assert not os.path.exists(os.path.join(root, name, 'checked.bin'))
+
+
+def test_upload_session_shared(client, folder, root, monkeypatch):
+    name, _ = folder
+    data = os.urandom(10000)
+    session = create_session(client, name, 'shared.bin', len(data))
+    # the chunk is received by another worker with its own connection to the store
+    monkeypatch.setattr(server, 'UPLOAD_SESSIONS', SessionStore(server.UPLOAD_SESSIONS.path))
+    assert send_chunks(client, session, 0, data).get_json()['code'] == 'SUCCESS'
+    assert server.UPLOAD_SESSIONS.get(session['session']) is None
+    with open(os.path.join(root, name, 'shared.bin'), 'rb') as f:
+        assert f.read() == data
+
+
+def test_legacy_upload(client, folder, root):
+    name, _ = folder
+    data = os.urandom(server.EXPECTED_CHUNK_SIZE + 1000)
+    for index, start in enumerate((0, server.EXPECTED_CHUNK_SIZE)):
+        body, boundary = multipart({'folder': name, 'chunk': index, 'fileSize': len(data)},
+                                   ('legacy.bin', data[start:start + server.EXPECTED_CHUNK_SIZE]))
+        response = client.request('POST', url('/upload'), {'Content-Type': f'multipart/form-data; boundary={boundary}'}, body)
+        assert response.get_json()['code'] == ('CONTINUE', 'SUCCESS')[index]
+    with open(os.path.join(root, name, 'legacy.bin'), 'rb') as f:
+        assert f.read() == data
+
+
+def test_upload_session_expired(client, folder, root):
+    name, _ = folder
+    session = create_session(client, name, 'abandoned.bin', 10000)
+    part_path, state_path = server.part_paths(os.path.join(root, name, 'abandoned.bin'))
+    delta_path = server.delta_part_path(os.path.join(root, name, 'a.txt'), '0123456789abcdef')
+    open(delta_path, 'wb').close()
+    old = time.time() - server.UPLOAD_SESSIONS.max_age - 60
+    with server.UPLOAD_SESSIONS._connection() as db:
+        db.execute('UPDATE upload_sessions SET created = ? WHERE id = ?', (old, session['session']))
+    for path in (part_path, state_path, delta_path):
+        os.utime(path, (old, old))
+    server.expire_uploads()
+    assert server.UPLOAD_SESSIONS.get(session['session']) is None
+    assert not any(os.path.exists(path) for path in (part_path, state_path, delta_path))
+    assert send_chunks(client, session, 0, b'x'*10000).status_code == 404
+
+
+def metric(client, sample):
+    """:return: The value of a sample of /metrics like 'name{label="value"}', 0 if absent."""
+    for line in client.request('GET', url('/metrics')).data.decode().splitlines():
+        name, _, value = line.rpartition(' ')
+        if name == sample:
+            return float(value)
+    return 0
+
+
+def test_metrics(client, folder):
+    name, files = folder
+    download = 'qrfileserver_sent_bytes_total{route="/download/<path:inputPath>"}'
+    archive = 'qrfileserver_sent_bytes_total{route="/zip/<path:inputPath>"}'
+    latency = 'qrfileserver_request_duration_seconds_count{route="/download/<path:inputPath>",method="%s"}'
+    before = {sample: metric(client, sample) for sample in (download, archive, latency % 'GET', latency % 'HEAD')}
+
+    client.request('GET', url(f'/download/{name}/data.bin'))
+    client.request('GET', url(f'/download/{name}/data.bin'), {'Range': 'bytes=100-199'})
+    client.request('HEAD', url(f'/download/{name}/data.bin'))
+    streamed = client.request('GET', url(f'/zip/{name}')).data
+
+    assert metric(client, download) - before[download] == len(files['data.bin']) + 100
+    assert metric(client, archive) - before[archive] == len(streamed)
+    assert metric(client, latency % 'GET') - before[latency % 'GET'] == 2
+    assert metric(client, latency % 'HEAD') - before[latency % 'HEAD'] == 1
+
+
+def test_search(client, folder):
+    name, _ = folder
+    data = b'x'*1000
+    session = create_session(client, f'{name}/found', 'needle-report.txt', len(data))
+    send_chunks(client, session, 0, data)
+    for _ in range(100):
+        page = client.request('GET', url('/search', q='NEEDLE', folder=name)).get_json()
+        if page['complete']:
+            break
+        time.sleep(0.05)
+    assert [(e['path'], e['type'], e['size']) for e in page['entries']] == [
+        (f'{name}/found/needle-report.txt', 'file', len(data))]
+    page = client.request('GET', url('/search', glob='*.txt', type='file', minSize=1001, folder=name)).get_json()
+    assert page['entries'] == []
+    assert client.request('GET', url('/search', type='link')).status_code == 400
+
+
+def test_deduplicated_upload(client, folder, root, monkeypatch):
+    name, _ = folder
+    monkeypatch.setattr(server, 'DEDUP_METHODS', ('reflink', 'copy'))
+    data = os.urandom(server.DEDUP_MIN_SIZE)
+    session = create_session(client, name, 'original.bin', len(data))
+    assert send_chunks(client, session, 0, data).get_json()['code'] == 'SUCCESS'
+    original = os.path.join(root, name, 'original.bin')
+    for _ in range(100):
+        # hashed in the background once uploaded
+        if server.CONTENT_INDEX.get(os.stat(original)) is not None:
+            break
+        time.sleep(0.05)
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    copy = create_session(client, name, 'copy.bin', len(data), contentHash=f'sha256:{sha256}')
+    assert copy['code'] == 'DEDUPLICATED'
+    if copy['method'] == 'copy':
+        # the filesystem can't clone files, they are copied in the background
+        assert server.FILE_JOBS.wait(copy['job']['id'], 10)['state'] == 'done'
+    with open(os.path.join(root, name, 'copy.bin'), 'rb') as f:
+        assert f.read() == data
+    other = create_session(client, name, 'other.bin', len(data), contentHash=f'sha256:{"0"*64}')
+    assert other['code'] == 'SESSION_CREATED'
+
+
+def test_dedup_disabled(client, folder, root):
+    name, _ = folder
+    assert client.request('GET', url('/upload/config')).get_json()['dedupMinSize'] is None
+    data = os.urandom(server.DEDUP_MIN_SIZE)
+    session = create_session(client, name, 'plain.bin', len(data))
+    assert send_chunks(client, session, 0, data).get_json()['code'] == 'SUCCESS'
+    sha256 = hashlib.sha256(data).hexdigest()
+    again = create_session(client, name, 'again.bin', len(data), contentHash=f'sha256:{sha256}')
+    assert again['code'] == 'SESSION_CREATED'
+
+
+def test_compressed_download(client, folder):
+    name, files = folder
+    data = files['sub/b.txt']
+    response = client.request('GET', url(f'/download/{name}/sub/b.txt'), {'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == data
+    etag = response.headers['ETag']
+    assert etag.endswith('-gzip"') and not etag.startswith('W/')
+    response = client.request('GET', url(f'/download/{name}/sub/b.txt'),
+                              {'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    # a range of the compressed version isn't served, the whole file is sent instead
+    response = client.request('GET', url(f'/download/{name}/sub/b.txt'),
+                              {'Accept-Encoding': 'gzip', 'Range': 'bytes=10-19', 'If-Range': etag})
+    assert response.status_code == 200 and response.data == data
+    plain = client.request('GET', url(f'/download/{name}/sub/b.txt'))
+    response = client.request('GET', url(f'/download/{name}/sub/b.txt'),
+                              {'Accept-Encoding': 'gzip', 'Range': 'bytes=10-19', 'If-Range': plain.headers['ETag']})
+    assert response.status_code == 206 and response.data == data[10:20]
+
+    response = client.request('GET', url(f'/download/{name}/sub/b.txt'),
+                              {'Accept-Encoding': 'gzip', 'Range': 'bytes=0-99'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == data[:100]
+    # binary files and small responses are sent as they are
+    response = client.request('GET', url(f'/download/{name}/data.bin'), {'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    response = client.request('GET', url(f'/download/{name}/a.txt'), {'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_compact_listing(client, folder):
+    name, files = folder
+    listing = client.request('GET', url('/files', folder=name, compact='true')).get_json()
+    assert listing['folders'] == [[-1, 'sub']]
+    names = {(parent, tuple(sorted(children))) for parent, *children in listing['files']}
+    assert names == {(-1, ('a.txt', 'data.bin')), (0, ('b.txt', 'empty'))}
+
+
+@pytest.mark.skipif(server.THUMBNAILER is None, reason='needs Pillow')
+def get_thumbnail(client, path, **args):
+    """Ask for a thumbnail until it is made, like the browser does."""
+    for _ in range(200):
+        response = client.request('GET', url(path, **args))
+        if response.status_code != 202:
+            return response
+        assert response.get_json()['code'] == 'PENDING'
+        assert response.headers['Retry-After']
+        time.sleep(0.05)
+    raise AssertionError(f'{path} was never made')
+
+
+def test_thumbnail(client, folder, root, monkeypatch):
+    from PIL import Image
+    name, _ = folder
+    Image.new('RGB', (1000, 500), 'red').save(os.path.join(root, name, 'picture.png'))
+    response = get_thumbnail(client, f'/thumb/{name}/picture.png', size=200)
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'image/jpeg'
+    with Image.open(io.BytesIO(response.data)) as thumbnail:
+        assert thumbnail.size == (256, 128)
+    assert client.request('GET', url(f'/thumb/{name}/a.txt')).status_code == 415
+    assert client.request('GET', url(f'/thumb/{name}/missing.png')).status_code == 404
+
+    with open(os.path.join(root, name, 'broken.png'), 'wb') as f:
+        f.write(b'not a png')
+    assert get_thumbnail(client, f'/thumb/{name}/broken.png').status_code == 415
+    assert client.request('GET', url(f'/thumb/{name}/broken.png')).status_code == 415
+    # failures are tried again later in case they were temporary
+    monkeypatch.setattr('modules.thumbnails.FAILED_EXPIRY', -1)
+    assert client.request('GET', url(f'/thumb/{name}/broken.png')).status_code == 202
+    monkeypatch.undo()
+    assert get_thumbnail(client, f'/thumb/{name}/broken.png').status_code == 415
+
+
+def tar_body(files):
+    body = io.BytesIO()
+    with tarfile.open(fileobj=body, mode='w') as archive:
+        for path, data in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return body.getvalue()
+
+
+def test_upload_batch(client, folder, root):
+    name, _ = folder
+    files = {'batch/one.txt': b'one', 'batch/two/three.txt': b'three'*100}
+    body = tar_body(files)
+    response = client.request('PUT', url('/upload/batch', folder=name), {'Content-Type': 'application/x-tar'}, body)
+    assert response.get_json()['code'] == 'SUCCESS'
+    assert response.get_json()['written'] == len(files)
+    for path, data in files.items():
+        with open(os.path.join(root, name, path), 'rb') as f:
+            assert f.read() == data
+
+    response = client.request('PUT', url('/upload/batch', folder=name, resume='true'),
+                              {'Content-Type': 'application/x-tar'}, body)
+    assert (response.get_json()['written'], response.get_json()['unchanged']) == (0, len(files))
+
+    response = client.request('PUT', url('/upload/batch', folder=name, checksum=f'crc32={zlib.crc32(body) ^ 1:08x}'),
+                              {'Content-Type': 'application/x-tar'}, tar_body({'batch/bad.txt': b'bad'}))
+    assert response.get_json()['code'] == 'CORRUPTED'
+    assert not os.path.exists(os.path.join(root, name, 'batch', 'bad.txt'))
+
+    # a file in the way of a folder only fails the files inside it
+    response = client.request('PUT', url('/upload/batch', folder=name), {'Content-Type': 'application/x-tar'},
+                              tar_body({'a.txt/inside.txt': b'in', 'batch/four.txt': b'four'}))
+    assert response.status_code == 200
+    assert response.get_json()['written'] == 1
+    assert [error['name'] for error in response.get_json()['errors']] == ['a.txt/inside.txt']
+    with open(os.path.join(root, name, 'batch', 'four.txt'), 'rb') as f:
+        assert f.read() == b'four'
+
+
+def test_upload_batch_size(client, folder, root, monkeypatch):
+    # a batch is streamed to disk, so it isn't limited to the size of a chunk
+    name, _ = folder
+    monkeypatch.setitem(server.app.config, 'MAX_CONTENT_LENGTH', 64*1024)
+    files = {f'big/{i}.bin': os.urandom(50*1024) for i in range(4)}
+    response = client.request('PUT', url('/upload/batch', folder=name), {'Content-Type': 'application/x-tar'},
+                              tar_body(files))
+    assert response.get_json()['written'] == len(files)
+    monkeypatch.setattr(server, 'UPLOAD_BATCH_MAX_SIZE', 64*1024)
+    response = client.request('PUT', url('/upload/batch', folder=name), {'Content-Type': 'application/x-tar'},
+                              tar_body(files))
+    assert response.status_code == 413
+
+
+def test_events(client, folder, monkeypatch):
+    name, _ = folder
+    # streams of gunicorn threads end after EVENTS_HOLD seconds
+    monkeypatch.setattr(server, 'EVENTS_HOLD', 1)
+    since = server.CHANGE_FEED.current()
+    form = urlencode({'foldername': f'{name}/created'}).encode()
+    assert client.request('POST', url('/newfolder'), {'Content-Type': 'application/x-www-form-urlencoded'},
+                          form).status_code == 200
+
+    response = client.request('GET', url('/events', since=since), disconnect_after=1.5)
+    assert response.headers['Content-Type'].startswith('text/event-stream')
+    events = [dict(line.split(': ', 1) for line in event.splitlines() if not line.startswith(':'))
+              for event in response.data.decode().split('\n\n') if event.strip()]
+    assert events[0]['event'] == 'ready'
+    records = [record for event in events if event.get('event') == 'change' for record in json.loads(event['data'])]
+    created = [record for record in records if record['path'] == f'{name}/created']
+    assert created and created[-1]['type'] == 'changed'
+    assert created[-1]['entry']['type'] == 'folder'
+
+
+def post_form(client, path, fields):
+    return client.request('POST', url(path), {'Content-Type': 'application/x-www-form-urlencoded'},
+                          urlencode(fields, doseq=True).encode())
+
+
+def test_jobs(client, folder, root, monkeypatch):
+    name, files = folder
+    response = post_form(client, '/copy', {'sourcePath': f'{name}/sub', 'destinationPath': f'{name}/copied'})
+    assert response.status_code == 200
+    with open(os.path.join(root, name, 'copied', 'b.txt'), 'rb') as f:
+        assert f.read() == files['sub/b.txt']
+    # an existing destination is never replaced
+    response = post_form(client, '/copy', {'sourcePath': f'{name}/a.txt', 'destinationPath': f'{name}/copied/b.txt'})
+    assert response.status_code == 400
+    assert response.get_json()['errors']
+
+    response = post_form(client, '/move', {'sourcePath': [f'{name}/a.txt', f'{name}/data.bin'],
+                                           'destinationPath': f'{name}/copied'})
+    assert response.status_code == 200
+    assert sorted(os.listdir(os.path.join(root, name, 'copied'))) == ['a.txt', 'b.txt', 'data.bin', 'empty']
+    assert not os.path.exists(os.path.join(root, name, 'a.txt'))
+    # nor by a move
+    response = post_form(client, '/move', {'sourcePath': f'{name}/sub/b.txt', 'destinationPath': f'{name}/copied/a.txt'})
+    assert response.status_code == 400
+    assert response.get_json()['errors'][0]['path'] == f'{name}/sub/b.txt'
+    with open(os.path.join(root, name, 'copied', 'a.txt'), 'rb') as f:
+        assert f.read() == files['a.txt']
+    assert os.path.exists(os.path.join(root, name, 'sub', 'b.txt'))
+
+    # jobs still running when the request is answered are polled
+    monkeypatch.setattr(server, 'JOB_WAIT', 0)
+    response = post_form(client, '/delete', {'path': [f'{name}/copied', f'{name}/sub']})
+    assert response.status_code in (200, 202)
+    if response.status_code == 202:
+        job_id = response.get_json()['job']['id']
+        for _ in range(100):
+            job = client.request('GET', url(f'/jobs/{job_id}')).get_json()
+            if job['state'] == 'done':
+                break
+            time.sleep(0.05)
+        assert job['state'] == 'done' and not job['errors']
+        assert job['filesDone'] == job['files']
+    assert os.listdir(os.path.join(root, name)) == []
+    assert client.request('GET', url('/jobs/missing')).status_code == 404
+
+
+def test_delta_upload(client, folder, root):
+    name, files = folder
+    old = files['data.bin']
+    started = post_form(client, '/upload/delta', {'folder': name, 'filename': 'data.bin'}).get_json()
+    assert started['code'] == 'DELTA_STARTED'
+    size = started['blockSize']
+    signatures = base64.b64decode(started['signatures'])
+    assert len(signatures) == 8*(len(old)//size)
+    assert struct.unpack('<II', signatures[:8]) == (zlib.adler32(old[:size]), zlib.crc32(old[:size]))
+
+    # the third block changes and some bytes are appended
+    new = old[:2*size] + os.urandom(size) + old[3*size:] + b'appended'
+    tail = new[3*size:len(old)]
+    delta = (struct.pack('<BII', 0, 0, 2) + struct.pack('<BI', 1, size) + new[2*size:3*size]
+             + struct.pack('<BII', 0, 3, len(tail)//size) + struct.pack('<BI', 1, 8) + b'appended')
+    fields = {'folder': name, 'filename': 'data.bin', 'upload': started['upload'], 'basis': started['basis'],
+              'fileSize': len(new)}
+    response = client.request('PUT', url('/upload/delta', offset=0, **fields),
+                              {'Content-Type': 'application/octet-stream'}, delta)
+    assert response.get_json() == {'message': 'Delta received', 'code': 'CONTINUE', 'offset': len(new)}
+    # the blocks were matched by crc32, so the whole file is checked with a stronger hash
+    response = post_form(client, '/upload/delta/commit', {**fields, 'checksum': f'crc32={zlib.crc32(new):08x}'})
+    assert response.status_code == 400
+    checksum = f'sha256={hashlib.sha256(new).hexdigest()}'
+    response = post_form(client, '/upload/delta/commit', {**fields, 'checksum': checksum})
+    assert response.get_json()['code'] == 'SUCCESS'
+    with open(os.path.join(root, name, 'data.bin'), 'rb') as f:
+        assert f.read() == new
+
+    # the file changed since the delta was started
+    response = post_form(client, '/upload/delta/commit', {**fields, 'checksum': checksum})
+    assert response.status_code == 409
+    assert response.get_json()['code'] == 'BASIS_CHANGED'
+    assert post_form(client, '/upload/delta', {'folder': name, 'filename': 'missing.bin'}).status_code == 404
+
+
+def test_sequential_downloads(client, folder):
+    # every transfer gives its place back, so one client is never told it has too many
+    name, files = folder
+    data = files['data.bin']
+    route = ('/download/<path:inputPath>',)
+    sent = server.SENT_BYTES.values.get(route, 0)
+    for i in range(server.FAIR_SHARE.client_transfers * 2):
+        response = client.request('GET', url(f'/download/{name}/data.bin'))
+        assert response.status_code == 200
+        response = client.request('GET', url(f'/download/{name}/data.bin'), {'Range': f'bytes={i}-{i + 99}'})
+        assert response.status_code == 206
+        response = client.request('GET', url(f'/zip/{name}', store='true'))
+        assert response.status_code == 200
+    assert server.FAIR_SHARE.transfers == 0
+    assert server.TRANSFERS.values.get(('download',)) == 0
+    assert server.SENT_BYTES.values.get(route, 0) - sent == server.FAIR_SHARE.client_transfers * 2 * (len(data) + 100)
+
+
+def test_throttled_upload(client, folder, root, monkeypatch):
+    name, _ = folder
+    rate = 256*1024
+    monkeypatch.setattr(server.FAIR_SHARE, 'client_rate', rate)
+    data = os.urandom(server.UPLOAD_MIN_CHUNK_SIZE*2 + 1000)
+    throttled = server.TRANSFER_THROTTLED_SECONDS.values.get(('upload',), 0)
+    session = create_session(client, name, 'throttled.bin', len(data))
+    start = time.monotonic()
+    assert send_chunks(client, session, 0, data).get_json()['code'] == 'SUCCESS'
+    # the first rate bytes are a burst, the rest is read at the rate
+    expected = (len(data) - rate)/rate
+    assert time.monotonic() - start >= expected*0.9
+    assert server.TRANSFER_THROTTLED_SECONDS.values[('upload',)] - throttled >= expected*0.9
+    assert server.FAIR_SHARE.transfers == 0
+    with open(os.path.join(root, name, 'throttled.bin'), 'rb') as f:
+        assert f.read() == data
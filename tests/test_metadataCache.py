@@ -0,0 +1,20 @@
+import os
+from modules.metadataCache import MetadataCache
+
+
+def test_lookup_missing_entry(tmp_path):
+    cache = MetadataCache(1024*1024)
+    cache.watcher_failed = True # only the mtime check, which can miss changes
+    with open(tmp_path / 'a.txt', 'w') as f:
+        f.write('a')
+    assert [e[0] for e in cache.scan(str(tmp_path))] == ['a.txt']
+    mtime_ns = os.stat(tmp_path).st_mtime_ns
+    with open(tmp_path / 'b.txt', 'w') as f:
+        f.write('bb')
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns)) # like a coarse mtime or another worker
+
+    entry = cache.lookup(str(tmp_path / 'b.txt'))
+    assert entry[:3] == ('b.txt', False, 2)
+    assert [e[0] for e in cache.scan(str(tmp_path))] == ['a.txt', 'b.txt']
+    assert cache.lookup(str(tmp_path / 'c.txt')) is None
+    assert cache.lookup(str(tmp_path / '.b.txt.qrpart')) is None
@@ -0,0 +1,69 @@
+import io, os, zipfile
+import pytest
+from modules.fileDigest import DigestIndex
+from modules.zipStream import ZipLayout, ZipStream
+
+
+@pytest.fixture
+def layout(tmp_path):
+    files = {'a.txt': b'hello world\n', 'data.bin': os.urandom(200*1024), 'sub/b.txt': b'b'*5000, 'sub/empty': b''}
+    entries = []
+    for name, data in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(data)
+        entries.append((str(path), name, os.stat(path)))
+    return ZipLayout(entries, DigestIndex()), files
+
+
+def read(layout, start, stop):
+    return b''.join(layout.read(start, stop))
+
+
+def test_whole_archive(layout):
+    layout, files = layout
+    archive = read(layout, 0, layout.size)
+    assert len(archive) == layout.size
+    with zipfile.ZipFile(io.BytesIO(archive)) as z:
+        assert z.testzip() is None
+        assert {name: z.read(name) for name in z.namelist()} == files
+
+
+def test_resume(layout):
+    layout, _ = layout
+    archive = read(layout, 0, layout.size)
+    starts = {layout.directory_offset}
+    for offset, header, path, st, _, _ in layout.entries:
+        data_offset = offset + len(header)
+        # inside the local header, at the start of the file data and inside it
+        starts.update((offset, offset + 1, offset + len(header)//2, data_offset, data_offset + st.st_size//2))
+    for start in sorted(starts):
+        resumed = archive[:start] + read(layout, start, layout.size)
+        assert resumed == archive, f'resumed at {start}'
+        with zipfile.ZipFile(io.BytesIO(resumed)) as z:
+            assert z.testzip() is None
+
+
+def test_ranges(layout):
+    layout, _ = layout
+    archive = read(layout, 0, layout.size)
+    offset, header, _, _, _, _ = layout.entries[2]
+    # a piece that ends in a local header and the next that starts in it
+    middle = offset + len(header)//2
+    pieces = [(0, middle), (middle, middle + 1000), (middle + 1000, layout.size)]
+    with zipfile.ZipFile(io.BytesIO(b''.join(read(layout, start, stop) for start, stop in pieces))) as z:
+        assert z.testzip() is None
+    assert read(layout, middle, middle + 1000) == archive[middle:middle + 1000]
+
+
+def test_stream_grown_file(tmp_path):
+    # files are listed before they are read and may have grown since
+    files = {'small.txt': b'small\n'*10, 'grown.txt': b'grown\n'*20000}
+    entries = []
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+        entries.append((str(tmp_path / name), name, 100, 0))
+    archive = b''.join(ZipStream(entries, compresslevel=1, threads=2, parallel_limit=1024).generator())
+    with zipfile.ZipFile(io.BytesIO(archive)) as z:
+        assert z.testzip() is None
+        assert {name: z.read(name) for name in z.namelist()} == files